@@ -1,6 +1,6 @@
 import json
 import os
-import time
+import re
 
 import merge_structure
 import click
@@ -9,19 +9,44 @@ from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv(usecwd=True))
 
 POLL_TIME = 2
+ECR_HOST_PATTERN = re.compile(r'^\d+\.dkr\.ecr\.([a-z0-9-]+)\.amazonaws\.com(\.cn)?$')
 
 
-def run_command(command, echo=False):
+def local_path(path):
     """
-    Simple wrapper to perform a command
+    Return `path` relative to the directory of the client the server runs
+    this thread's command for, if any
     """
-    from subprocess import Popen, PIPE, STDOUT
-    p = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT)
-    if echo:
-        for line in iter(p.stdout.readline, ''):
-            click.echo(line.replace("\n", ""))
-    else:
-        return p.stdout.read()
+    from .process import request_cwd
+
+    cwd = request_cwd()
+    return os.path.join(cwd, path) if cwd else path
+
+
+def run_command(command, echo=False, check=False, on_line=None, env=None):
+    """
+    Perform a command: a string run by the shell, or a list of arguments.
+    With `echo`, its output is shown as it is written, otherwise it is kept
+    in the result. With `check`, a failing command raises a CommandError
+    showing the end of its output. `on_line` is called with each line of
+    output. `env` has variables to add to its environment. Returns the
+    CommandResult, with the exit code
+    """
+    from .process import CommandError, run
+
+    result = run(command, echo=echo, on_line=on_line, env=env)
+    if check and not result.ok:
+        raise CommandError(result)
+    return result
+
+
+def command_succeeds(command):
+    """
+    Perform a command, returning whether it exited with 0
+    """
+    from .process import run
+
+    return run(command).ok
 
 
 def find_base_dir():
@@ -66,10 +91,7 @@ def git_has_tag(tag):
     """
     Check if the git repo has the tag
     """
-    result = run_command('git show-ref --tags {0}'.format(tag))
-    if result:
-        return True
-    return False
+    return command_succeeds(['git', 'show-ref', '--tags', '--quiet', '--verify', 'refs/tags/{0}'.format(tag)])
 
 
 def git_is_clean():
@@ -77,8 +99,7 @@ def git_is_clean():
     Make sure there aren't any uncommitted changes in git
     """
     # If this isn't a git repository, there isn't a problem.
-    response = run_command('git -C . rev-parse')
-    if 'Not a git repository' in response:
+    if not command_succeeds(['git', 'rev-parse']):
         return True
 
     # Update the index
@@ -87,13 +108,13 @@ def git_is_clean():
     clean = True
 
     # Disallow unstaged changes in the working tree
-    response = run_command('git diff-files --name-status -r --ignore-submodules --')
+    response = run_command('git diff-files --name-status -r --ignore-submodules --', check=True).output
     if response:
         click.echo("You have unstaged changes.")
         clean = False
 
     # Disallow uncommitted changes in the index
-    response = run_command('git diff-index --cached --name-status -r --ignore-submodules HEAD --')
+    response = run_command('git diff-index --cached --name-status -r --ignore-submodules HEAD --', check=True).output
     if response:
         click.echo("Your index contains uncommitted changes.")
         clean = False
@@ -110,26 +131,62 @@ def git_tag(tag):
     """
     if git_has_tag(tag):
         click.echo("Checking out existing tag '{0}' in git".format(tag))
-        run_command("git checkout {0}".format(tag))
+        run_command(['git', 'checkout', tag], check=True)
     else:
         click.echo("Tagging git repository with '{0}'".format(tag))
-        run_command("git tag {0}".format(tag))
-        run_command("git push --tags")
+        run_command(['git', 'tag', tag], check=True)
+        run_command("git push --tags", check=True)
 
 
-def docker_tag(ecs_client, ecr_client, project_name, repository, tag):
+def get_repository_region(repository):
     """
-    Tag the docker image, or use a previously tagged image
+    Return the region of an ECR repository URI, or None if it isn't one
     """
-    repository_host, repository_name = repository.split('/')
+    match = ECR_HOST_PATTERN.match(repository.split('/')[0])
+    return match.group(1) if match else None
+
+
+def regional_repository(repository, region):
+    """
+    Return the URI of the repository with the same account and name in `region`
+    """
+    current_region = get_repository_region(repository)
+    if current_region is None:
+        raise click.ClickException("{0} isn't the URI of an ECR repository.".format(repository))
+    repository_host, repository_name = repository.split('/', 1)
+    repository_host = repository_host.replace('.{0}.'.format(current_region), '.{0}.'.format(region), 1)
+    return "{0}/{1}".format(repository_host, repository_name)
+
+
+def ecr_login_command(repository):
+    """
+    The command that logs docker in to the region of the repository
+    """
+    region = get_repository_region(repository)
+    region_arg = " --region {0}".format(region) if region else ""
+    return "eval $(aws ecr get-login --no-include-email{0})".format(region_arg)
+
+
+def docker_tag(ecs_client, ecr_client, project_name, repository, tag, docker=None, compression=None):
+    """
+    Tag the docker image, or use a previously tagged image. With `docker`, a
+    DockerEngine, the image is tagged and pushed with the Docker Engine API.
+    With `compression`, a LayerCompression, BuildKit pushes it with its
+    layers recompressed. Returns the digest of the pushed image when it is
+    known
+    """
+    repository_host, repository_name = repository.split('/', 1)
 
     # Make sure tag doesn't already exist remotely
     remote_tagged_img = tagged_img = False
     remote_tagged_img = ecr_client.has_tagged_image(repository_name, tag)
     if not remote_tagged_img:
         # Check to make sure the tag doesn't already exist locally
-        docker_cmd = 'docker images --quiet {0}:{1}'.format(repository, tag)
-        tagged_img = run_command(docker_cmd)
+        if docker is not None:
+            tagged_img = docker.image_id('{0}:{1}'.format(repository, tag))
+        else:
+            docker_cmd = 'docker images --quiet {0}:{1}'.format(repository, tag)
+            tagged_img = run_command(docker_cmd).output.strip()
         if tagged_img:
             click.echo("Found previously locally tagged image")
     else:
@@ -142,24 +199,59 @@ def docker_tag(ecs_client, ecr_client, project_name, repository, tag):
     }
     if not tagged_img and not remote_tagged_img:
         click.echo("Tagging image with {0}".format(tag))
-        docker_cmd = "docker tag {project_name} {repository}:{tag}".format(**kwargs)
-        run_command(docker_cmd)
+        if docker is not None:
+            docker.tag(project_name, repository, tag)
+        else:
+            docker_cmd = "docker tag {project_name} {repository}:{tag}".format(**kwargs)
+            run_command(docker_cmd, check=True)
 
     if not remote_tagged_img:
         click.echo("Pushing to {repository}:{tag}".format(**kwargs))
-        docker_cmd = "eval $(aws ecr get-login --no-include-email --region us-east-1) && " \
-                    "docker push {repository}:{tag}".format(**kwargs)
-        run_command(docker_cmd, echo=True)
+        if compression is not None:
+            from .compression import push_compressed
 
+            return push_compressed(ecr_client, repository, tag, compression)
+        if docker is not None:
+            return docker.push(repository, tag, ecr_client.get_login()).digest
+        docker_cmd = "{0} && docker push {repository}:{tag}".format(ecr_login_command(repository), **kwargs)
+        run_command(docker_cmd, echo=True, check=True)
+
+
+def track_tasks(ecs_client, cluster, task_ids):
+    """Wait until the tasks are STOPPED"""
+    from .poller import get_poller
+
+    poller = get_poller(ecs_client)
+    subscriptions = [poller.watch_task(cluster, task_id, lambda task: task['lastStatus'] == 'STOPPED')
+                     for task_id in task_ids]
+    for subscription in subscriptions:
+        subscription.wait()
+    click.echo('ECS tasks {0} STOPPED'.format(','.join(task_ids)))
+
+
+def get_container_log_config(task_def, container_name=None):
+    """
+    Return the name and log configuration of `container_name`, or the first
+    container if `container_name` isn't specified
+    """
+    for container in task_def['containerDefinitions']:
+        if container_name is None or container['name'] == container_name:
+            return container['name'], container.get('logConfiguration')
+    raise click.ClickException("There is no container named '{0}' in {1}.".format(container_name, task_def.family))
 
-def track_tasks(ecs_client, task_ids):
-    """Poll task status until STOPPED"""
-    while True:
-        statuses = ecs_client.get_task_statuses(task_ids)
-        if all([status == 'STOPPED' for status in statuses]):
-            click.echo('ECS tasks {0} STOPPED'.format(','.join(task_ids)))
-            break
-        time.sleep(POLL_TIME)
+
+def get_log_stream_name(log_config, container_name, task_id):
+    """
+    Return the CloudWatch group and stream names that ECS uses for a task's
+    container, or (None, None) if the logs aren't available
+    """
+    if not log_config or log_config['logDriver'] != 'awslogs':
+        return None, None
+    if 'awslogs-stream-prefix' not in log_config['options']:
+        return None, None
+    log_group = log_config['options']['awslogs-group']
+    log_stream = "{0}/{1}/{2}".format(log_config['options']['awslogs-stream-prefix'], container_name, task_id)
+    return log_group, log_stream
 
 
 def get_latest_task_revision(ecs_client, family_name):
@@ -177,17 +269,15 @@ def get_latest_task_revision(ecs_client, family_name):
     return None
 
 
-def create_or_update_task(ecs_client, local_task_file, repository=None, tag=None):
+def render_task_def(local_task_file, repository=None, tag=None):
     """
-    Update or create the specified task
+    Fill in the placeholders of a local task definition, in place
 
-    The ecs_client is passed in because the AWS keys are passed into the
-    original function
+    Without a tag, the images are removed so the remote images are kept.
     """
     if tag and not repository:
         raise click.ClickException("Passed a tag without a repository.")
 
-    family_name = local_task_file.family
     if tag:
         # Replace the 'image' value on container Definitions with the local value
         for cd in local_task_file['containerDefinitions']:
@@ -197,12 +287,36 @@ def create_or_update_task(ecs_client, local_task_file, repository=None, tag=None
         # Remove the 'image' value on the container Definitions, use the
         # value already specified
         for cd in local_task_file['containerDefinitions']:
-            del cd['image']
+            cd.pop('image', None)
+    return local_task_file
+
 
-    task_def = get_latest_task_revision(ecs_client, family_name)
+def merge_remote_task_def(ecs_client, local_task_file):
+    """
+    Merge a rendered local task definition into the latest revision of its
+    family, or return None if the family doesn't exist
+    """
+    task_def = get_latest_task_revision(ecs_client, local_task_file.family)
+    if task_def is None:
+        return None
+    return EcsTaskDefinition(merge_structure.recursive_update(task_def, local_task_file))
+
+
+def create_or_update_task(ecs_client, local_task_file, repository=None, tag=None):
+    """
+    Update or create the specified task
+
+    The ecs_client is passed in because the AWS keys are passed into the
+    original function
+    """
+    if tag and not repository:
+        raise click.ClickException("Passed a tag without a repository.")
+
+    render_task_def(local_task_file, repository, tag)
+
+    task_def = merge_remote_task_def(ecs_client, local_task_file)
     if task_def is not None:
         click.echo("Merging remote task definition with local definition.")
-        task_def = EcsTaskDefinition(merge_structure.recursive_update(task_def, local_task_file))
     else:
         click.echo("Remote task definition doesn't exist. Task will be created.")
         task_def = local_task_file
@@ -296,16 +410,79 @@ def create_or_update_service(ecs_client, service_desc, task_definition=None, tas
             raise click.ClickException("Error received from AWS: {0}".format(response))
 
 
-def build(project_name, build_arg_str=""):
+def find_cached_image(project_name, context_hash, repository=None, ecr_client=None, docker=None):
+    """
+    Tag an existing image built from the same context as `project_name`.
+    Looks for a local image with the context hash label, then for an image
+    in the repository with the context hash tag. Returns True if one was found
+    """
+    from .build_cache import IMAGE_LABEL, HASH_TAG_PREFIX
+
+    if docker is not None:
+        image_ids = docker.find_images(IMAGE_LABEL, context_hash)
+    else:
+        image_ids = run_command("docker images --quiet --filter label={0}={1}".format(
+            IMAGE_LABEL, context_hash)).output.split()
+    if image_ids:
+        click.echo("Found local image {0} built from the same context".format(image_ids[0]))
+        if docker is not None:
+            docker.tag(image_ids[0], project_name)
+        else:
+            run_command("docker tag {0} {1}".format(image_ids[0], project_name), check=True)
+        return True
+
+    hash_tag = HASH_TAG_PREFIX + context_hash
+    if repository and ecr_client and ecr_client.has_tagged_image(repository, hash_tag):
+        click.echo("Found image {0}:{1} built from the same context".format(repository, hash_tag))
+        if docker is not None:
+            docker.pull(repository, hash_tag, ecr_client.get_login())
+            docker.tag("{0}:{1}".format(repository, hash_tag), project_name)
+            return True
+        docker_cmd = "{0} && docker pull {1}:{2}".format(ecr_login_command(repository), repository, hash_tag)
+        run_command(docker_cmd, echo=True, check=True)
+        run_command("docker tag {0}:{1} {2}".format(repository, hash_tag, project_name), check=True)
+        return True
+    return False
+
+
+def build(project_name, build_arg_str="", use_cache=False, repository=None, ecr_client=None, docker=None):
     """
     Do the actual building of the docker image.
+
+    With `use_cache`, the build is skipped if an image was already built from
+    the same context, Dockerfile and build arguments. With `docker`, a
+    DockerEngine, the image is built with the Docker Engine API unless
+    `build_arg_str` has options other than --build-arg. Returns the context
+    hash
     """
+    from .build_cache import IMAGE_LABEL, hash_build_context
+
     # base_dir = find_base_dir()
     base_dir = "."
+    context_hash = None
+    label_arg = ""
+    if use_cache:
+        context_hash = hash_build_context(local_path(base_dir), build_arg_str)
+        if find_cached_image(project_name, context_hash, repository, ecr_client, docker):
+            click.echo("Skipped building: the build context hasn't changed")
+            return context_hash
+        label_arg = "--label {0}={1}".format(IMAGE_LABEL, context_hash)
+
     click.echo("Building {0} from {1}".format(project_name, base_dir))
-    docker_cmd = "docker build -t {0} {1} {2}".format(project_name, build_arg_str, base_dir)
-    run_command(docker_cmd, echo=True)
+    if docker is not None:
+        from .docker_engine import parse_build_args
+
+        build_args = parse_build_args(build_arg_str)
+        if build_args is not None:
+            labels = {IMAGE_LABEL: context_hash} if context_hash else {}
+            docker.build(local_path(base_dir), project_name, build_args, labels)
+            click.echo("Finished Building")
+            return context_hash
+        click.echo("Building with the docker CLI for the options in the build arguments.")
+    docker_cmd = "docker build -t {0} {1} {2} {3}".format(project_name, label_arg, build_arg_str, base_dir)
+    run_command(docker_cmd, echo=True, check=True)
     click.echo("Finished Building")
+    return context_hash
 
 
 def validate(task_file, service_file):
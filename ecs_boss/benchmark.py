@@ -0,0 +1,263 @@
+"""
+Benchmark ecs-boss commands against a stand-in for AWS
+
+Each scenario runs a real command in a temporary directory, with the ECS, ECR
+and CloudWatch Logs clients replaced by `ecs_boss.standin` and docker and git
+replaced by a recorder. Sleeping is virtual: the time a command spends
+waiting between polls is added up instead of slept, so only the injected API
+latency takes real time.
+
+The API calls, the time spent waiting and the wall time of each scenario are
+compared with a baseline. More calls or more waiting is a regression, as is a
+wall time more than --time-tolerance above the baseline. The scenarios take
+hundredths of a second, so a wall time within --time-floor of the baseline is
+timing noise and never a regression.
+
+    python -m ecs_boss.benchmark
+    python -m ecs_boss.benchmark --save
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import click
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks',
+                                'baseline.json')
+ACCOUNT = '123456789012'
+REPOSITORY = '{0}.dkr.ecr.us-east-1.amazonaws.com/web'.format(ACCOUNT)
+
+TASK_DEF = {
+    'family': 'web',
+    'containerDefinitions': [{
+        'name': 'web',
+        'image': '%REPOSITORY%:%RELEASE_TAG%',
+        'memory': 256,
+        'command': ['gunicorn', 'app:wsgi'],
+        'environment': [{'name': 'ENV', 'value': 'benchmark'}],
+        'logConfiguration': {
+            'logDriver': 'awslogs',
+            'options': {'awslogs-group': '/ecs/web', 'awslogs-region': 'us-east-1', 'awslogs-stream-prefix': 'web'},
+        },
+    }],
+}
+SERVICE = {
+    'cluster': 'benchmark',
+    'serviceName': 'web',
+    'taskDefinition': 'web',
+    'desiredCount': 2,
+}
+
+SCENARIOS = OrderedDict([
+    ('deploy', ['deploy', '--repository', REPOSITORY, '--tag', 'bench-2']),
+    ('deploy-watch', ['deploy', '--repository', REPOSITORY, '--tag', 'bench-2', '--watch']),
+    ('update-task-and-service', ['update-task-and-service', '--repository', REPOSITORY, '--tag', 'bench-1']),
+    ('scale-service', ['scale-service', '4']),
+    ('run-task-command', ['run-task-command', 'manage.py migrate']),
+    ('run-task-command-shards', ['run-task-command', '--shards', '25', '--launch-rate', '5', 'manage.py check']),
+])
+
+
+class VirtualClock(object):
+    """
+    Replaces time.sleep and time.time so waiting takes no real time. The
+    clock only moves when something sleeps, which keeps timeouts and rate
+    limits deterministic
+    """
+    def __init__(self):
+        self.waited = 0.0
+        self._lock = threading.Lock()
+        self._real_sleep = time.sleep
+        self._real_time = time.time
+        self._start = time.time()
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.waited += max(seconds, 0)
+
+    def time(self):
+        return self._start + self.waited
+
+    def __enter__(self):
+        time.sleep = self.sleep
+        time.time = self.time
+        return self
+
+    def __exit__(self, *exc_info):
+        time.sleep = self._real_sleep
+        time.time = self._real_time
+
+
+class CommandRecorder(object):
+    """
+    Replaces run_command and command_succeeds: records the docker and git
+    commands, and adds the pushed images to the stand-in's repositories
+    """
+    def __init__(self, aws):
+        self.aws = aws
+        self.commands = []
+
+    def __call__(self, command, echo=False, check=False, on_line=None, env=None):
+        from .process import CommandResult
+
+        if isinstance(command, (list, tuple)):
+            command = " ".join(command)
+        self.commands.append(command)
+        match = re.search(r'docker push (\S+):(\S+)', command)
+        if match:
+            self.aws.add_image(match.group(1).split('/')[-1], match.group(2))
+        output = 'master\n' if command.startswith('git rev-parse --abbrev-ref') and not echo else ''
+        return CommandResult(command, 0, output, output.splitlines())
+
+    def succeeds(self, command):
+        self.commands.append(" ".join(command) if isinstance(command, (list, tuple)) else command)
+        return not self.commands[-1].startswith('git show-ref')
+
+
+def setup_account(aws):
+    """
+    Create the task definition, service and images the scenarios start from
+    """
+    from copy import deepcopy
+
+    containers = deepcopy(TASK_DEF['containerDefinitions'])
+    containers[0]['image'] = '{0}:bench-0'.format(REPOSITORY)
+    for tag in ('bench-0', 'bench-1'):
+        aws.add_image('web', tag)
+    aws.add_task_definition('web', containers)
+    aws.add_service(SERVICE['cluster'], SERVICE['serviceName'], SERVICE['taskDefinition'], SERVICE['desiredCount'])
+
+
+def run_scenario(name, args, latency=0.0, throttle_every=0, page_size=100):
+    """
+    Run one scenario and return its measurements
+    """
+    from click.testing import CliRunner
+    from . import api, build_cache, commands, ecs
+    from .standin import StandInAws
+
+    # Commands import modules when they need them, after the runner has left this directory
+    package = sys.modules[__package__]
+    package.__path__[:] = [os.path.abspath(path) for path in package.__path__]
+
+    aws = StandInAws(latency=latency, throttle_every=throttle_every, page_size=page_size)
+    setup_account(aws)
+    recorder = CommandRecorder(aws)
+    patched = [(api, 'run_command'), (api, 'command_succeeds'), (commands, 'run_command'), (build_cache, 'CACHE_DIR')]
+    originals = [getattr(module, attr) for module, attr in patched]
+    cache_dir = tempfile.mkdtemp()
+
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('task-def.json', 'w') as f:
+            json.dump(TASK_DEF, f)
+        with open('service.json', 'w') as f:
+            json.dump(SERVICE, f)
+        with open('Dockerfile', 'w') as f:
+            f.write('FROM python:2.7\n')
+
+        ecs.set_client_factory(aws.client)
+        for (module, attr), value in zip(patched, [recorder, recorder.succeeds, recorder, cache_dir]):
+            setattr(module, attr, value)
+        try:
+            with VirtualClock() as clock:
+                start = clock._real_time()
+                result = runner.invoke(commands.cli, args)
+                seconds = clock._real_time() - start
+        finally:
+            ecs.set_client_factory(None)
+            for (module, attr), value in zip(patched, originals):
+                setattr(module, attr, value)
+            shutil.rmtree(cache_dir)
+
+    if result.exit_code != 0:
+        raise click.ClickException("Scenario {0} failed:\n{1}{2}".format(name, result.output, result.exception or ''))
+    return OrderedDict([
+        ('seconds', round(seconds, 4)),
+        ('waited', round(clock.waited, 4)),
+        ('total_calls', aws.total_calls),
+        ('throttled', aws.throttled),
+        ('calls', OrderedDict(sorted(aws.calls.items()))),
+    ])
+
+
+def compare(name, result, baseline, time_tolerance, time_floor=0.25):
+    """
+    Return the regressions of a scenario compared with its baseline
+    """
+    regressions = []
+    for operation, count in result['calls'].items():
+        if count > baseline['calls'].get(operation, 0):
+            regressions.append("{0}: {1} calls to {2}, up from {3}".format(
+                name, count, operation, baseline['calls'].get(operation, 0)))
+    if result['waited'] > baseline['waited'] + 0.001:
+        regressions.append("{0}: waited {1}s, up from {2}s".format(name, result['waited'], baseline['waited']))
+    if result['seconds'] > max(baseline['seconds'] * (1 + time_tolerance), baseline['seconds'] + time_floor):
+        regressions.append("{0}: took {1:.3f}s, more than {2:.0%} and {3}s above {4:.3f}s".format(
+            name, result['seconds'], time_tolerance, time_floor, baseline['seconds']))
+    return regressions
+
+
+@click.command()
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(list(SCENARIOS)),
+              help="Run only this scenario. May be repeated. Default is every scenario.")
+@click.option('--latency', type=float, default=0.005, help="Seconds added to every API call.")
+@click.option('--throttle-every', type=int, default=20, help="Throttle every Nth API call. 0 never throttles.")
+@click.option('--page-size', type=int, default=100, help="The most items in a page of results.")
+@click.option('--repeat', type=int, default=3, help="Run each scenario this many times and keep the fastest.")
+@click.option('--baseline', 'baseline_file', default=DEFAULT_BASELINE, help="The baseline to compare with.")
+@click.option('--time-tolerance', type=float, default=0.5,
+              help="How much slower than the baseline a scenario may be, e.g. 0.5 for 50%.")
+@click.option('--time-floor', type=float, default=0.25,
+              help="Seconds a scenario may always be slower than the baseline, whatever --time-tolerance allows.")
+@click.option('--save', is_flag=True, help="Save the results as the new baseline instead of comparing.")
+def main(scenarios, latency, throttle_every, page_size, repeat, baseline_file, time_tolerance, time_floor, save):
+    """
+    Benchmark the commands against a stand-in for AWS
+    """
+    settings = OrderedDict([('latency', latency), ('throttle_every', throttle_every), ('page_size', page_size)])
+    baseline = None
+    if not save:
+        if not os.path.exists(baseline_file):
+            raise click.ClickException("There is no baseline at {0}. Create one with --save.".format(baseline_file))
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != settings:
+            raise click.ClickException("The baseline was recorded with different settings: {0}".format(
+                json.dumps(baseline['settings'])))
+
+    results = OrderedDict()
+    regressions = []
+    click.echo("{0:<26} {1:>9} {2:>9} {3:>7} {4:>10}".format('scenario', 'seconds', 'waited', 'calls', 'throttled'))
+    for name in scenarios or SCENARIOS:
+        runs = [run_scenario(name, SCENARIOS[name], latency, throttle_every, page_size) for _ in range(max(repeat, 1))]
+        result = min(runs, key=lambda r: r['seconds'])
+        results[name] = result
+        click.echo("{0:<26} {1:>9.3f} {2:>9.1f} {3:>7} {4:>10}".format(
+            name, result['seconds'], result['waited'], result['total_calls'], result['throttled']))
+        if baseline is not None and name in baseline['results']:
+            regressions.extend(compare(name, result, baseline['results'][name], time_tolerance, time_floor))
+
+    if save:
+        if os.path.dirname(baseline_file) and not os.path.isdir(os.path.dirname(baseline_file)):
+            os.makedirs(os.path.dirname(baseline_file))
+        with open(baseline_file, 'w') as f:
+            json.dump(OrderedDict([('settings', settings), ('results', results)]), f, indent=2)
+            f.write('\n')
+        click.echo("Saved the baseline to {0}".format(baseline_file))
+        return
+
+    if regressions:
+        click.echo("\n".join(regressions))
+        raise click.ClickException("{0} regressions compared with {1}.".format(len(regressions), baseline_file))
+    click.echo("No regressions compared with {0}.".format(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
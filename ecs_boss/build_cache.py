@@ -0,0 +1,181 @@
+"""
+Hash a docker build context so unchanged builds can be skipped
+
+The hash covers every file docker would send (honoring .dockerignore), the
+Dockerfile and the build arguments. File hashes are remembered by size and
+modification time between runs, and files that changed are hashed in
+parallel.
+"""
+import hashlib
+import json
+import os
+import re
+
+IMAGE_LABEL = 'ecs-boss.context-hash'
+HASH_TAG_PREFIX = 'ctx-'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ecs-boss', 'build-cache')
+READ_SIZE = 1024 * 1024
+
+
+def translate_pattern(pattern):
+    """
+    Convert a .dockerignore pattern into a regular expression. A pattern that
+    matches a directory also matches everything in it.
+    """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern[i:i + 3] == '**/':
+            regex += '(.*/)?'
+            i += 3
+            continue
+        if pattern[i:i + 2] == '**':
+            regex += '.*'
+            i += 2
+            continue
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        else:
+            regex += re.escape(char)
+        i += 1
+    return re.compile('^{0}(/.*)?$'.format(regex))
+
+
+class DockerIgnore(object):
+    """
+    The exclusion rules of a .dockerignore file. Later patterns win, and
+    patterns starting with ! include files again.
+    """
+    def __init__(self, lines=()):
+        self.rules = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            include = line.startswith('!')
+            pattern = os.path.normpath(line.lstrip('!').strip()).lstrip('/')
+            self.rules.append((include, translate_pattern(pattern)))
+
+    @classmethod
+    def from_context(cls, context_dir):
+        path = os.path.join(context_dir, '.dockerignore')
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(f.readlines())
+
+    @property
+    def has_exceptions(self):
+        return any([include for include, _ in self.rules])
+
+    def is_excluded(self, rel_path):
+        excluded = False
+        for include, regex in self.rules:
+            if regex.match(rel_path):
+                excluded = not include
+        return excluded
+
+
+def iter_context_files(context_dir, ignore=None):
+    """
+    Yield the relative paths of the files docker would send as the context
+    """
+    ignore = ignore or DockerIgnore.from_context(context_dir)
+    for dir_path, dir_names, file_names in os.walk(context_dir):
+        rel_dir = os.path.relpath(dir_path, context_dir)
+        rel_dir = '' if rel_dir == '.' else rel_dir
+        if not ignore.has_exceptions:
+            # Nothing inside an excluded directory can be included again
+            dir_names[:] = [d for d in dir_names if not ignore.is_excluded(os.path.join(rel_dir, d))]
+        # A link to a directory is sent as a link, like a file, and isn't walked into
+        links = [d for d in dir_names if os.path.islink(os.path.join(dir_path, d))]
+        dir_names[:] = sorted([d for d in dir_names if d not in links])
+        for file_name in sorted(file_names + links):
+            rel_path = os.path.join(rel_dir, file_name)
+            if not ignore.is_excluded(rel_path):
+                yield rel_path
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileHashCache(object):
+    """
+    File hashes from the last run, keyed by relative path and checked against
+    the size and modification time
+    """
+    def __init__(self, context_dir):
+        name = hashlib.sha1(os.path.abspath(context_dir).encode('utf-8')).hexdigest()
+        self.path = os.path.join(CACHE_DIR, '{0}.json'.format(name))
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+
+    def get(self, rel_path, stat):
+        entry = self.entries.get(rel_path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            return entry[2]
+        return None
+
+    def save(self, entries):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp_path = "{0}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp_path, self.path)
+
+
+def hash_build_context(context_dir='.', build_arg_str='', dockerfile='Dockerfile', concurrency=8):
+    """
+    Return a hash of the build context, Dockerfile and build arguments
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = FileHashCache(context_dir)
+    entries = {}
+    links = {}
+    to_hash = []
+    for rel_path in iter_context_files(context_dir):
+        path = os.path.join(context_dir, rel_path)
+        if os.path.islink(path):
+            # Docker sends the link itself, so the build sees a change of its target
+            links[rel_path] = hashlib.sha256(os.readlink(path).encode('utf-8')).hexdigest()
+            continue
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        file_hash = cache.get(rel_path, stat)
+        entries[rel_path] = [stat.st_size, stat.st_mtime, file_hash, stat.st_mode & 0o777]
+        if file_hash is None:
+            to_hash.append(rel_path)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        paths = [os.path.join(context_dir, rel_path) for rel_path in to_hash]
+        for rel_path, file_hash in zip(to_hash, executor.map(hash_file, paths)):
+            entries[rel_path][2] = file_hash
+    cache.save(dict([(k, v[:3]) for k, v in entries.items()]))
+
+    digest = hashlib.sha256()
+    for rel_path in sorted(list(entries) + list(links)):
+        if rel_path in links:
+            digest.update('{0}\0link\0{1}\n'.format(rel_path, links[rel_path]).encode('utf-8'))
+        else:
+            mode, file_hash = entries[rel_path][3], entries[rel_path][2]
+            digest.update('{0}\0{1:o}\0{2}\n'.format(rel_path, mode, file_hash).encode('utf-8'))
+    with open(os.path.join(context_dir, dockerfile), 'rb') as f:
+        digest.update(f.read())
+    digest.update(build_arg_str.encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,261 @@
+"""
+Check that an EC2 cluster has room for a rollout before starting it
+
+The free cpu, memory and host ports of every container instance are read with
+list_container_instances and describe_container_instances (in batches of 100).
+The new tasks are then placed on the instances one at a time:
+
+- First the tasks ECS starts before stopping the rest of the old tasks. The
+  deploymentConfiguration decides how many: up to maximumPercent of the
+  desired count may run at once, and ECS stops old tasks first only down to
+  minimumHealthyPercent.
+- Then, with every old task stopped, the rest of the new tasks.
+
+If none of the first tasks fit, the rollout would wait for capacity forever.
+If not all the tasks fit at the end, some would never be placed. Either way
+the check fails and says how much cpu and memory is missing.
+"""
+from collections import namedtuple
+from functools import partial
+
+from .ecs import DESCRIBE_CONTAINER_INSTANCES_MAX, chunked
+
+TaskRequirements = namedtuple('TaskRequirements', ['cpu', 'memory', 'ports'])
+
+
+def parse_units(value, unit_size):
+    """
+    Convert a task-level cpu or memory value ("1024", "1 vCPU", "2 GB") into
+    cpu units or MiB
+    """
+    value = str(value).strip().lower()
+    for suffix in ('vcpu', 'gb'):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * unit_size)
+    return int(value)
+
+
+def get_requirements(task_def):
+    """
+    The cpu units, memory (MiB) and host ports that one task takes on an instance
+    """
+    containers = task_def.get('containerDefinitions', [])
+    if task_def.get('cpu'):
+        cpu = parse_units(task_def['cpu'], 1024)
+    else:
+        cpu = sum([c.get('cpu', 0) for c in containers])
+    if task_def.get('memory'):
+        memory = parse_units(task_def['memory'], 1024)
+    else:
+        # The scheduler places tasks by their soft limit, when a container has one
+        memory = sum([c.get('memoryReservation') or c.get('memory') or 0 for c in containers])
+
+    ports = set()
+    network_mode = task_def.get('networkMode', 'bridge')
+    if network_mode != 'awsvpc':  # Tasks with their own network interface don't use the instance's ports
+        for container in containers:
+            for mapping in container.get('portMappings', []):
+                port = mapping.get('hostPort') or (mapping.get('containerPort') if network_mode == 'host' else 0)
+                if port:
+                    ports.add((mapping.get('protocol', 'tcp'), int(port)))
+    return TaskRequirements(cpu, memory, frozenset(ports))
+
+
+class InstanceCapacity(object):
+    """
+    The free resources of a container instance
+    """
+    def __init__(self, instance):
+        self.arn = instance['containerInstanceArn']
+        self.cpu = 0
+        self.memory = 0
+        self.ports = set()
+        for resource in instance.get('remainingResources', []):
+            if resource['name'] == 'CPU':
+                self.cpu = resource['integerValue']
+            elif resource['name'] == 'MEMORY':
+                self.memory = resource['integerValue']
+            elif resource['name'] in ('PORTS', 'PORTS_UDP'):
+                protocol = 'udp' if resource['name'] == 'PORTS_UDP' else 'tcp'
+                self.ports.update([(protocol, int(port)) for port in resource.get('stringSetValue', [])])
+        self.placed = 0
+
+    def fits(self, requirements):
+        return (self.cpu >= requirements.cpu and self.memory >= requirements.memory
+                and not self.ports & requirements.ports)
+
+    def place(self, requirements):
+        self.cpu -= requirements.cpu
+        self.memory -= requirements.memory
+        self.ports |= requirements.ports
+        self.placed += 1
+
+    def release(self, requirements):
+        self.cpu += requirements.cpu
+        self.memory += requirements.memory
+        self.ports -= requirements.ports
+
+
+def get_instance_capacities(ecs_client, cluster, concurrency=4):
+    """
+    Return the free resources of the active, connected container instances
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    describe = partial(ecs_client.describe_container_instances, cluster)
+    futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for page in ecs_client.iter_container_instance_arn_pages(cluster):
+            futures.extend([executor.submit(describe, chunk)
+                            for chunk in chunked(page, DESCRIBE_CONTAINER_INSTANCES_MAX)])
+        instances = []
+        for future in futures:
+            instances.extend([InstanceCapacity(instance) for instance in future.result()['containerInstances']
+                              if instance.get('status') == 'ACTIVE' and instance.get('agentConnected', True)])
+    return instances
+
+
+def plan_rollout(desired_count, old_count, deployment_configuration=None):
+    """
+    Return how many new tasks ECS starts before the old tasks it keeps
+    running stop, and how many old tasks it keeps until then
+    """
+    config = deployment_configuration or {}
+    max_total = desired_count * config.get('maximumPercent', 200) // 100
+    min_healthy = -(-desired_count * config.get('minimumHealthyPercent', 100) // 100)
+    kept_old = old_count
+    if old_count + desired_count > max_total:
+        kept_old = max(min(old_count, min_healthy), max_total - desired_count)
+    return max(min(desired_count, max_total - kept_old), 0), kept_old
+
+
+def place(instances, requirements, count, distinct_instances=False):
+    """
+    Place up to `count` tasks on the instances with the most free memory
+    first. Returns how many were placed
+    """
+    placed = 0
+    for _ in range(count):
+        candidates = [i for i in instances if i.fits(requirements) and not (distinct_instances and i.placed)]
+        if not candidates:
+            break
+        max(candidates, key=lambda i: (i.memory, i.cpu)).place(requirements)
+        placed += 1
+    return placed
+
+
+class CapacityReport(object):
+    def __init__(self):
+        self.ok = True
+        self.skipped = False
+        self.messages = []
+
+    def fail(self, message):
+        self.ok = False
+        self.messages.append(message)
+
+
+def describe_missing(instances, requirements, missing):
+    """
+    Explain why `missing` more tasks don't fit and how much capacity they need
+    """
+    needs = ["{0} MiB of memory".format(requirements.memory)]
+    if requirements.cpu:
+        needs.insert(0, "{0} CPU units".format(requirements.cpu))
+    message = "Each task needs {0}".format(" and ".join(needs))
+    if requirements.ports:
+        message += " and host ports {0}".format(
+            ", ".join(["{1}/{0}".format(*port) for port in sorted(requirements.ports)]))
+    if instances:
+        largest = max(instances, key=lambda i: (i.memory, i.cpu))
+        message += "; the instance with the most free memory has {0} CPU units and {1} MiB left".format(
+            largest.cpu, largest.memory)
+    message += ". Add capacity for at least {0} more MiB of memory".format(missing * requirements.memory)
+    if requirements.cpu:
+        message += " and {0} more CPU units".format(missing * requirements.cpu)
+    return message + "."
+
+
+def check_capacity(ecs_client, service_desc, task_def, desired_count=None):
+    """
+    Check that the cluster has room to roll `task_def` out to the service
+    described by `service_desc` (the service file) with `desired_count`
+    tasks. Returns a CapacityReport
+    """
+    report = CapacityReport()
+    cluster = service_desc['cluster']
+    response = ecs_client.describe_services(cluster, service_desc['serviceName'])
+    service = response['services'][0] if response['services'] else {}
+    launch_type = service_desc.get('launchType') or service.get('launchType')
+    if launch_type == 'FARGATE' or service.get('capacityProviderStrategy'):
+        report.skipped = True
+        report.messages.append("Skipped the capacity check: the service doesn't run on EC2 instances.")
+        return report
+
+    if desired_count is None:
+        desired_count = service_desc.get('desiredCount', service.get('desiredCount', 1))
+    deployment_configuration = service_desc.get('deploymentConfiguration', service.get('deploymentConfiguration'))
+    constraints = service_desc.get('placementConstraints', service.get('placementConstraints')) or []
+    distinct_instances = any([c.get('type') == 'distinctInstance' for c in constraints])
+    requirements = get_requirements(task_def)
+    instances = get_instance_capacities(ecs_client, cluster)
+    if not instances:  # e.g. a cluster whose default capacity provider is Fargate
+        report.skipped = True
+        report.messages.append("Skipped the capacity check: {0} has no active container instances.".format(cluster))
+        return report
+    by_arn = dict([(instance.arn, instance) for instance in instances])
+    name = "{0}:{1}".format(task_def.get('family', ''), task_def.get('revision', ''))
+
+    old_tasks = []
+    if service:
+        task_arns = ecs_client.list_task_arns(cluster, service['serviceName'])
+        if task_arns:
+            old_tasks = ecs_client.describe_tasks(cluster, task_arns)['tasks']
+    for instance in instances:  # Tasks can't share an instance with a distinctInstance constraint
+        instance.placed = len([t for t in old_tasks if t.get('containerInstanceArn') == instance.arn])
+
+    if service.get('taskDefinition') in (task_def.get('taskDefinitionArn'), None):
+        # Scaling: the running tasks stay and only the extra tasks are started
+        new_count = max(desired_count - len(old_tasks), 0)
+        missing = new_count - place(instances, requirements, new_count, distinct_instances)
+        if missing:
+            report.fail("{0} of the {1} new tasks of {2} don't fit on the {3} instances of {4}. {5}".format(
+                missing, new_count, name, len(instances), cluster, describe_missing(instances, requirements, missing)))
+        else:
+            report.messages.append("The {0} instances of {1} have room for {2} more tasks of {3}.".format(
+                len(instances), cluster, new_count, name))
+        return report
+
+    old_requirements = get_requirements(ecs_client.describe_task_definition(service['taskDefinition']))
+
+    def release(tasks):
+        for task in tasks:
+            instance = by_arn.get(task.get('containerInstanceArn'))
+            if instance is not None:
+                instance.release(old_requirements)
+                instance.placed -= 1
+
+    first_wave, kept_old = plan_rollout(desired_count, len(old_tasks), deployment_configuration)
+    release(old_tasks[kept_old:])  # Stopped before the first new tasks start
+    placed = place(instances, requirements, first_wave, distinct_instances)
+    if first_wave and not placed:
+        report.fail("None of the first {0} tasks of {1} fit on the {2} instances of {3} while {4} old tasks are "
+                    "kept running, so the rollout would never start. {5}".format(
+                        first_wave, name, len(instances), cluster, kept_old,
+                        describe_missing(instances, requirements, first_wave)))
+        return report
+    if placed < first_wave:
+        report.messages.append("Only {0} of the first {1} tasks of {2} fit while the old tasks run, so the "
+                               "rollout will take more steps.".format(placed, first_wave, name))
+
+    release(old_tasks[:kept_old])
+    placed += place(instances, requirements, desired_count - placed, distinct_instances)
+    missing = desired_count - placed
+    if missing:
+        report.fail("{0} of the {1} tasks of {2} don't fit on the {3} instances of {4}. {5}".format(
+            missing, desired_count, name, len(instances), cluster,
+            describe_missing(instances, requirements, missing)))
+    else:
+        report.messages.append("The {0} instances of {1} have room to roll out {2} tasks of {3}.".format(
+            len(instances), cluster, desired_count, name))
+    return report
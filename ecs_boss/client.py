@@ -0,0 +1,59 @@
+"""
+A thin client for `ecs-boss serve`
+
+It sends its command line, working directory and environment to the server
+and prints the output as it arrives, so a command doesn't pay for starting
+Python, importing boto3 and resolving credentials. When no server is running,
+the command runs in this process instead.
+"""
+import json
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.ecs-boss', 'ecs-boss.sock')
+
+
+def get_socket_path():
+    return os.environ.get('ECS_BOSS_SOCKET') or DEFAULT_SOCKET
+
+
+def connect(socket_path):
+    """
+    Return a socket connected to the server, or None if it isn't running
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else list(args)
+    sock = connect(get_socket_path())
+    if sock is None:
+        from ecs_boss.commands import cli
+        return cli(args=args, prog_name='ecs-boss')
+
+    request = {'args': args, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+    responses = sock.makefile('rb')
+    exit_code = 1  # If the server goes away before saying how the command ended
+    for line in iter(responses.readline, b''):
+        message = json.loads(line.decode('utf-8'))
+        if 'exit_code' in message:
+            exit_code = message['exit_code']
+            break
+        stream = sys.stderr if message.get('stream') == 'stderr' else sys.stdout
+        stream = getattr(stream, 'buffer', stream)
+        stream.write(message['output'].encode('utf-8'))
+        stream.flush()
+    sock.close()
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,46 @@
 import json
+import os
+import threading
 import click
-from .ecs import EcsClient, EcrClient, CloudWatchLogClient
+from .ecs import EcsClient, EcrClient, CloudWatchClient, CloudWatchLogClient, SecretsManagerClient, SsmClient
 from .api import (validate as _validate, validate_task_def, build as _build,
                   docker_tag, run_command, create_or_update_task, get_latest_task_revision,
-                  create_or_update_service, git_is_clean, git_tag)
+                  create_or_update_service, git_is_clean, git_tag, get_container_log_config,
+                  get_log_stream_name, local_path, get_repository_region)
+from .build_cache import HASH_TAG_PREFIX
+from .deploy_state import DEFAULT_CHECKPOINT_FILE, DeployCheckpoint, DeployStateMachine, fingerprint
+from .poller import get_poller
+from .process import request_env
 
 AWS_KEY_HELP = 'AWS access key id. Default is derived from AWSACCESSKEYID environment variable.'
 AWS_SECRET_HELP = 'AWS secret access key. Default is derived from AWSSECRETACCESSKEY environment variable.'
 TAG_HELP = 'Tag for the image. This will skip the build step if an image with tag exists. Default is a datetime stamp.'
 TASK_TAG_HELP = "If included, this task will use this tag for the image. Otherwise the image won't be changed."
 REPOSITORY_HELP = 'The URI for the repository for the image. Default is derived from REPOSITORY environment variable'
+FORCE_BUILD_HELP = "Build the image even if an image was already built from the same context."
+WATCH_HELP = "Watch the deployment and roll back to the previous task definition if it fails."
+MAX_FAILED_TASKS_HELP = "With --watch, roll back after this many failed tasks or placement failures."
+WATCH_TIMEOUT_HELP = "With --watch, roll back if no new task of the deployment starts running for this many seconds."
+REGION_HELP = "The AWS region. Default is derived from the AWS_DEFAULT_REGION environment variable or your AWS config."
+DOCKER_API_HELP = ("Build, tag and push with the Docker Engine API over its Unix socket instead of the docker CLI. "
+                   "Falls back to the CLI if the socket can't be reached.")
+TASK_LATENCY_HELP = ("Write the launch latency of the started tasks to this file: a Prometheus textfile if it ends "
+                     "with .prom, JSON if it ends with .json, text otherwise. Use - for the terminal.")
+COMPRESSION_HELP = ("Push the image with its layers compressed with zstd or estargz (or gzip at --compression-level) "
+                    "by docker buildx, and show the size and push time of each layer.")
+PREPULL_HELP = ("Before updating the service, pull the new image on every container instance of the cluster at the "
+                "same time, so the new tasks start without waiting for the pull.")
+PREFLIGHT_HELP = ("Check that the cluster's container instances have the cpu, memory and ports for the new tasks, "
+                  "including the extra tasks started during the rollout, and stop if they don't.")
+SIZE_BUDGET_HELP = ("Show the size of each layer of the pushed image and how it changed since the deployed image, and "
+                    "stop if the image is bigger than this many MB.")
+MAX_LAYER_GROWTH_HELP = "Flag the layers that grew by more than this many MB since the deployed image."
+SECRET_PLACEHOLDERS_HELP = ("How to fill in the %SSM:...% and %SECRET:...% placeholders that are secret: 'reference' "
+                            "turns environment variables into secrets with the ARN, 'render' writes the values.")
+MERGE_REMOTE_HELP = ("Merge the task file into the latest registered revision of its family, as update-task does, "
+                     "so the containers get what is only in the remote task definition.")
+EXEC_HELP = ("Run the command in a running task of the service with ECS Exec and exit with its exit code, or in a "
+             "new task if the service doesn't have execute command enabled.")
 
 
 @click.group()
@@ -20,16 +51,69 @@ def cli():
     pass
 
 
+# Clients kept between commands by the server, so their connections and caches stay warm
+_clients = None
+_clients_lock = threading.Lock()
+
+
+def reuse_clients():
+    """
+    Give every command with the same keys, region and profile the same clients
+    """
+    global _clients
+    _clients = {}
+
+
+def _get_client(client_class, access_key_id, secret_access_key, region, profile):
+    env = request_env()
+    if env is not None:  # In the server, use the client's profile and region rather than the server's
+        profile = profile or env.get('AWS_PROFILE')
+        region = region or env.get('AWS_REGION') or env.get('AWS_DEFAULT_REGION')
+    if _clients is None:
+        return client_class(access_key_id, secret_access_key, region, profile)
+    key = (client_class.__name__, access_key_id, secret_access_key, region, profile)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = client_class(access_key_id, secret_access_key, region, profile)
+        return _clients[key]
+
+
 def get_ecs_client(access_key_id=None, secret_access_key=None, region=None, profile=None):
-    return EcsClient(access_key_id, secret_access_key, region, profile)
+    return _get_client(EcsClient, access_key_id, secret_access_key, region, profile)
 
 
 def get_ecr_client(access_key_id=None, secret_access_key=None, region=None, profile=None):
-    return EcrClient(access_key_id, secret_access_key, region, profile)
+    return _get_client(EcrClient, access_key_id, secret_access_key, region, profile)
 
 
 def get_log_client(access_key_id=None, secret_access_key=None, region=None, profile=None):
-    return CloudWatchLogClient(access_key_id, secret_access_key, region, profile)
+    return _get_client(CloudWatchLogClient, access_key_id, secret_access_key, region, profile)
+
+
+def get_cloudwatch_client(access_key_id=None, secret_access_key=None, region=None, profile=None):
+    return _get_client(CloudWatchClient, access_key_id, secret_access_key, region, profile)
+
+
+def get_ssm_client(access_key_id=None, secret_access_key=None, region=None, profile=None):
+    return _get_client(SsmClient, access_key_id, secret_access_key, region, profile)
+
+
+def get_secrets_manager_client(access_key_id=None, secret_access_key=None, region=None, profile=None):
+    return _get_client(SecretsManagerClient, access_key_id, secret_access_key, region, profile)
+
+
+def get_docker(docker_api):
+    """
+    Return a DockerEngine with --docker-api, or None to use the docker CLI
+    """
+    if not docker_api:
+        return None
+    from .docker_engine import get_docker_engine
+
+    docker = get_docker_engine()
+    if docker is None:
+        click.echo("The Docker Engine API can't be reached. Using the docker CLI.")
+    return docker
 
 
 @cli.command()
@@ -45,7 +129,8 @@ def check_git():
 @click.option('--task-file', type=click.File('r'), default="task-def.json")
 @click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
 @click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
-def setup(task_file, access_key_id, secret_access_key):
+@click.option('--region', required=False, help=REGION_HELP)
+def setup(task_file, access_key_id, secret_access_key, region):
     """
     Set up the Repository, load balancer and log group
     """
@@ -61,7 +146,7 @@ def setup(task_file, access_key_id, secret_access_key):
     project_name = local_task_file['family']
 
     repository_name = project_name
-    ecr_client = get_ecr_client(access_key_id, secret_access_key)
+    ecr_client = get_ecr_client(access_key_id, secret_access_key, region)
     repository = ecr_client.create_repository(repository_name)
     click.echo("")
     click.echo("Add this to your .env file")
@@ -71,7 +156,7 @@ def setup(task_file, access_key_id, secret_access_key):
     click.echo("")
 
     log_group_name = "{0}-logs".format(project_name)
-    log_client = get_log_client(access_key_id, secret_access_key)
+    log_client = get_log_client(access_key_id, secret_access_key, region)
     response = log_client.describe_log_groups(log_group_name)
     if response['ResponseMetadata']['HTTPStatusCode'] != 200:
         click.ClickException("Received an error getting log groups: {0}".format(response['ResponseMetadata']))
@@ -94,14 +179,14 @@ def setup(task_file, access_key_id, secret_access_key):
         click.echo('    "logDriver": "awslogs",')
         click.echo('    "options": {')
         click.echo('        "awslogs-group": "{0}",'.format(log_group_name))
-        click.echo('        "awslogs-region": "us-east-1"')
+        click.echo('        "awslogs-region": "{0}"'.format(log_client.boto.meta.region_name))
         click.echo('    }')
         click.echo('},')
         click.echo("")
         click.echo("")
 
     load_balancer_name = project_name
-    elb_client = boto3.client('elbv2')
+    elb_client = boto3.client('elbv2', region_name=region)
     try:
         response = elb_client.describe_load_balancers(Names=[load_balancer_name])
         if len(response['LoadBalancers']) > 1:
@@ -140,7 +225,10 @@ def validate(service_file, task_file):
 @click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
 @click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
 @click.option('--build-arg-str', required=False, default="", help="A string of build arguments to pass to docker.")
-def build(task_file, access_key_id, secret_access_key, build_arg_str):
+@click.option('--repository', envvar='REPOSITORY', help=REPOSITORY_HELP)
+@click.option('--force-build', is_flag=True, help=FORCE_BUILD_HELP)
+@click.option('--docker-api', is_flag=True, envvar='ECS_BOSS_DOCKER_API', help=DOCKER_API_HELP)
+def build(task_file, access_key_id, secret_access_key, build_arg_str, repository, force_build, docker_api):
     """
     Build the docker image.
     """
@@ -151,7 +239,8 @@ def build(task_file, access_key_id, secret_access_key, build_arg_str):
 
     validate_task_def(local_task_file)
     project_name = local_task_file['family']
-    _build(project_name, build_arg_str)
+    ecr_client = get_ecr_client(access_key_id, secret_access_key) if repository else None
+    _build(project_name, build_arg_str, not force_build, repository, ecr_client, get_docker(docker_api))
 
 
 @cli.command()
@@ -160,13 +249,14 @@ def build(task_file, access_key_id, secret_access_key, build_arg_str):
 @click.option('--image', required=True, help="The local Docker image to push to the remote repository")
 @click.option('--repository', envvar='REPOSITORY', help=REPOSITORY_HELP)
 @click.option('--tag', required=False, help=TAG_HELP)
-def push_docker_image(access_key_id, secret_access_key, image, repository, tag):
+@click.option('--docker-api', is_flag=True, envvar='ECS_BOSS_DOCKER_API', help=DOCKER_API_HELP)
+def push_docker_image(access_key_id, secret_access_key, image, repository, tag, docker_api):
     """
     Tag and push a docker image to a remote repository
     """
     ecr_client = get_ecr_client(access_key_id, secret_access_key)
     ecs_client = get_ecs_client(access_key_id, secret_access_key)
-    docker_tag(ecs_client, ecr_client, image, repository, tag)
+    docker_tag(ecs_client, ecr_client, image, repository, tag, get_docker(docker_api))
 
 
 @cli.command()
@@ -176,34 +266,49 @@ def push_docker_image(access_key_id, secret_access_key, image, repository, tag):
 @click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
 @click.option('--repository', required=False, help="Deprecated. Ignored")
 @click.option('--container-name', required=False, help="Name of the container to run the command. Defaults to the first container.")
+@click.option('--shards', type=int, default=1, help="Run the command in this many tasks.")
+@click.option('--commands-file', type=click.File('r'), required=False,
+              help="A file with one command per line. Each command is run in its own task.")
+@click.option('--max-running', type=int, default=10, help="The most tasks to run at the same time when using shards.")
+@click.option('--launch-rate', type=float, required=False,
+              help="The most run_task calls per second when using shards. Shards only share a call (up to 10 tasks) "
+                   "when they have the same command and no shard env, so the default is 1, or 5 when every call "
+                   "launches one task.")
+@click.option('--shard-env/--no-shard-env', default=True,
+              help="Pass SHARD_INDEX and SHARD_COUNT environment variables to each shard.")
+@click.option('--log-dir', type=click.Path(file_okay=False), required=False, help="Where to write each shard's log. Default is run-logs/<run id>.")
+@click.option('--task-latency', type=click.Path(dir_okay=False), required=False, help=TASK_LATENCY_HELP)
+@click.option('--exec', 'exec_command', is_flag=True, help=EXEC_HELP)
 @click.argument('command', nargs=-1)
-def run_task_command(service_file, task_file, access_key_id, secret_access_key, repository, container_name, command):
+def run_task_command(service_file, task_file, access_key_id, secret_access_key, repository, container_name,
+                     shards, commands_file, max_running, launch_rate, shard_env, log_dir, task_latency, exec_command,
+                     command):
     """
     Run a command using the latest task revision
     """
-    import time
-
+    if exec_command and (shards > 1 or commands_file):
+        raise click.ClickException("--exec runs one command, so it can't be used with --shards or --commands-file.")
     local_task_file, local_service_file = _validate(task_file, service_file)
     ecs_client = get_ecs_client(access_key_id, secret_access_key)
     log_client = get_log_client(access_key_id, secret_access_key)
 
     cluster = local_service_file['cluster']
     task = get_latest_task_revision(ecs_client, local_task_file.family)
-    log_config = None
-    log_stream = None
-    log_group = None
+    container_name, log_config = get_container_log_config(task, container_name)
 
-    if not container_name:
-        container_name = task['containerDefinitions'][0]['name']
-        log_config = task['containerDefinitions'][0]['logConfiguration']
-    else:
-        for cont in task['containerDefinitions']:
-            if cont['name'] == container_name:
-                log_config = cont['logConfiguration']
-                break
+    if shards > 1 or commands_file:
+        _run_task_fanout(ecs_client, log_client, cluster, task, container_name, log_config, command,
+                         shards, commands_file, max_running, launch_rate, shard_env, log_dir, task_latency)
+        return
 
     if len(command) == 1 and " " in command[0]:
         command = command[0].split(" ")
+    if exec_command:
+        from .ecs_exec import exec_command as run_with_exec
+
+        exit_code = run_with_exec(ecs_client, cluster, local_service_file['serviceName'], container_name, command)
+        if exit_code is not None:
+            click.get_current_context().exit(exit_code)
     overrides = {
         'containerOverrides': [{
             'name': container_name,
@@ -215,55 +320,349 @@ def run_task_command(service_file, task_file, access_key_id, secret_access_key,
     if result['failures']:
         click.ClickException("Error starting one-off task: {0}".format(result['failures']))
 
-    task_id = result['tasks'][0]['taskArn'].split("/")[1]
+    task_id = result['tasks'][0]['taskArn'].split("/")[-1]
 
-    if log_config and log_config["logDriver"] == "awslogs":
-        if "awslogs-stream-prefix" in log_config['options']:
-            log_group = log_config['options']['awslogs-group']
-            log_stream = "{0}/{1}/{2}".format(log_config['options']['awslogs-stream-prefix'], container_name, task_id)
-            click.echo("Will retrieve logs from {0}".format(log_stream))
+    log_group, log_stream = get_log_stream_name(log_config, container_name, task_id)
+    if log_stream is not None:
+        click.echo("Will retrieve logs from {0}".format(log_stream))
 
-    cur_status = ''
-    status = ''
     task_id = result['tasks'][0]['taskArn']
-    next_token = None
-    prev_next_token = None  # Apparently the next token can be reused if there is nothing more.
-
-    while status != 'STOPPED':
-        time.sleep(2)
-        status = ecs_client.get_task_statuses(cluster, [task_id])[0]
-        if status != cur_status:  # We only want to output the status when it changes
-            cur_status = status
+    poller = get_poller(ecs_client)
+    watched = {'status': '', 'logs': None}
+
+    def show_events(events):
+        click.echo("\n".join([event['message'] for event in events]))
+
+    def on_task(task_state):
+        status = task_state['lastStatus']
+        if status != watched['status']:  # We only want to output the status when it changes
+            watched['status'] = status
             click.echo("Task: {0} Command: {1} Status:{2}".format(task.family_revision, " ".join(command), status))
-        if status == 'RUNNING' and log_stream is not None:
-            kwargs = {
-                'logGroupName': log_group,
-                'logStreamName': log_stream,
-            }
-            if next_token is not None:
-                kwargs['nextToken'] = next_token
-            else:
-                kwargs['startFromHead'] = True
-
-            log_events = log_client.get_log_events(**kwargs)
-            next_token = log_events['nextForwardToken']
-            if next_token != prev_next_token:
-                prev_next_token = next_token
-                for event in log_events['events']:
-                    click.echo(event['message'])
-
-    while next_token:  # Get the rest of the logged events until there is no more tokens
-        log_events = log_client.get_log_events(**kwargs)
-        next_token = log_events['nextForwardToken']
-        if next_token != prev_next_token:
-            prev_next_token = next_token
-            for event in log_events['events']:
-                click.echo(event['message'])
+        if status == 'RUNNING' and log_stream is not None and watched['logs'] is None:
+            watched['logs'] = poller.follow_log_stream(log_client, log_group, log_stream, show_events)
+        if status == 'STOPPED' and watched['logs'] is not None:
+            watched['logs'].cancel()
+        return status == 'STOPPED'
+
+    poller.watch_task(cluster, task_id, on_task).wait()
+    if watched['logs'] is not None:
+        watched['logs'].drain()  # Get the rest of the logged events
+
+    if task_latency:
+        _write_task_latency(ecs_client.describe_tasks(cluster, [task_id])['tasks'], task_latency,
+                            cluster=cluster, task_definition=task.family_revision)
+    click.echo("Done.")
+
+
+@cli.command()
+@click.option('--task-file', type=click.File('r'), default="task-def.json")
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--repository', envvar='REPOSITORY', help=REPOSITORY_HELP)
+@click.option('--tag', required=False, help="Run this tag of the repository instead of the image made by build.")
+@click.option('--merge-remote', is_flag=True, help=MERGE_REMOTE_HELP)
+@click.option('--network', required=False, help="The docker network of the containers. Default is ecs-boss-<family>.")
+@click.option('--detach', is_flag=True, help="Leave the containers running instead of showing their output.")
+@click.option('--container-name', required=False, help="Name of the container to run the command. Defaults to the first container.")
+@click.argument('command', nargs=-1)
+def run_local(task_file, access_key_id, secret_access_key, repository, tag, merge_remote, network, detach,
+              container_name, command):
+    """
+    Run the task definition on this machine with docker
+    """
+    from .api import ecr_login_command, merge_remote_task_def, render_task_def
+    from .ecs import EcsTaskDefinition
+    from .local_run import LocalTask, has_secrets, resolve_secrets
+
+    if tag and not repository:
+        raise click.ClickException("Please set the REPOSITORY environment variable or pass the --repository flag.")
+    try:
+        task_def = EcsTaskDefinition(json.loads(task_file.read()))
+        validate_task_def(task_def)
+    except (ValueError, ) as e:
+        raise click.ClickException("Received an error reading the task file: {0}".format(e))
+    # Every value is needed in the containers' environment
+    _resolve_placeholders(access_key_id, secret_access_key, 'render', [task_def])
+    render_task_def(task_def, repository if tag else task_def.family, tag or 'latest')
+
+    if merge_remote:
+        merged = merge_remote_task_def(get_ecs_client(access_key_id, secret_access_key), task_def)
+        if merged is None:
+            click.echo("Remote task definition doesn't exist. Running the local definition.")
         else:
-            break
-        time.sleep(2)
+            click.echo("Merging remote task definition with local definition.")
+            task_def = merged
+    if command:
+        container_name, _ = get_container_log_config(task_def, container_name)
+        if len(command) == 1 and " " in command[0]:
+            command = command[0].split(" ")
+        for container in task_def['containerDefinitions']:
+            if container['name'] == container_name:
+                container['command'] = list(command)
+    if has_secrets(task_def):
+        resolve_secrets(task_def, get_ssm_client(access_key_id, secret_access_key),
+                        get_secrets_manager_client(access_key_id, secret_access_key))
+
+    local_task = LocalTask(task_def, network)
+    if tag and get_repository_region(repository):
+        run_command(ecr_login_command(repository), check=True)
+    local_task.start()
+    if detach:
+        click.echo("Remove the containers with: docker rm -f {0}".format(" ".join(local_task.docker_names)))
+        return
+    exit_code = local_task.follow()
+    if exit_code:
+        click.get_current_context().exit(exit_code)
+
+
+def _write_task_latency(tasks, path, **labels):
+    from collections import OrderedDict
+    from .latency import format_for_path, summarize, write_report
+
+    write_report(summarize(tasks), path, format_for_path(path), OrderedDict(sorted(labels.items())))
+
+
+def _get_layer_compression(compression, compression_level):
+    """
+    The LayerCompression for --compression and --compression-level, or None
+    to push the image as it was built
+    """
+    if compression is None:
+        if compression_level is not None:
+            raise click.ClickException("--compression-level needs --compression.")
+        return None
+    from .compression import MAX_LEVELS, LayerCompression
+
+    if compression_level is not None and not 0 <= compression_level <= MAX_LEVELS[compression]:
+        raise click.ClickException("The {0} compression level must be between 0 and {1}.".format(
+            compression, MAX_LEVELS[compression]))
+    return LayerCompression(compression, compression_level)
+
+
+def _check_capacity(ecs_client, local_service_file, task_def, desired_count=None):
+    """
+    Stop with the missing capacity if the service's tasks won't fit on the cluster
+    """
+    from .capacity import check_capacity
+
+    click.echo("Checking the capacity of {0}.".format(local_service_file['cluster']))
+    report = check_capacity(ecs_client, local_service_file, task_def, desired_count)
+    if not report.ok:
+        raise click.ClickException("\n".join(report.messages))
+    for message in report.messages:
+        click.echo(message)
 
-    click.echo("Done.")
+
+def _resolve_placeholders(access_key_id, secret_access_key, mode, task_defs=(), service_descs=(), region=None):
+    """
+    Fill in the Parameter Store and Secrets Manager placeholders of the task
+    definitions and service descriptions, in place
+    """
+    text = json.dumps([list(task_defs), list(service_descs)])
+    if '%SSM:' not in text and '%SECRET:' not in text:
+        return  # Without placeholders, nothing is fetched
+    from .placeholders import PlaceholderResolver
+
+    resolver = PlaceholderResolver(get_ssm_client(access_key_id, secret_access_key, region),
+                                   get_secrets_manager_client(access_key_id, secret_access_key, region), mode)
+    resolver.resolve(task_defs, service_descs)
+
+
+def _check_image_size(report, budget=None, max_layer_growth=None, output_format='text', top=None):
+    """
+    Show the image report and stop if the image is over the size budget
+    """
+    from .image_report import DEFAULT_MAX_LAYER_GROWTH, format_json, format_text
+
+    if max_layer_growth is None:
+        max_layer_growth = DEFAULT_MAX_LAYER_GROWTH
+    flagged = report.flag_growth(max_layer_growth * 1e6)
+    if output_format == 'json':
+        click.echo("\n".join(format_json(report)))
+    else:
+        click.echo("\n".join(format_text(report, top)))
+        if flagged:
+            click.echo("Layers that grew by more than {0:g} MB: {1}.".format(max_layer_growth, len(flagged)))
+    if budget is not None and report.total > budget * 1e6:
+        raise click.ClickException("{0} is {1:.1f} MB, over the budget of {2:g} MB.".format(
+            report.image, report.total / 1e6, budget))
+
+
+def _run_task_fanout(ecs_client, log_client, cluster, task, container_name, log_config, command,
+                     shards, commands_file, max_running, launch_rate, shard_env, log_dir, task_latency=None):
+    """
+    Run the command, or each command in commands_file, across many tasks
+    """
+    import datetime
+    from .fanout import FanOut, Shard, read_commands_file, summarize
+
+    if commands_file:
+        commands = read_commands_file(commands_file)
+    else:
+        if len(command) == 1 and " " in command[0]:
+            command = command[0].split(" ")
+        commands = [list(command)] * shards
+    if not commands:
+        raise click.ClickException("There are no commands to run.")
+
+    run_id = datetime.datetime.utcnow().strftime("ecs-boss-%Y%m%d-%H%M%S")
+    log_dir = log_dir or local_path(os.path.join("run-logs", run_id))
+    click.echo("Running {0} shards of task '{1}' as run {2}.".format(len(commands), task.family_revision, run_id))
+    if log_config:
+        click.echo("Writing shard logs to {0}".format(log_dir))
+
+    fanout = FanOut(
+        ecs_client, log_client, cluster, task, container_name,
+        [Shard(index, cmd) for index, cmd in enumerate(commands)],
+        max_running=max_running,
+        launch_rate=launch_rate,
+        shard_env=shard_env,
+        log_config=log_config,
+        log_dir=log_dir,
+        started_by=run_id)
+    failed = summarize(fanout.run())
+    if task_latency:
+        from .latency import collect_tasks
+
+        _write_task_latency(collect_tasks(ecs_client, cluster, started_by=run_id), task_latency,
+                            cluster=cluster, run=run_id)
+    if failed:
+        raise click.ClickException("{0} shards failed.".format(len(failed)))
+
+
+@cli.command()
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--cluster', multiple=True, help="The cluster to list. May be repeated. Default is every cluster.")
+@click.option('--format', 'output_format', type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option('--output', type=click.File('w'), default='-', help="Where to write the inventory. Default is stdout.")
+@click.option('--concurrency', type=int, default=8, help="How many describe calls to make at the same time.")
+def inventory(access_key_id, secret_access_key, cluster, output_format, output, concurrency):
+    """
+    List every service with its task revision, image, counts and reservations.
+    """
+    from .inventory import iter_inventory, write_csv, write_ndjson
+
+    ecs_client = get_ecs_client(access_key_id, secret_access_key)
+    clusters = cluster or ecs_client.list_cluster_arns()
+    rows = iter_inventory(ecs_client, clusters, concurrency)
+    if output_format == 'csv':
+        write_csv(rows, output)
+    else:
+        write_ndjson(rows, output)
+
+
+@cli.command()
+@click.option('--pair', 'pairs', multiple=True, metavar='SERVICE_FILE:TASK_FILE',
+              help="A service file and its task definition file. May be repeated. "
+                   "Default is service.json:task-def.json.")
+@click.option('--tag', required=False, help="Compare images using this release tag. Otherwise images are ignored.")
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--repository', envvar='REPOSITORY', help=REPOSITORY_HELP)
+@click.option('--format', 'output_format', type=click.Choice(['text', 'json']), default='text')
+@click.option('--concurrency', type=int, default=8, help="How many describe calls to make at the same time.")
+@click.pass_context
+def drift(ctx, pairs, tag, access_key_id, secret_access_key, repository, output_format, concurrency):
+    """
+    Show where services differ from their local files. Exits with 1 if any do.
+    """
+    from .drift import check_drift, format_report
+
+    local_pairs = []
+    for pair in pairs or ['service.json:task-def.json']:
+        service_path, _, task_path = pair.partition(':')
+        if not task_path:
+            raise click.BadParameter("'{0}' should be SERVICE_FILE:TASK_FILE".format(pair), param_hint='--pair')
+        with open(local_path(service_path)) as service_file, open(local_path(task_path)) as task_file:
+            local_task_file, local_service_file = _validate(task_file, service_file)
+        local_pairs.append((local_service_file, local_task_file))
+    # Filled in as update-task does by default, so secrets compare as the references ECS has
+    _resolve_placeholders(access_key_id, secret_access_key, 'reference', [t for _, t in local_pairs],
+                          [s for s, _ in local_pairs])
+
+    ecs_client = get_ecs_client(access_key_id, secret_access_key)
+    reports = check_drift(ecs_client, local_pairs, repository, tag, concurrency)
+    if output_format == 'json':
+        click.echo(json.dumps([r.as_dict() for r in reports], indent=2, default=str))
+    else:
+        for report in reports:
+            click.echo("\n".join(format_report(report)))
+
+    drifted = [r for r in reports if r.drifted]
+    if drifted:
+        if output_format == 'text':
+            click.echo("{0} of {1} services have drifted.".format(len(drifted), len(reports)))
+        ctx.exit(1)
+
+
+@cli.group()
+def logs():
+    """
+    Work with the CloudWatch logs of tasks
+    """
+    pass
+
+
+@logs.command('export')
+@click.option('--service-file', type=click.File('r'), default="service.json")
+@click.option('--task-file', type=click.File('r'), default="task-def.json")
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--task-id', multiple=True, help="Export the logs of this task. May be repeated.")
+@click.option('--run', 'run_id', required=False, help="Export the logs of every task started by this run.")
+@click.option('--container-name', required=False, help="Only export the logs of this container.")
+@click.option('--log-group', required=False, help="The log group to export. Defaults to the task definition's group.")
+@click.option('--stream-prefix', required=False, help="Only export streams with this prefix from the log group.")
+@click.option('--start', required=False, help="Start of the time range, as YYYY-MM-DD[THH:MM[:SS]] UTC or e.g. 2h ago.")
+@click.option('--end', required=False, help="End of the time range, as YYYY-MM-DD[THH:MM[:SS]] UTC or e.g. 30m ago.")
+@click.option('--output-dir', type=click.Path(file_okay=False), default="log-export", help="Where to write the exported files.")
+@click.option('--compression', type=click.Choice(['gzip', 'zstd', 'none']), default='gzip')
+@click.option('--state-file', type=click.Path(dir_okay=False), required=False, help="Where to save progress. Default is <output-dir>/export-state.json.")
+@click.option('--restart', is_flag=True, help="Ignore saved progress and export everything again.")
+@click.option('--concurrency', type=int, default=4, help="How many streams to download at the same time.")
+def logs_export(service_file, task_file, access_key_id, secret_access_key, task_id, run_id, container_name,
+                log_group, stream_prefix, start, end, output_dir, compression, state_file, restart, concurrency):
+    """
+    Export logs for tasks, a run or a time range to compressed NDJSON files.
+
+    An interrupted export continues from where it stopped when run again.
+    """
+    from .logs import ExportJob, LogExporter, get_task_jobs, parse_time
+
+    local_task_file, local_service_file = _validate(task_file, service_file)
+    cluster = local_service_file['cluster']
+    start_time, end_time = parse_time(start), parse_time(end)
+    ecs_client = get_ecs_client(access_key_id, secret_access_key)
+    log_client = get_log_client(access_key_id, secret_access_key)
+
+    task_arns = list(task_id)
+    if run_id:
+        for desired_status in ('RUNNING', 'STOPPED'):
+            task_arns.extend(ecs_client.list_task_arns(cluster, started_by=run_id, desired_status=desired_status))
+        if not task_arns:
+            raise click.ClickException("There are no tasks for the run '{0}'.".format(run_id))
+
+    if task_arns:
+        jobs = get_task_jobs(ecs_client, cluster, task_arns, container_name, start_time, end_time)
+    elif start_time is not None:
+        if not log_group:
+            task = get_latest_task_revision(ecs_client, local_task_file.family)
+            name, log_config = get_container_log_config(task, container_name)
+            if not log_config or log_config['logDriver'] != 'awslogs':
+                raise click.ClickException("Container {0} doesn't log to CloudWatch. Pass --log-group.".format(name))
+            log_group = log_config['options']['awslogs-group']
+        jobs = [ExportJob(log_group, start_time=start_time, end_time=end_time, stream_prefix=stream_prefix)]
+    else:
+        raise click.ClickException("Pass --task-id, --run or --start to choose the logs to export.")
+
+    if not jobs:
+        raise click.ClickException("There are no logs to export.")
+    exporter = LogExporter(log_client, output_dir, compression, state_file, restart, concurrency)
+    errors = exporter.export(jobs)
+    if errors:
+        raise click.ClickException("{0} of {1} exports failed. Run the command again to resume.".format(
+            len(errors), len(jobs)))
 
 
 @cli.command()
@@ -273,7 +672,9 @@ def run_task_command(service_file, task_file, access_key_id, secret_access_key,
 @click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
 @click.option('--repository', envvar='REPOSITORY', help=REPOSITORY_HELP)
 @click.option('--quiet', is_flag=True, help="Only return the resulting task family and revision")
-def update_task(task_file, tag, access_key_id, secret_access_key, repository, quiet):
+@click.option('--secret-placeholders', type=click.Choice(['reference', 'render']), default='reference',
+              help=SECRET_PLACEHOLDERS_HELP)
+def update_task(task_file, tag, access_key_id, secret_access_key, repository, quiet, secret_placeholders):
     """
     Update the remote task definition with the docker repo tag and any other
     modifications made to the local task definition
@@ -292,6 +693,7 @@ def update_task(task_file, tag, access_key_id, secret_access_key, repository, qu
         validate_task_def(local_task_file)
     except (ValueError, ) as e:
         raise click.ClickException("Received an error reading the task file: {0}".format(e))
+    _resolve_placeholders(access_key_id, secret_access_key, secret_placeholders, [local_task_file])
 
     ecs_client = get_ecs_client(access_key_id, secret_access_key)
     ecr_client = get_ecr_client(access_key_id, secret_access_key)
@@ -312,12 +714,12 @@ def update_task(task_file, tag, access_key_id, secret_access_key, repository, qu
 @click.option('--service-file', type=click.File('r'), default="service.json")
 @click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
 @click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--preflight', is_flag=True, help=PREFLIGHT_HELP)
 @click.argument('count', nargs=1)
-def scale_service(service_file, access_key_id, secret_access_key, count):
+def scale_service(service_file, access_key_id, secret_access_key, preflight, count):
     """
     Set the desired count of a service.
     """
-    import time
     from api import validate_service_desc
 
     ecs_client = get_ecs_client(access_key_id, secret_access_key)
@@ -333,6 +735,8 @@ def scale_service(service_file, access_key_id, secret_access_key, count):
     task_def = ecs_client.describe_task_definition(family)
     if task_def is None:
         raise click.ClickException("Received an error reading the task: {0}".format(family))
+    if preflight:
+        _check_capacity(ecs_client, local_service_file, task_def, int(count))
 
     click.echo("Scaling service {0} to {1}.".format(local_service_file['serviceName'], count))
     ecs_client.update_service(
@@ -341,14 +745,13 @@ def scale_service(service_file, access_key_id, secret_access_key, count):
         int(count),
         task_def.family_revision)
 
-    # poll service every 10 seconds until count is reached or timeout is reached
-    elapsed_time = 0
-    while elapsed_time < 300:
-        response = ecs_client.describe_services(local_service_file['cluster'], local_service_file['serviceName'])
-        if response['services'][0]['runningCount'] == int(count):
-            return
-        time.sleep(10)
-        elapsed_time += 10
+    # Wait until the count is reached or the timeout is reached
+    subscription = get_poller(ecs_client).watch_service(
+        local_service_file['cluster'], local_service_file['serviceName'],
+        lambda service: service['runningCount'] == int(count), timeout=300)
+    subscription.wait()
+    if not subscription.timed_out:
+        return
     raise click.ClickException("The service {0} did not scale to {1} within the time allowed.".format(local_service_file['serviceName'], count))
 
 
@@ -357,7 +760,13 @@ def scale_service(service_file, access_key_id, secret_access_key, count):
 @click.option('--revision', required=False, help="The revision to use. Leave blank to use the latest revision.")
 @click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
 @click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
-def update_service(service_file, revision, access_key_id, secret_access_key):
+@click.option('--watch', is_flag=True, help=WATCH_HELP)
+@click.option('--max-failed-tasks', type=int, default=3, help=MAX_FAILED_TASKS_HELP)
+@click.option('--watch-timeout', type=int, default=300, help=WATCH_TIMEOUT_HELP)
+@click.option('--secret-placeholders', type=click.Choice(['reference', 'render']), default='reference',
+              help=SECRET_PLACEHOLDERS_HELP)
+def update_service(service_file, revision, access_key_id, secret_access_key, watch, max_failed_tasks, watch_timeout,
+                   secret_placeholders):
     """
     Update a service to a task revision.
     """
@@ -370,6 +779,7 @@ def update_service(service_file, revision, access_key_id, secret_access_key):
         validate_service_desc(local_service_file)
     except (ValueError, ) as e:
         raise click.ClickException("Received an error reading the task file: {0}".format(e))
+    _resolve_placeholders(access_key_id, secret_access_key, secret_placeholders, service_descs=[local_service_file])
 
     family = local_service_file['taskDefinition'].split(":")[0]
     if revision is None:
@@ -382,7 +792,11 @@ def update_service(service_file, revision, access_key_id, secret_access_key):
         task_revision = "{0}:{1}".format(family, revision)
 
     click.echo("Updating service {0} to use task {1}.".format(local_service_file['serviceName'], task_revision))
-    create_or_update_service(ecs_client, local_service_file, task_revision=task_revision)
+    service = create_or_update_service(ecs_client, local_service_file, task_revision=task_revision)
+    if watch and service:
+        from .watchdog import watch_rollout
+
+        watch_rollout(ecs_client, service, max_failed_tasks, watch_timeout)
 
 
 @cli.command()
@@ -392,7 +806,13 @@ def update_service(service_file, revision, access_key_id, secret_access_key):
 @click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
 @click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
 @click.option('--repository', envvar='REPOSITORY', help=REPOSITORY_HELP)
-def update_task_and_service(service_file, task_file, tag, access_key_id, secret_access_key, repository):
+@click.option('--watch', is_flag=True, help=WATCH_HELP)
+@click.option('--max-failed-tasks', type=int, default=3, help=MAX_FAILED_TASKS_HELP)
+@click.option('--watch-timeout', type=int, default=300, help=WATCH_TIMEOUT_HELP)
+@click.option('--secret-placeholders', type=click.Choice(['reference', 'render']), default='reference',
+              help=SECRET_PLACEHOLDERS_HELP)
+def update_task_and_service(service_file, task_file, tag, access_key_id, secret_access_key, repository,
+                            watch, max_failed_tasks, watch_timeout, secret_placeholders):
     """
     Update the remote task and service definition with the docker repo tag and any other
     modifications made to the local task definition
@@ -404,6 +824,8 @@ def update_task_and_service(service_file, task_file, tag, access_key_id, secret_
         raise click.ClickException("Please set the REPOSITORY environment variable or pass the --respository flag.")
 
     local_task_file, local_service_file = _validate(task_file, service_file)
+    _resolve_placeholders(access_key_id, secret_access_key, secret_placeholders, [local_task_file],
+                          [local_service_file])
 
     ecs_client = get_ecs_client(access_key_id, secret_access_key)
     ecr_client = get_ecr_client(access_key_id, secret_access_key)
@@ -416,7 +838,11 @@ def update_task_and_service(service_file, task_file, tag, access_key_id, secret_
     task_definition = create_or_update_task(ecs_client, local_task_file, repository, tag)
 
     # Update the service def with the new task def
-    create_or_update_service(ecs_client, local_service_file, task_definition)
+    service = create_or_update_service(ecs_client, local_service_file, task_definition)
+    if watch and service:
+        from .watchdog import watch_rollout
+
+        watch_rollout(ecs_client, service, max_failed_tasks, watch_timeout)
     click.echo("Finished.")
 
 
@@ -425,42 +851,470 @@ def update_task_and_service(service_file, task_file, tag, access_key_id, secret_
 @click.option('--task-file', type=click.File('r'), default="task-def.json")
 @click.option('--tag', required=False, help=TAG_HELP)
 @click.option('--build-arg-str', required=False, default="", help="A string of build arguments to pass to docker.")
+@click.option('--force-build', is_flag=True, help=FORCE_BUILD_HELP)
 @click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
 @click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
 @click.option('--repository', envvar='REPOSITORY', help=REPOSITORY_HELP)
-def deploy(service_file, task_file, tag, build_arg_str, access_key_id, secret_access_key, repository):
+@click.option('--watch', is_flag=True, help=WATCH_HELP)
+@click.option('--max-failed-tasks', type=int, default=3, help=MAX_FAILED_TASKS_HELP)
+@click.option('--watch-timeout', type=int, default=300, help=WATCH_TIMEOUT_HELP)
+@click.option('--checkpoint-file', type=click.Path(dir_okay=False), default=DEFAULT_CHECKPOINT_FILE,
+              help="Where to save the progress of the deploy.")
+@click.option('--resume', is_flag=True, help="Continue the last deploy from its first unfinished step.")
+@click.option('--region', 'regions', multiple=True,
+              help="Deploy to this region, using the repository with the same name in the region. May be repeated.")
+@click.option('--ecr-replication', is_flag=True,
+              help="With --region, push the image once and wait for ECR replication to copy it to the other regions.")
+@click.option('--fail-fast', is_flag=True,
+              help="With --region, deploy to the first region before the others and stop if it fails.")
+@click.option('--task-latency', type=click.Path(dir_okay=False), required=False, help=TASK_LATENCY_HELP)
+@click.option('--docker-api', is_flag=True, envvar='ECS_BOSS_DOCKER_API', help=DOCKER_API_HELP)
+@click.option('--preflight', is_flag=True, help=PREFLIGHT_HELP)
+@click.option('--prepull', is_flag=True, help=PREPULL_HELP)
+@click.option('--compression', type=click.Choice(['gzip', 'zstd', 'estargz']), required=False, help=COMPRESSION_HELP)
+@click.option('--compression-level', type=int, required=False,
+              help="With --compression, the compression level: 0-9 for gzip and estargz, 0-22 for zstd.")
+@click.option('--size-budget', type=float, required=False, help=SIZE_BUDGET_HELP)
+@click.option('--max-layer-growth', type=float, required=False, help=MAX_LAYER_GROWTH_HELP)
+@click.option('--secret-placeholders', type=click.Choice(['reference', 'render']), default='reference',
+              help=SECRET_PLACEHOLDERS_HELP)
+def deploy(service_file, task_file, tag, build_arg_str, force_build, access_key_id, secret_access_key, repository,
+           watch, max_failed_tasks, watch_timeout, checkpoint_file, resume, regions, ecr_replication, fail_fast,
+           task_latency, docker_api, preflight, prepull, compression, compression_level, size_budget, max_layer_growth,
+           secret_placeholders):
     """
     Build, tag, upload, update task, update service
     """
     import datetime
 
-    if not git_is_clean():
-        raise click.ClickException("Please commit or stash your uncommitted changes.")
-
     if not repository:
         raise click.ClickException("Please set the REPOSITORY environment variable or pass the --respository flag.")
+    if task_latency and regions:
+        raise click.ClickException("--task-latency can't be used with --region.")
+    if (size_budget is not None or max_layer_growth is not None) and regions:
+        raise click.ClickException("--size-budget and --max-layer-growth can't be used with --region.")
+    layer_compression = _get_layer_compression(compression, compression_level)
     local_task_file, local_service_file = _validate(task_file, service_file)
     project_name = local_task_file['family']
-    default_tag = datetime.datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S")
-    tag = tag or default_tag
+    local_files = fingerprint(local_task_file, local_service_file)
+
+    if resume:
+        checkpoint = DeployCheckpoint.load(checkpoint_file)
+        if checkpoint.inputs['local_files'] != local_files:
+            raise click.ClickException("The task or service file changed since the deploy started. "
+                                       "Run deploy without --resume.")
+        if tag and tag != checkpoint.inputs['tag']:
+            raise click.ClickException("The deploy being resumed uses the tag '{0}'.".format(checkpoint.inputs['tag']))
+        if regions and list(regions) != checkpoint.inputs.get('regions', []):
+            raise click.ClickException("The deploy being resumed is for the regions: {0}.".format(
+                ", ".join(checkpoint.inputs.get('regions', [])) or "the default region"))
+        tag = checkpoint.inputs['tag']
+        regions = checkpoint.inputs.get('regions', [])
+        click.echo("Resuming deploy of {0}.".format(tag))
+    else:
+        default_tag = datetime.datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S")
+        tag = tag or default_tag
+        checkpoint = DeployCheckpoint(checkpoint_file, {
+            'tag': tag,
+            'repository': repository,
+            'local_files': local_files,
+            'regions': list(regions),
+        })
+        checkpoint.save()
+
+    if not regions:  # Parameters and secrets are regional, so each region fills in its own copy
+        _resolve_placeholders(access_key_id, secret_access_key, secret_placeholders, [local_task_file],
+                              [local_service_file])
+    ecr_client = get_ecr_client(access_key_id, secret_access_key, get_repository_region(repository))
+    ecs_client = get_ecs_client(access_key_id, secret_access_key)
+    docker = get_docker(docker_api)
+    state_machine = DeployStateMachine(checkpoint)
+
+    def tag_git(results):
+        if not git_is_clean():
+            raise click.ClickException("Please commit or stash your uncommitted changes.")
+        current_branch = run_command("git rev-parse --abbrev-ref HEAD", check=True).output.strip()
+        git_tag(tag)
+        return {'branch': current_branch}
+
+    def build_image(results):
+        try:
+            context_hash = _build(project_name, build_arg_str, not force_build, repository, ecr_client, docker)
+        finally:
+            run_command("git checkout {0}".format(results['branch']))  # Since we may have detached HEAD from git_tag
+        return {'context_hash': context_hash}
+
+    def push_image(results):
+        digest = docker_tag(ecs_client, ecr_client, project_name, repository, tag, docker, layer_compression)
+        if results.get('context_hash'):
+            # Lets later builds of the same context reuse this image
+            docker_tag(ecs_client, ecr_client, project_name, repository, HASH_TAG_PREFIX + results['context_hash'],
+                       docker, layer_compression)
+        return {'image_digest': digest or ecr_client.get_image_digest(repository, tag)}
+
+    def check_image_size(results):
+        from .image_report import build_report
+
+        # Before register-task, the service still runs the previous image
+        report = build_report(ecs_client, ecr_client, local_service_file, repository, tag)
+        if report is None:
+            raise click.ClickException("{0}:{1} isn't in the repository.".format(repository, tag))
+        _check_image_size(report, size_budget, max_layer_growth)
+        return {'image_size': report.total}
+
+    def register_task(results):
+        task_definition = create_or_update_task(ecs_client, local_task_file, repository, tag)
+        return {'task_definition': task_definition.family_revision}
+
+    def check_capacity(results):
+        _check_capacity(ecs_client, local_service_file, ecs_client.describe_task_definition(results['task_definition']))
+        return {}
+
+    def prepull_image(results):
+        from .prepull import prepull_images
+
+        prepull_images(ecs_client, local_service_file['cluster'],
+                       ecs_client.describe_task_definition(results['task_definition']))
+        return {}
+
+    def update_service(results):
+        service = create_or_update_service(ecs_client, local_service_file, task_revision=results['task_definition'])
+        if not service:
+            return {'deployment_id': None}
+        primary = [d for d in service['deployments'] if d['status'] == 'PRIMARY']
+        return {'deployment_id': primary[0]['id'] if primary else None}
+
+    def watch_service(results):
+        from .watchdog import watch_rollout
+
+        if not results['deployment_id']:
+            return {}
+        response = ecs_client.describe_services(local_service_file['cluster'], local_service_file['serviceName'])
+        try:
+            watch_rollout(ecs_client, response['services'][0], max_failed_tasks, watch_timeout)
+        except click.ClickException as e:
+            # Don't resume into a deployment that was rolled back
+            checkpoint.complete('watch', {'watch_result': e.message})
+            raise
+        return {'watch_result': 'stable'}
+
+    def push_to_regions(results):
+        from .multi_region import push_images
+
+        digests = push_images(project_name, repository, tag, regions,
+                              lambda region: get_ecr_client(access_key_id, secret_access_key, region), ecr_replication,
+                              docker, layer_compression)
+        if results.get('context_hash'):
+            docker_tag(ecs_client, ecr_client, project_name, repository, HASH_TAG_PREFIX + results['context_hash'],
+                       docker, layer_compression)
+        return {'image_digests': digests}
+
+    def deploy_to_regions(results):
+        from copy import deepcopy
+        from .ecs import EcsTaskDefinition
+        from .multi_region import ROLLED_BACK, SUCCEEDED, deploy_region, deploy_regions, format_results
+
+        def deploy_to(region):
+            step = 'deploy:{0}'.format(region)
+            if checkpoint.is_done(step):
+                click.echo("Skipping {0}: already done.".format(region))
+                return checkpoint.steps[step][step]
+            task_def, service_desc = EcsTaskDefinition(deepcopy(local_task_file)), deepcopy(local_service_file)
+            _resolve_placeholders(access_key_id, secret_access_key, secret_placeholders, [task_def], [service_desc],
+                                  region)
+            result = deploy_region(region, get_ecs_client(access_key_id, secret_access_key, region),
+                                   task_def, service_desc, repository, tag,
+                                   watch, max_failed_tasks, watch_timeout, preflight=preflight, prepull=prepull)
+            if result['status'] in SUCCEEDED + (ROLLED_BACK, ):
+                checkpoint.complete(step, {step: result})
+            return result
+
+        region_results = deploy_regions(regions, deploy_to, fail_fast)
+        click.echo("\n".join(format_results(region_results)))
+        failed = [region for region, result in region_results.items() if result['status'] not in SUCCEEDED]
+        if failed:
+            raise click.ClickException("The deploy didn't succeed in {0}.".format(", ".join(failed)))
+        return {}
+
+    state_machine.add_step('git-tag', tag_git)
+    state_machine.add_step('build', build_image)
+    if regions:
+        state_machine.add_step('push', push_to_regions)
+        state_machine.add_step('deploy-regions', deploy_to_regions)
+    else:
+        state_machine.add_step('push', push_image)
+        if size_budget is not None or max_layer_growth is not None:
+            state_machine.add_step('image-report', check_image_size)
+        state_machine.add_step('register-task', register_task)
+        if preflight:
+            state_machine.add_step('preflight', check_capacity)
+        if prepull:
+            state_machine.add_step('prepull', prepull_image)
+        state_machine.add_step('update-service', update_service)
+        if watch:
+            state_machine.add_step('watch', watch_service)
+    if not state_machine.pending_steps:
+        click.echo("The deploy of {0} already finished. Nothing to resume.".format(tag))
+        return
+    results = state_machine.run()
+    if task_latency and results.get('deployment_id'):
+        from .latency import wait_for_tasks
+
+        # Without --watch, the new tasks may still be starting
+        tasks = wait_for_tasks(ecs_client, local_service_file['cluster'], results['deployment_id'],
+                               local_service_file.get('desiredCount', 1), watch_timeout)
+        _write_task_latency(tasks, task_latency, cluster=local_service_file['cluster'],
+                            service=local_service_file['serviceName'])
+    click.echo("Finished.")
 
-    # Tag the git repo
-    current_branch = run_command("git rev-parse --abbrev-ref HEAD")
-    git_tag(tag)
-    _build(project_name, build_arg_str)
-    run_command("git checkout {0}".format(current_branch))  # Since we may have detached HEAD from git_tag
 
-    # tag the docker repo
-    ecr_client = get_ecr_client(access_key_id, secret_access_key)
+@cli.command()
+@click.option('--service-file', type=click.File('r'), default="service.json")
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--events', type=int, default=5, help="How many of the latest service events to show.")
+def status(service_file, access_key_id, secret_access_key, events):
+    """
+    Show the deployments, task counts and latest events of a service.
+    """
+    from api import validate_service_desc
+
+    try:
+        local_service_file = json.loads(service_file.read())
+        validate_service_desc(local_service_file)
+    except (ValueError, ) as e:
+        raise click.ClickException("Received an error reading the service file: {0}".format(e))
+
     ecs_client = get_ecs_client(access_key_id, secret_access_key)
-    docker_tag(ecs_client, ecr_client, project_name, repository, tag)
+    response = ecs_client.describe_services(local_service_file['cluster'], local_service_file['serviceName'])
+    if not response['services']:
+        raise click.ClickException("The service {0} doesn't exist in {1}.".format(
+            local_service_file['serviceName'], local_service_file['cluster']))
+
+    service = response['services'][0]
+    click.echo("{0} ({1}): {2}, running {3} of {4}, {5} pending".format(
+        service['serviceName'], service['taskDefinition'].split('/')[-1], service['status'],
+        service['runningCount'], service['desiredCount'], service['pendingCount']))
+    for deployment in service['deployments']:
+        click.echo("  {0} {1}: running {2} of {3}, {4} pending, {5}".format(
+            deployment['status'], deployment['taskDefinition'].split('/')[-1], deployment['runningCount'],
+            deployment['desiredCount'], deployment['pendingCount'], deployment.get('rolloutState', 'no rollout state')))
+    for event in service.get('events', [])[:events]:
+        click.echo("  {0} {1}".format(event['createdAt'], event['message']))
 
-    # Update the task def with the new tagged image
-    task_definition = create_or_update_task(ecs_client, local_task_file, repository, tag)
 
-    # Update the service def with the new task def
-    create_or_update_service(ecs_client, local_service_file, task_definition)
-    click.echo("Finished.")
+@cli.command()
+@click.option('--service-file', type=click.File('r'), default="service.json")
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--deployment', required=False,
+              help="Only measure the tasks of this deployment id, or 'primary' for the current deployment. "
+                   "Default is every task of the service.")
+@click.option('--run', 'run_id', required=False, help="Measure the tasks started by this run-task-command run instead.")
+@click.option('--format', 'output_format', type=click.Choice(['text', 'json', 'prometheus']), default='text')
+@click.option('--output', type=click.Path(dir_okay=False), default='-', help="Where to write the report. Default is stdout.")
+def task_latency(service_file, access_key_id, secret_access_key, deployment, run_id, output_format, output):
+    """
+    Show how long a service's tasks took to be placed, pull their images and start.
+
+    Prints the 50th, 90th and 99th percentile of each phase of the launch of
+    the running and recently stopped tasks.
+    """
+    from collections import OrderedDict
+    from api import validate_service_desc
+    from .latency import collect_tasks, get_primary_deployment_id, summarize, write_report
+
+    try:
+        local_service_file = json.loads(service_file.read())
+        validate_service_desc(local_service_file)
+    except (ValueError, ) as e:
+        raise click.ClickException("Received an error reading the service file: {0}".format(e))
+
+    ecs_client = get_ecs_client(access_key_id, secret_access_key)
+    cluster = local_service_file['cluster']
+    service_name = local_service_file['serviceName']
+    labels = OrderedDict([('cluster', cluster), ('service', service_name)])
+    if run_id:
+        labels = OrderedDict([('cluster', cluster), ('run', run_id)])
+        tasks = collect_tasks(ecs_client, cluster, started_by=run_id)
+    elif deployment:
+        if deployment == 'primary':
+            deployment = get_primary_deployment_id(ecs_client, cluster, service_name)
+        labels['deployment'] = deployment
+        tasks = collect_tasks(ecs_client, cluster, started_by=deployment)
+    else:
+        tasks = collect_tasks(ecs_client, cluster, service_name)
+    write_report(summarize(tasks), output, output_format, labels)
+
+
+@cli.command()
+@click.option('--service-file', type=click.Path(dir_okay=False), default="service.json")
+@click.option('--cluster', required=False, help="Scan every stopped task of this cluster instead of the service's.")
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--top', type=int, default=20, help="How many groups of tasks to show.")
+@click.option('--format', 'output_format', type=click.Choice(['text', 'json']), default='text')
+@click.option('--concurrency', type=int, default=8, help="How many describe calls to make at the same time.")
+def stopped_tasks(service_file, cluster, access_key_id, secret_access_key, top, output_format, concurrency):
+    """
+    Show why the tasks of a service or cluster stopped.
+
+    The recently stopped tasks are grouped by stop code, stopped reason,
+    container exit codes and task definition revision, largest group first.
+    """
+    from api import validate_service_desc
+    from .stopped_tasks import format_json, format_text, scan_stopped_tasks
+
+    service_name = None
+    if not cluster:
+        try:
+            with open(service_file) as f:
+                local_service_file = json.load(f)
+            validate_service_desc(local_service_file)
+        except (IOError, ValueError) as e:
+            raise click.ClickException("Received an error reading the service file: {0}".format(e))
+        cluster = local_service_file['cluster']
+        service_name = local_service_file['serviceName']
+
+    ecs_client = get_ecs_client(access_key_id, secret_access_key)
+    groups = scan_stopped_tasks(ecs_client, cluster, service_name, concurrency)
+    format_groups = format_json if output_format == 'json' else format_text
+    click.echo("\n".join(format_groups(groups, top)))
+
+
+@cli.command()
+@click.option('--task-file', type=click.Path(dir_okay=False), default="task-def.json")
+@click.option('--service-file', 'service_files', type=click.Path(dir_okay=False), multiple=True,
+              help="A service running the task definition. May be repeated. Default is service.json.")
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--days', type=int, default=14, help="How many days of metrics to use.")
+@click.option('--period', type=int, default=300, help="The period of the metrics in seconds.")
+@click.option('--percentile', 'percent', type=click.FloatRange(1, 100), default=99,
+              help="The percentile of the average usage to reserve for.")
+@click.option('--headroom', type=float, default=1.2, help="Multiply the usage by this much.")
+@click.option('--format', 'output_format', type=click.Choice(['text', 'json']), default='text',
+              help="Show the changes, or print them as a patch for the task file.")
+@click.option('--write', is_flag=True, help="Save the proposed values in the task file.")
+def rightsize(task_file, service_files, access_key_id, secret_access_key, days, period, percent, headroom,
+              output_format, write):
+    """
+    Propose cpu and memory reservations from CloudWatch utilization.
+
+    Reads the CPU and memory utilization of the services running the task
+    definition and proposes cpu, memory and memoryReservation values for
+    each container.
+    """
+    import datetime
+    from collections import OrderedDict
+    from api import validate_service_desc
+    from .rightsize import MIN_DATAPOINTS, apply_patch, fetch_utilization, format_json, format_text, propose
+
+    try:
+        with open(task_file) as f:
+            local_task_file = json.load(f, object_pairs_hook=OrderedDict)
+        services = []
+        for service_file in service_files or ['service.json']:
+            with open(service_file) as f:
+                local_service_file = json.load(f)
+            validate_service_desc(local_service_file)
+            services.append((local_service_file['cluster'], local_service_file['serviceName']))
+    except (IOError, ValueError) as e:
+        raise click.ClickException("Received an error reading the task or service file: {0}".format(e))
+
+    ecs_client = get_ecs_client(access_key_id, secret_access_key)
+    live_task_def = get_latest_task_revision(ecs_client, local_task_file['family'])
+    if live_task_def is None:
+        raise click.ClickException("The task definition {0} hasn't been registered.".format(local_task_file['family']))
+
+    end_time = datetime.datetime.utcnow()
+    utilization = fetch_utilization(get_cloudwatch_client(access_key_id, secret_access_key), services,
+                                    end_time - datetime.timedelta(days=days), end_time, period)
+    if len(utilization['cpu_average']) < MIN_DATAPOINTS:
+        raise click.ClickException("Only {0} datapoints of utilization in the last {1} days. Use more --days or "
+                                   "a shorter --period.".format(len(utilization['cpu_average']), days))
+
+    changes = propose(local_task_file, live_task_def, utilization, percent, headroom)
+    if output_format == 'json':
+        click.echo("\n".join(format_json(changes)))
+    else:
+        click.echo("\n".join(format_text(changes, utilization, percent)))
+    if write and changes:
+        tmp_path = "{0}.tmp".format(task_file)
+        with open(tmp_path, 'w') as f:
+            json.dump(apply_patch(local_task_file, changes), f, indent=2, separators=(',', ': '))
+            f.write("\n")
+        os.rename(tmp_path, task_file)
+        if output_format == 'text':
+            click.echo("Saved the changes to {0}.".format(task_file))
+
+
+@cli.command()
+@click.option('--service-file', type=click.Path(dir_okay=False), default="service.json")
+@click.option('--task-file', type=click.Path(dir_okay=False), default="task-def.json")
+@click.option('--tag', required=False, help="The tag of the image in the repository to report on.")
+@click.option('--local', is_flag=True, help="Report on the image built locally instead, with uncompressed sizes.")
+@click.option('--access-key-id', required=False, help=AWS_KEY_HELP)
+@click.option('--secret-access-key', required=False, help=AWS_SECRET_HELP)
+@click.option('--repository', envvar='REPOSITORY', help=REPOSITORY_HELP)
+@click.option('--budget', type=float, required=False, help="Fail if the image is bigger than this many MB.")
+@click.option('--max-layer-growth', type=float, required=False, help=MAX_LAYER_GROWTH_HELP)
+@click.option('--top', type=int, default=0, help="Only show this many of the largest layers. Default is every layer.")
+@click.option('--format', 'output_format', type=click.Choice(['text', 'json']), default='text')
+@click.option('--docker-api', is_flag=True, envvar='ECS_BOSS_DOCKER_API', help=DOCKER_API_HELP)
+def image_report(service_file, task_file, tag, local, access_key_id, secret_access_key, repository, budget,
+                 max_layer_growth, top, output_format, docker_api):
+    """
+    Show the size of an image's layers and how they changed.
+
+    Each layer's size is attributed to the Dockerfile instruction that made
+    it, and compared with the image the service runs now, found through its
+    current task definition.
+    """
+    from api import validate_service_desc
+    from .image_report import build_report
+
+    if not repository:
+        raise click.ClickException("Please set the REPOSITORY environment variable or pass the --respository flag.")
+    if not tag and not local:
+        raise click.ClickException("Pass the --tag of the image in the repository, or --local.")
+    try:
+        with open(task_file) as f:
+            project_name = json.load(f)['family']
+        with open(service_file) as f:
+            local_service_file = json.load(f)
+        validate_service_desc(local_service_file)
+    except (IOError, ValueError, KeyError) as e:
+        raise click.ClickException("Received an error reading the task or service file: {0}".format(e))
+
+    ecs_client = get_ecs_client(access_key_id, secret_access_key)
+    ecr_client = get_ecr_client(access_key_id, secret_access_key, get_repository_region(repository))
+    if local:
+        report = build_report(ecs_client, ecr_client, local_service_file, repository, None, project_name,
+                              get_docker(docker_api))
+        if report is None:
+            raise click.ClickException("There is no local image {0}. Run build first.".format(project_name))
+    else:
+        report = build_report(ecs_client, ecr_client, local_service_file, repository, tag)
+        if report is None:
+            raise click.ClickException("{0}:{1} isn't in the repository.".format(repository, tag))
+    _check_image_size(report, budget, max_layer_growth, output_format, top)
+
+
+@cli.command()
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False), required=False,
+              help="The socket to listen on. Default is $ECS_BOSS_SOCKET or ~/.ecs-boss/ecs-boss.sock.")
+def serve(socket_path):
+    """
+    Run commands sent by ecs-boss-client, keeping AWS clients and caches warm.
+
+    Commands that change the same service run one at a time; others run
+    concurrently.
+    """
+    from .client import get_socket_path
+    from .server import serve as serve_forever
+
+    serve_forever(socket_path or get_socket_path())
 
 
 @cli.command()
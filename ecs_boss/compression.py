@@ -0,0 +1,139 @@
+"""
+Push images with zstd or estargz layers
+
+docker push sends the gzip layers the image was built with. With another
+compression, the local image that was built (or found by the build cache) is
+exported by BuildKit instead, with its layers recompressed, and pushed in the
+same step. Nothing is rebuilt: BuildKit builds a Dockerfile that only has
+`FROM` the local image, so the pushed image keeps its config, labels
+included:
+
+- zstd layers decompress several times faster than gzip, which shortens the
+  part of a task's image pull spent extracting them
+- estargz layers are gzip with an index, so a snapshotter that supports lazy
+  pulling can start the container before the whole image is downloaded
+
+The compressed size of each layer of the pushed manifest and how long BuildKit
+took to push it are shown afterwards. task-latency shows the effect on the
+pull phase of the new tasks.
+
+When the image goes to several regions, it is exported once and the pushed
+manifest is copied to the other regions' repositories with docker buildx
+imagetools, so every region gets the same layers and digest.
+"""
+import re
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+
+import click
+
+COMPRESSIONS = ('gzip', 'zstd', 'estargz')
+MAX_LEVELS = {'gzip': 9, 'estargz': 9, 'zstd': 22}
+STARGZ_ANNOTATION = 'containerd.io/snapshot/stargz/toc.digest'
+
+LayerCompression = namedtuple('LayerCompression', ['algorithm', 'level'])
+
+PUSH_VERTEX_RE = re.compile(r'^#(\d+) pushing layers')
+LAYER_DONE_RE = re.compile(r'^#(\d+) (?:pushing (?:layer )?)?(sha256:[0-9a-f]{64})\b.*?([\d.]+)s done$')
+
+
+def output_options(image, compression):
+    """
+    The BuildKit --output that pushes `image` with recompressed layers
+    """
+    options = ['type=image', 'name={0}'.format(image), 'push=true',
+               'compression={0}'.format(compression.algorithm), 'force-compression=true']
+    if compression.level is not None:
+        options.append('compression-level={0}'.format(compression.level))
+    if compression.algorithm != 'gzip':
+        options.append('oci-mediatypes=true')  # Docker's media types have no zstd or estargz layers
+    return ",".join(options)
+
+
+class PushProgress(object):
+    """
+    Reads the seconds each layer took to push from BuildKit's plain progress
+    output, a line at a time
+    """
+    def __init__(self):
+        self.push_steps = set()
+        self.layer_seconds = {}
+
+    def __call__(self, line):
+        match = PUSH_VERTEX_RE.match(line)
+        if match:
+            self.push_steps.add(match.group(1))
+            return
+        match = LAYER_DONE_RE.match(line)
+        if match and (match.group(1) in self.push_steps or ' pushing ' in line):
+            self.layer_seconds[match.group(2)] = float(match.group(3))
+
+
+def layer_compression(layer):
+    if STARGZ_ANNOTATION in layer.get('annotations', {}):
+        return 'estargz'
+    media_type = layer['mediaType']
+    if media_type.endswith('zstd'):
+        return 'zstd'
+    if media_type.endswith('gzip'):
+        return 'gzip'
+    return 'none'
+
+
+def format_size(size):
+    return "{0:.1f} MB".format(size / 1e6)
+
+
+def format_layers(manifest, layer_seconds, seconds):
+    layers = (manifest or {}).get('layers', [])
+    lines = ["{0:<14} {1:<8} {2:>10} {3:>8}".format('layer', 'format', 'size', 'push')]
+    for layer in layers:
+        layer_time = layer_seconds.get(layer['digest'])
+        lines.append("{0:<14} {1:<8} {2:>10} {3:>8}".format(
+            layer['digest'].split(':')[-1][:12], layer_compression(layer), format_size(layer['size']),
+            '-' if layer_time is None else '{0:.1f}s'.format(layer_time)))
+    total = sum([layer['size'] for layer in layers])
+    lines.append("{0} in {1} layers, pushed in {2:.1f}s".format(format_size(total), len(layers), seconds))
+    return lines
+
+
+def push_compressed(ecr_client, repository, tag, compression, source=None):
+    """
+    Export the local image `source`, by default the image tagged
+    repository:tag, and push it with the layer compression. Returns the
+    digest of the pushed image
+    """
+    from .api import ecr_login_command, run_command
+
+    image = "{0}:{1}".format(repository, tag)
+    click.echo("Exporting the layers with {0} compression".format(compression.algorithm))
+    progress = PushProgress()
+    start = time.time()
+    context_dir = tempfile.mkdtemp(prefix='ecs-boss-')  # Nothing is copied, so the build context is empty
+    try:
+        docker_cmd = ("echo 'FROM {0}' | docker buildx build --provenance=false --progress=plain --output {1} "
+                      "-f - {2}").format(source or image, output_options(image, compression), context_dir)
+        run_command("{0} && {1}".format(ecr_login_command(repository), docker_cmd), echo=True, check=True,
+                    on_line=progress)
+    finally:
+        shutil.rmtree(context_dir, ignore_errors=True)
+    seconds = time.time() - start
+    click.echo("\n".join(format_layers(ecr_client.get_image_manifest(repository, tag), progress.layer_seconds,
+                                       seconds)))
+    return ecr_client.get_image_digest(repository, tag)
+
+
+def copy_compressed(ecr_client, source_repository, repository, tag):
+    """
+    Copy the image pushed by push_compressed to another repository, keeping
+    its compressed layers. Returns the digest of the copied image
+    """
+    from .api import ecr_login_command, run_command
+
+    click.echo("Copying {0}:{2} to {1}:{2}".format(source_repository, repository, tag))
+    docker_cmd = "docker buildx imagetools create --tag {0}:{2} {1}:{2}".format(repository, source_repository, tag)
+    run_command("{0} && {1} && {2}".format(ecr_login_command(source_repository), ecr_login_command(repository),
+                                           docker_cmd), echo=True, check=True)
+    return ecr_client.get_image_digest(repository, tag)
@@ -0,0 +1,100 @@
+"""
+Run a deploy as a sequence of steps that can be resumed
+
+After each step finishes, its results are written to a checkpoint file. A
+resumed deploy skips the finished steps and gives their results to the
+remaining steps, so a failure late in the deploy doesn't rebuild the image or
+register another task definition revision.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import click
+
+DEFAULT_CHECKPOINT_FILE = '.ecs-boss-deploy.json'
+
+
+def fingerprint(*structures):
+    """
+    Return a hash of JSON-serializable structures, used to notice when the
+    local files change between a failure and a resume
+    """
+    data = json.dumps(structures, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class DeployCheckpoint(object):
+    """
+    The inputs of a deploy and the results of each finished step
+    """
+    def __init__(self, path, inputs=None, steps=None):
+        self.path = path
+        self.inputs = inputs or {}
+        self.steps = steps or OrderedDict()
+        self._lock = threading.Lock()  # Steps may finish in parallel, e.g. one per region
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            raise click.ClickException("There is no deploy to resume: {0} doesn't exist.".format(path))
+        with open(path) as f:
+            data = json.load(f, object_pairs_hook=OrderedDict)
+        return cls(path, data['inputs'], data['steps'])
+
+    def save(self):
+        tmp_path = "{0}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump({'inputs': self.inputs, 'steps': self.steps}, f, indent=2)
+        os.rename(tmp_path, self.path)
+
+    def is_done(self, step):
+        return step in self.steps
+
+    def complete(self, step, outputs):
+        with self._lock:
+            self.steps[step] = outputs
+            self.save()
+
+    @property
+    def results(self):
+        """
+        The combined results of the finished steps
+        """
+        results = dict(self.inputs)
+        for outputs in self.steps.values():
+            results.update(outputs)
+        return results
+
+
+class DeployStateMachine(object):
+    """
+    Run named steps in order, skipping the ones the checkpoint has finished
+
+    Each step is a function that receives the results of the inputs and
+    previous steps and returns a dict of its own results.
+    """
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.steps = []
+
+    def add_step(self, name, func):
+        self.steps.append((name, func))
+
+    @property
+    def pending_steps(self):
+        return [name for name, _ in self.steps if not self.checkpoint.is_done(name)]
+
+    def run(self):
+        """
+        Run the unfinished steps. Returns the combined results
+        """
+        for name, func in self.steps:
+            if self.checkpoint.is_done(name):
+                click.echo("Skipping {0}: already done.".format(name))
+                continue
+            outputs = func(self.checkpoint.results) or {}
+            self.checkpoint.complete(name, outputs)
+        return self.checkpoint.results
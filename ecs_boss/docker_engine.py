@@ -0,0 +1,276 @@
+"""
+Build, tag, pull and push images with the Docker Engine API
+
+The API is called over the daemon's Unix socket, without running the docker
+CLI. Build and push progress arrives as JSON events. A push reports the bytes
+uploaded for each layer and the digest of the manifest, so the throughput of
+the push can be shown and the digest doesn't have to be looked up afterwards.
+"""
+import base64
+import json
+import os
+import shlex
+import socket
+import tarfile
+import tempfile
+import time
+from collections import deque, namedtuple
+
+try:
+    import httplib
+    from urllib import quote, urlencode
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import quote, urlencode
+
+import click
+
+from .build_cache import iter_context_files
+from .process import echo_line
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+READ_SIZE = 64 * 1024
+TAIL_LINES = 100
+
+PushResult = namedtuple('PushResult', ['digest', 'bytes', 'seconds'])
+
+
+class DockerEngineError(click.ClickException):
+    def __init__(self, message, status=None):
+        super(DockerEngineError, self).__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def iter_events(response):
+    """
+    Yield the JSON objects of a streamed response as they arrive
+    """
+    decoder = json.JSONDecoder()
+    buffered = ''
+    for chunk in iter(lambda: response.read(READ_SIZE), b''):
+        buffered += chunk.decode('utf-8', 'replace')
+        while True:
+            buffered = buffered.lstrip()
+            try:
+                event, end = decoder.raw_decode(buffered)
+            except ValueError:
+                break  # Wait for the rest of the object
+            buffered = buffered[end:]
+            yield event
+
+
+def parse_build_args(build_arg_str):
+    """
+    Return the build arguments in `build_arg_str` as a dict, or None if it
+    has options other than --build-arg
+    """
+    build_args = {}
+    args = shlex.split(build_arg_str or '')
+    while args:
+        arg = args.pop(0)
+        if arg == '--build-arg' and args:
+            arg = args.pop(0)
+        elif arg.startswith('--build-arg='):
+            arg = arg[len('--build-arg='):]
+        else:
+            return None
+        name, separator, value = arg.partition('=')
+        build_args[name] = value if separator else os.environ.get(name, '')
+    return build_args
+
+
+def context_tar(context_dir, dockerfile='Dockerfile'):
+    """
+    Return a temporary file with the build context as a tar archive,
+    honoring .dockerignore
+    """
+    context_file = tempfile.TemporaryFile()
+    tar = tarfile.open(fileobj=context_file, mode='w')
+    try:
+        rel_paths = set(iter_context_files(context_dir))
+        rel_paths.add(dockerfile)  # Docker always sends the Dockerfile
+        for rel_path in sorted(rel_paths):
+            tar.add(os.path.join(context_dir, rel_path), arcname=rel_path, recursive=False)
+    finally:
+        tar.close()
+    context_file.seek(0)
+    return context_file
+
+
+def registry_auth(login):
+    """
+    The X-Registry-Auth header for a (username, password, registry) login
+    """
+    username, password, registry = login
+    auth = json.dumps({'username': username, 'password': password, 'serveraddress': registry})
+    return base64.urlsafe_b64encode(auth.encode('utf-8')).decode('ascii')
+
+
+class DockerEngine(object):
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+
+    def request(self, method, path, params=None, body=None, headers=None, timeout=None):
+        """
+        Send a request and return the response. Raises a DockerEngineError if
+        the daemon answers with an error
+        """
+        if params:
+            path = "{0}?{1}".format(path, urlencode(params))
+        connection = UnixHTTPConnection(self.socket_path, timeout)
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        if response.status >= 400:
+            content = response.read().decode('utf-8', 'replace')
+            try:
+                message = json.loads(content)['message']
+            except (ValueError, KeyError, TypeError):
+                message = content.strip()
+            raise DockerEngineError("Docker returned {0} for {1} {2}: {3}".format(
+                response.status, method, path.split('?')[0], message), response.status)
+        return response
+
+    def ping(self):
+        try:
+            return self.request('GET', '/_ping', timeout=5).read() == b'OK'
+        except (socket.error, httplib.HTTPException, DockerEngineError):
+            return False
+
+    def image_id(self, name):
+        """
+        Return the id of the local image `name`, or None if it doesn't exist
+        """
+        try:
+            response = self.request('GET', '/images/{0}/json'.format(quote(name, safe='/:')))
+        except DockerEngineError as e:
+            if e.status == 404:
+                return None
+            raise
+        return json.loads(response.read().decode('utf-8'))['Id']
+
+    def find_images(self, label, value):
+        """
+        Return the ids of the local images with the label
+        """
+        filters = json.dumps({'label': ['{0}={1}'.format(label, value)]})
+        response = self.request('GET', '/images/json', {'filters': filters})
+        return [image['Id'] for image in json.loads(response.read().decode('utf-8'))]
+
+    def history(self, name):
+        """
+        Return the instructions that made the layers of a local image and
+        their sizes, oldest first, or None if it doesn't exist
+        """
+        try:
+            response = self.request('GET', '/images/{0}/history'.format(quote(name, safe='/:')))
+        except DockerEngineError as e:
+            if e.status == 404:
+                return None
+            raise
+        return [(layer['CreatedBy'], layer['Size']) for layer in reversed(json.loads(response.read().decode('utf-8')))]
+
+    def tag(self, image, repository, tag='latest'):
+        self.request('POST', '/images/{0}/tag'.format(quote(image, safe='/:')), {'repo': repository, 'tag': tag}).read()
+
+    def build(self, context_dir, name, build_args=None, labels=None, dockerfile='Dockerfile'):
+        """
+        Build the image, showing its output as it is built. Returns the image id
+        """
+        params = {
+            't': name,
+            'dockerfile': dockerfile,
+            'rm': '1',
+            'buildargs': json.dumps(build_args or {}),
+            'labels': json.dumps(labels or {}),
+        }
+        context_file = context_tar(context_dir, dockerfile)
+        try:
+            size = os.fstat(context_file.fileno()).st_size
+            headers = {'Content-Type': 'application/x-tar', 'Content-Length': str(size)}
+            response = self.request('POST', '/build', params, context_file, headers)
+            image_id = None
+            tail = deque(maxlen=TAIL_LINES)
+            for event in iter_events(response):
+                if 'error' in event:
+                    raise DockerEngineError("Building {0} failed: {1}\n{2}".format(
+                        name, event['error'].strip(), "\n".join(tail)))
+                for line in event.get('stream', '').splitlines():
+                    tail.append(line)
+                    echo_line(line)
+                if 'ID' in event.get('aux', {}):
+                    image_id = event['aux']['ID']
+        finally:
+            context_file.close()
+        return image_id
+
+    def _follow_progress(self, response, action, noisy_statuses):
+        """
+        Show the changes of status of each layer, and return the bytes
+        transferred and the final aux event
+        """
+        statuses = {}
+        transferred = {}
+        aux = {}
+        for event in iter_events(response):
+            if 'error' in event:
+                raise DockerEngineError("{0} failed: {1}".format(action, event['error'].strip()))
+            if 'aux' in event:
+                aux = event['aux']
+                continue
+            layer = event.get('id')
+            status = event.get('status', '')
+            progress = event.get('progressDetail') or {}
+            if layer and 'current' in progress:
+                transferred[layer] = max(transferred.get(layer, 0), progress['current'])
+            if status in noisy_statuses:
+                continue
+            if layer is None:
+                echo_line(status)
+            elif statuses.get(layer) != status:
+                statuses[layer] = status
+                echo_line("{0}: {1}".format(layer, status))
+        return sum(transferred.values()), aux
+
+    def push(self, repository, tag, login):
+        """
+        Push the tagged image with the (username, password, registry) login.
+        Returns a PushResult
+        """
+        start = time.time()
+        response = self.request('POST', '/images/{0}/push'.format(quote(repository, safe='/:')), {'tag': tag},
+                                headers={'X-Registry-Auth': registry_auth(login)})
+        pushed, aux = self._follow_progress(response, "Pushing {0}:{1}".format(repository, tag), ('Pushing',))
+        seconds = time.time() - start
+        echo_line("Pushed {0:.1f} MB in {1:.1f}s ({2:.1f} MB/s), digest {3}".format(
+            pushed / 1e6, seconds, pushed / 1e6 / max(seconds, 0.001), aux.get('Digest', 'unknown')))
+        return PushResult(aux.get('Digest'), pushed, seconds)
+
+    def pull(self, repository, tag, login):
+        params = {'fromImage': repository, 'tag': tag}
+        response = self.request('POST', '/images/create', params, headers={'X-Registry-Auth': registry_auth(login)})
+        self._follow_progress(response, "Pulling {0}:{1}".format(repository, tag), ('Downloading', 'Extracting'))
+
+
+def get_docker_engine():
+    """
+    Return a DockerEngine if the daemon answers on its Unix socket (from
+    DOCKER_HOST or the default), otherwise None
+    """
+    host = os.environ.get('DOCKER_HOST', '')
+    if host and not host.startswith('unix://'):
+        return None
+    engine = DockerEngine(host[len('unix://'):] or DEFAULT_SOCKET)
+    return engine if engine.ping() else None
@@ -0,0 +1,129 @@
+"""
+Compare local service and task definition files with what is running in ECS
+
+Services are described in batches of 10 per cluster and each live task
+definition is described once, all concurrently, so checking many services
+takes about as long as checking one.
+"""
+import copy
+from collections import OrderedDict
+from functools import partial
+
+from .api import render_task_def
+from .ecs import DESCRIBE_SERVICES_MAX, chunked
+from .merge_structure import recursive_diff
+
+# Service file keys that either identify the service or can't be compared
+# with the output of describe_services
+SERVICE_IGNORED_KEYS = ('cluster', 'serviceName', 'taskDefinition', 'clientToken', 'role')
+
+
+class DriftReport(object):
+    """
+    The differences between the local files of one service and ECS
+    """
+    def __init__(self, cluster, service_name):
+        self.cluster = cluster
+        self.service_name = service_name
+        self.task_definition = None
+        self.error = None
+        self.changes = []
+
+    @property
+    def drifted(self):
+        return bool(self.error or self.changes)
+
+    def add(self, source, path, live, local):
+        self.changes.append((source, path, live, local))
+
+    def as_dict(self):
+        return OrderedDict([
+            ('cluster', self.cluster),
+            ('service', self.service_name),
+            ('taskDefinition', self.task_definition),
+            ('error', self.error),
+            ('changes', [
+                OrderedDict([('source', source), ('path', path), ('live', live), ('local', local)])
+                for source, path, live, local in self.changes]),
+        ])
+
+
+def compare_task_definition_name(local_name, live_arn):
+    """
+    Compare the service file's `family:revision` with the live ARN. A missing
+    revision or the %TASK_REV% placeholder only compares the family.
+    """
+    live_name = live_arn.split('/')[-1]
+    family, _, revision = local_name.partition(':')
+    if not revision or revision == '%TASK_REV%':
+        return live_name.split(':')[0] == family
+    return live_name == local_name
+
+
+def check_drift(ecs_client, pairs, repository=None, tag=None, concurrency=8):
+    """
+    Return a DriftReport for each (service description, task definition) pair
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    clusters = OrderedDict()
+    for service_desc, _ in pairs:
+        clusters.setdefault(service_desc['cluster'], []).append(service_desc['serviceName'])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        requests = []
+        for cluster, names in clusters.items():
+            for chunk in chunked(sorted(set(names)), DESCRIBE_SERVICES_MAX):
+                requests.append((cluster, executor.submit(ecs_client.describe_services, cluster, chunk)))
+        live_services = {}
+        for cluster, future in requests:
+            for service in future.result()['services']:
+                live_services[(cluster, service['serviceName'])] = service
+
+        task_def_arns = sorted(set([s['taskDefinition'] for s in live_services.values()]))
+        live_task_defs = dict(zip(task_def_arns, executor.map(ecs_client.describe_task_definition, task_def_arns)))
+
+    return [compare(service_desc, task_def, live_services, live_task_defs, repository, tag)
+            for service_desc, task_def in pairs]
+
+
+def compare(service_desc, task_def, live_services, live_task_defs, repository=None, tag=None):
+    report = DriftReport(service_desc['cluster'], service_desc['serviceName'])
+    service = live_services.get((service_desc['cluster'], service_desc['serviceName']))
+    if service is None or service.get('status') == 'INACTIVE':
+        report.error = "The service doesn't exist."
+        return report
+
+    report.task_definition = service['taskDefinition'].split('/')[-1]
+    if not compare_task_definition_name(service_desc['taskDefinition'], service['taskDefinition']):
+        report.add('service', 'taskDefinition', report.task_definition, service_desc['taskDefinition'])
+
+    local_service = dict([(k, v) for k, v in service_desc.items() if k not in SERVICE_IGNORED_KEYS])
+    for path, live, local in recursive_diff(service, local_service):
+        report.add('service', path, live, local)
+
+    local_task_def = render_task_def(copy.deepcopy(task_def), repository, tag)
+    if local_task_def.family != live_task_defs[service['taskDefinition']].family:
+        report.add('task-def', 'family', live_task_defs[service['taskDefinition']].family, local_task_def.family)
+        return report
+    for path, live, local in recursive_diff(live_task_defs[service['taskDefinition']], local_task_def):
+        report.add('task-def', path, live, local)
+    return report
+
+
+def format_report(report):
+    """
+    Return the lines describing a report for the terminal
+    """
+    import json
+
+    dumps = partial(json.dumps, sort_keys=True, default=str)
+    name = "{0} ({1})".format(report.service_name, report.cluster)
+    if report.error:
+        return ["{0}: {1}".format(name, report.error)]
+    if not report.changes:
+        return ["{0}: in sync with {1}".format(name, report.task_definition)]
+    lines = ["{0}: {1} differences from {2}".format(name, len(report.changes), report.task_definition)]
+    for source, path, live, local in report.changes:
+        lines.append("  {0} {1}: live={2} local={3}".format(source, path, dumps(live), dumps(local)))
+    return lines
@@ -3,20 +3,115 @@
 Largely derived from https://github.com/fabfuel/ecs-deploy/blob/develop/ecs_deploy/ecs.py
 """
 from __future__ import unicode_literals
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
 from datetime import datetime
-from json import dumps
+from json import dumps, loads
 
 import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 
+# The most items the ECS API accepts in a single call
+DESCRIBE_TASKS_MAX = 100
+DESCRIBE_SERVICES_MAX = 10
+LIST_SERVICES_MAX = 100  # list_services returns 10 per page unless asked for more
+RUN_TASK_MAX_COUNT = 10
+START_TASK_MAX_INSTANCES = 10
+DESCRIBE_CONTAINER_INSTANCES_MAX = 100
+GET_METRIC_DATA_MAX_QUERIES = 500
+GET_PARAMETERS_MAX = 10
+
+# How long parameters and secrets are reused before they are fetched again
+PARAMETER_CACHE_TTL = 300
+
+MANIFEST_MEDIA_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+
+
+# Replaces boto3 when set, e.g. by the benchmark's stand-in for AWS
+_client_factory = None
+
+
+def set_client_factory(factory):
+    """
+    Make every client use `factory(service_name, region)` instead of boto3.
+    Pass None to go back to boto3
+    """
+    global _client_factory
+    _client_factory = factory
+
+
+# Temporary credentials of assume-role profiles, kept between runs until shortly before they expire
+CREDENTIAL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ecs-boss', 'credentials')
+
+# One session per set of keys or profile, so every client in a process shares its credentials
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(access_key_id=None, secret_access_key=None, profile=None):
+    """
+    Return the boto3 session for the keys or profile, creating it once per
+    process. Its assume-role credentials are cached in CREDENTIAL_CACHE_DIR,
+    so only the first run in the credentials' lifetime calls STS (and asks
+    for an MFA code)
+    """
+    from botocore.credentials import JSONFileCache
+
+    key = (access_key_id, secret_access_key, profile)
+    with _sessions_lock:
+        if key not in _sessions:
+            session = boto3.session.Session(aws_access_key_id=access_key_id,
+                                            aws_secret_access_key=secret_access_key,
+                                            profile_name=profile)
+            if not os.path.isdir(CREDENTIAL_CACHE_DIR):
+                os.makedirs(CREDENTIAL_CACHE_DIR, 0o700)
+            provider = session._session.get_component('credential_provider').get_provider('assume-role')
+            provider.cache = JSONFileCache(CREDENTIAL_CACHE_DIR)  # Files are only readable by this user
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def get_boto_client(service_name, access_key_id=None, secret_access_key=None, region=None, profile=None):
+    if _client_factory is not None:
+        return _client_factory(service_name, region)
+    session = get_session(access_key_id, secret_access_key, profile)
+    with _sessions_lock:  # Creating clients from a shared session isn't thread safe
+        return session.client(service_name, region_name=region)
+
+
+def get_repository_name(repository):
+    """
+    The name of an ECR repository, which may be nested like team/app, from its
+    URI or the name itself
+    """
+    host, _, name = repository.partition('/')
+    if name and ('.' in host or ':' in host):
+        return name
+    return repository
+
+
+def chunked(items, size):
+    """
+    Split `items` into lists of at most `size` items
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
 class CloudWatchLogClient(object):
     def __init__(self, access_key_id=None, secret_access_key=None, region=None, profile=None):
-        session = boto3.session.Session(aws_access_key_id=access_key_id,
-                                        aws_secret_access_key=secret_access_key,
-                                        region_name=region,
-                                        profile_name=profile)
-        self.boto = session.client(u'logs')
+        self.boto = get_boto_client(u'logs', access_key_id, secret_access_key, region, profile)
 
     def describe_log_groups(self, log_group_name=None):
         """
@@ -48,22 +143,141 @@ class CloudWatchLogClient(object):
         kwargs['logStreamName'] = logStreamName
         return self.boto.get_log_events(**kwargs)
 
+    def filter_log_events(self, logGroupName, **kwargs):  # NOQA
+        """
+        Get the events from all or some of the streams in a cloud watch log group
+
+        Accepts other keyword arguments based on: https://boto3.readthedocs.io/en/latest/reference/services/logs.html#CloudWatchLogs.Client.filter_log_events
+        """
+        kwargs['logGroupName'] = logGroupName
+        return self.boto.filter_log_events(**kwargs)
+
+
+class CloudWatchClient(object):
+    def __init__(self, access_key_id=None, secret_access_key=None, region=None, profile=None):
+        self.boto = get_boto_client(u'cloudwatch', access_key_id, secret_access_key, region, profile)
+
+    def get_metric_data(self, queries, start_time, end_time):
+        """
+        Run the metric queries, at most 500 per call, and return the
+        timestamps and values of each query by its id, across every page
+        """
+        results = OrderedDict([(query['Id'], {'Timestamps': [], 'Values': []}) for query in queries])
+        for chunk in chunked(queries, GET_METRIC_DATA_MAX_QUERIES):
+            kwargs = {'MetricDataQueries': chunk, 'StartTime': start_time, 'EndTime': end_time,
+                      'ScanBy': 'TimestampAscending'}
+            while True:
+                response = self.boto.get_metric_data(**kwargs)
+                for result in response['MetricDataResults']:
+                    results[result['Id']]['Timestamps'].extend(result['Timestamps'])
+                    results[result['Id']]['Values'].extend(result['Values'])
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+        return results
+
+
+class TtlCache(object):
+    """
+    Values kept for `ttl` seconds, shared by the threads of a process
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._values.get(key, (0, None))
+            return value if expires > time.time() else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = (time.time() + self.ttl, value)
+
+
+class SsmClient(object):
+    def __init__(self, access_key_id=None, secret_access_key=None, region=None, profile=None):
+        self.boto = get_boto_client(u'ssm', access_key_id, secret_access_key, region, profile)
+        self._parameters = TtlCache(PARAMETER_CACHE_TTL)
+
+    def get_parameters(self, names):
+        """
+        Return the decrypted parameters by name, fetching those that aren't
+        cached 10 per call. Names that don't exist are left out
+        """
+        parameters = OrderedDict()
+        missing = []
+        for name in OrderedDict.fromkeys(names):
+            parameter = self._parameters.get(name)
+            if parameter is None:
+                missing.append(name)
+            else:
+                parameters[name] = parameter
+        for chunk in chunked(missing, GET_PARAMETERS_MAX):
+            response = self.boto.get_parameters(Names=chunk, WithDecryption=True)
+            for parameter in response['Parameters']:
+                self._parameters.set(parameter['Name'], parameter)
+                parameters[parameter['Name']] = parameter
+        return OrderedDict([(name, parameters[name]) for name in names if name in parameters])
+
+    def get_parameters_by_path(self, path):
+        """
+        Return the decrypted parameters directly under `path` by name, and
+        cache them for get_parameters
+        """
+        names = self._parameters.get(('path', path))
+        if names is not None:
+            cached = self.get_parameters(names)
+            if len(cached) == len(names):
+                return cached
+        parameters = OrderedDict()
+        for page in self.boto.get_paginator('get_parameters_by_path').paginate(
+                Path=path, Recursive=False, WithDecryption=True):
+            for parameter in page['Parameters']:
+                self._parameters.set(parameter['Name'], parameter)
+                parameters[parameter['Name']] = parameter
+        self._parameters.set(('path', path), list(parameters))
+        return parameters
+
+
+class SecretsManagerClient(object):
+    def __init__(self, access_key_id=None, secret_access_key=None, region=None, profile=None):
+        self.boto = get_boto_client(u'secretsmanager', access_key_id, secret_access_key, region, profile)
+        self._secrets = TtlCache(PARAMETER_CACHE_TTL)
+
+    def get_secret(self, name, with_value=False):
+        """
+        Return the ARN and name of a secret, and its SecretString
+        `with_value`, or None if it doesn't exist
+        """
+        secret = self._secrets.get((name, with_value)) or (None if with_value else self._secrets.get((name, True)))
+        if secret is not None:
+            return secret
+        try:
+            if with_value:
+                response = self.boto.get_secret_value(SecretId=name)
+            else:
+                response = self.boto.describe_secret(SecretId=name)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                return None
+            raise
+        secret = dict([(key, response[key]) for key in ('ARN', 'Name', 'SecretString') if key in response])
+        self._secrets.set((name, with_value), secret)
+        return secret
+
 
 class EcrClient(object):
     def __init__(self, access_key_id=None, secret_access_key=None, region=None, profile=None):
-        session = boto3.session.Session(aws_access_key_id=access_key_id,
-                                        aws_secret_access_key=secret_access_key,
-                                        region_name=region,
-                                        profile_name=profile)
-        self.boto = session.client(u'ecr')
+        self.boto = get_boto_client(u'ecr', access_key_id, secret_access_key, region, profile)
 
     def describe_repositories(self, repository_name=None):
         """
         Describe all the repositories or a subset filtered by repository_name
         """
         if repository_name and not isinstance(repository_name, (list, tuple)):
-            if "/" in repository_name:
-                _, repository_name = repository_name.split('/')
+            repository_name = get_repository_name(repository_name)
             repository_name = [repository_name]
         try:
             return self.boto.describe_repositories(repositoryNames=repository_name)
@@ -74,28 +288,83 @@ class EcrClient(object):
         """
         List all the tagged images in the repository
         """
-        if "/" in repository_name:
-            _, repository_name = repository_name.split('/')
+        repository_name = get_repository_name(repository_name)
         return self.boto.list_images(repositoryName=repository_name, filter={'tagStatus': 'TAGGED'})
 
     def has_tagged_image(self, repository_name, tag):
         """
         Return True if the repository has the tag
         """
-        if "/" in repository_name:
-            _, repository_name = repository_name.split('/')
-        images = self.boto.list_images(repositoryName=repository_name, filter={'tagStatus': 'TAGGED'})
-        for image in images['imageIds']:
-            if image['imageTag'] == tag:
-                return True
-        return False
+        return self.get_image_digest(repository_name, tag) is not None
+
+    def get_image_digest(self, repository_name, tag):
+        """
+        Return the digest of the tagged image, or None if it doesn't exist
+        """
+        repository_name = get_repository_name(repository_name)
+        try:
+            response = self.boto.describe_images(repositoryName=repository_name, imageIds=[{'imageTag': tag}])
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('ImageNotFoundException', 'RepositoryNotFoundException'):
+                return None
+            raise
+        return response['imageDetails'][0]['imageDigest']
+
+    def get_image_manifest(self, repository_name, tag=None, digest=None):
+        """
+        Return the manifest of the image with the tag or digest, or None if it
+        doesn't exist. For a multi-platform image, the manifest of its first
+        platform is returned
+        """
+        repository_name = get_repository_name(repository_name)
+        image_id = {'imageDigest': digest} if digest else {'imageTag': tag}
+        try:
+            response = self.boto.batch_get_image(repositoryName=repository_name, imageIds=[image_id],
+                                                 acceptedMediaTypes=MANIFEST_MEDIA_TYPES)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'RepositoryNotFoundException':
+                return None
+            raise
+        if not response['images']:
+            return None
+        manifest = loads(response['images'][0]['imageManifest'])
+        platforms = [m for m in manifest.get('manifests', [])
+                     if m.get('platform', {}).get('architecture', 'unknown') != 'unknown']
+        if platforms:
+            return self.get_image_manifest(repository_name, digest=platforms[0]['digest'])
+        return manifest
+
+    def get_image_config(self, repository_name, config_digest):
+        """
+        Download the config of an image, which has the instructions that made
+        its layers
+        """
+        try:
+            from urllib2 import urlopen
+        except ImportError:
+            from urllib.request import urlopen
+
+        repository_name = get_repository_name(repository_name)
+        response = self.boto.get_download_url_for_layer(repositoryName=repository_name, layerDigest=config_digest)
+        download = urlopen(response['downloadUrl'], timeout=30)
+        try:
+            return loads(download.read().decode('utf-8'))
+        finally:
+            download.close()
+
+    def get_login(self):
+        """
+        Return the user name, password and registry of a docker login to ECR
+        """
+        data = self.boto.get_authorization_token()['authorizationData'][0]
+        username, password = base64.b64decode(data['authorizationToken']).decode('utf-8').split(':', 1)
+        return username, password, data['proxyEndpoint']
 
     def create_repository(self, repository_name):
         """
         Create the repository `repository_name` if it doesn't exist
         """
-        if "/" in repository_name:
-            _, repository_name = repository_name.split('/')
+        repository_name = get_repository_name(repository_name)
         response = self.describe_repositories(repository_name)
         if 'error' in response and 'RepositoryNotFoundException' in response['error']:
             response = self.boto.create_repository(repositoryName=repository_name)
@@ -112,32 +381,106 @@ class EcrClient(object):
 
 class EcsClient(object):
     def __init__(self, access_key_id=None, secret_access_key=None, region=None, profile=None):
-        session = boto3.session.Session(aws_access_key_id=access_key_id,
-                                        aws_secret_access_key=secret_access_key,
-                                        region_name=region,
-                                        profile_name=profile)
-        self.boto = session.client(u'ecs')
+        self.boto = get_boto_client(u'ecs', access_key_id, secret_access_key, region, profile)
+        self._task_definitions = {}
 
     def describe_services(self, cluster_name, service_name):
-        return self.boto.describe_services(cluster=cluster_name, services=[service_name])
+        """
+        Describe one service, or a list of at most 10 services
+        """
+        if not isinstance(service_name, (tuple, list)):
+            service_name = [service_name]
+        return self.boto.describe_services(cluster=cluster_name, services=service_name)
+
+    def list_cluster_arns(self):
+        cluster_arns = []
+        for page in self.boto.get_paginator('list_clusters').paginate():
+            cluster_arns.extend(page['clusterArns'])
+        return cluster_arns
+
+    def iter_service_arn_pages(self, cluster_name):
+        """
+        Yield the service ARNs of a cluster one page at a time
+        """
+        pages = self.boto.get_paginator('list_services').paginate(
+            cluster=cluster_name, PaginationConfig={'PageSize': LIST_SERVICES_MAX})
+        for page in pages:
+            yield page['serviceArns']
 
     def describe_task_definition(self, task_definition_arn):
+        """
+        Describe a task definition by family, family:revision or ARN
+
+        A specific revision never changes, so it is only fetched once.
+        """
+        if task_definition_arn in self._task_definitions:
+            return EcsTaskDefinition(deepcopy(self._task_definitions[task_definition_arn]))
         result = self.boto.describe_task_definition(taskDefinition=task_definition_arn)
         if 'taskDefinition' in result:
+            if ':' in task_definition_arn.split('/')[-1]:
+                self._task_definitions[task_definition_arn] = deepcopy(result['taskDefinition'])
             return EcsTaskDefinition(result['taskDefinition'])
 
     def list_tasks(self, cluster_name, service_name):
         return self.boto.list_tasks(cluster=cluster_name, serviceName=service_name)
 
+    def list_task_arns(self, cluster_name, service_name=None, started_by=None, desired_status='RUNNING'):
+        """
+        Return the ARNs of all the tasks matching the filters, across every page
+        """
+        task_arns = []
+        for page in self.iter_task_arn_pages(cluster_name, service_name, started_by, desired_status):
+            task_arns.extend(page)
+        return task_arns
+
+    def iter_task_arn_pages(self, cluster_name, service_name=None, started_by=None, desired_status='RUNNING'):
+        """
+        Yield the ARNs of the tasks matching the filters one page at a time
+        """
+        kwargs = {'cluster': cluster_name, 'desiredStatus': desired_status}
+        if service_name:
+            kwargs['serviceName'] = service_name
+        if started_by:
+            kwargs['startedBy'] = started_by
+        for page in self.boto.get_paginator('list_tasks').paginate(**kwargs):
+            yield page['taskArns']
+
     def describe_tasks(self, cluster_name, task_arns):
-        return self.boto.describe_tasks(cluster=cluster_name, tasks=task_arns)
+        """
+        Describe the tasks, in as many calls as ECS requires
+        """
+        if len(task_arns) <= DESCRIBE_TASKS_MAX:
+            return self.boto.describe_tasks(cluster=cluster_name, tasks=task_arns)
+
+        result = {'tasks': [], 'failures': []}
+        for chunk in chunked(task_arns, DESCRIBE_TASKS_MAX):
+            response = self.boto.describe_tasks(cluster=cluster_name, tasks=chunk)
+            result['tasks'].extend(response['tasks'])
+            result['failures'].extend(response['failures'])
+            result['ResponseMetadata'] = response['ResponseMetadata']
+        return result
+
+    def iter_container_instance_arn_pages(self, cluster_name):
+        """
+        Yield the ARNs of the active container instances of a cluster one page at a time
+        """
+        paginator = self.boto.get_paginator('list_container_instances')
+        for page in paginator.paginate(cluster=cluster_name, status='ACTIVE'):
+            yield page['containerInstanceArns']
+
+    def describe_container_instances(self, cluster_name, container_instance_arns):
+        return self.boto.describe_container_instances(cluster=cluster_name, containerInstances=container_instance_arns)
 
-    def register_task_definition(self, family, containers, volumes, role_arn):
+    def register_task_definition(self, family, containers, volumes, role_arn, execution_role_arn=None):
+        kwargs = {}
+        if execution_role_arn:
+            kwargs['executionRoleArn'] = execution_role_arn
         return self.boto.register_task_definition(
             family=family,
             containerDefinitions=containers,
             volumes=volumes,
-            taskRoleArn=role_arn or ''
+            taskRoleArn=role_arn or '',
+            **kwargs
         )
 
     def deregister_task_definition(self, task_definition_arn):
@@ -163,6 +506,38 @@ class EcsClient(object):
             overrides=overrides
         )
 
+    def start_task(self, cluster, task_definition, container_instance_arns, started_by="ecs-boss"):
+        """
+        Start a task on each of the container instances (at most 10)
+        """
+        return self.boto.start_task(
+            cluster=cluster,
+            taskDefinition=task_definition,
+            containerInstances=container_instance_arns,
+            startedBy=started_by
+        )
+
+    def execute_command(self, cluster, task_arn, container, command):
+        """
+        Start an ECS Exec session running `command` in a container of a task.
+        The session in the response is given to the Session Manager plugin
+        """
+        return self.boto.execute_command(
+            cluster=cluster,
+            task=task_arn,
+            container=container,
+            command=command,
+            interactive=True
+        )
+
+    @property
+    def region(self):
+        return self.boto.meta.region_name
+
+    @property
+    def endpoint_url(self):
+        return self.boto.meta.endpoint_url
+
     def get_task_statuses(self, cluster, task_ids):
         """
         Retrieve task statuses from ECS API
@@ -170,7 +545,7 @@ class EcsClient(object):
         """
         if not isinstance(task_ids, (tuple, list)):
             task_ids = [task_ids]
-        response = self.boto.describe_tasks(cluster=cluster, tasks=task_ids)
+        response = self.describe_tasks(cluster, task_ids)
 
         # Error checking
         if response['failures']:
@@ -244,9 +619,124 @@ class EcsService(dict):
 
 
 class EcsTaskDefinition(dict):
+    """
+    A task definition with its containers indexed by name
+
+    The set_* methods edit copy-on-write: a container, and its environment or
+    secrets, is copied the first time it is changed rather than changed in
+    place, so a copy() shares every container it hasn't changed. Changes are
+    recorded as one EcsTaskDefinitionDiff per container and field.
+
+    Changing containers directly (not through the set_* methods) requires a
+    call to reindex() before the task definition is used again.
+    """
     def __init__(self, iterable=None, **kwargs):
-        super(EcsTaskDefinition, self).__init__(iterable, **kwargs)
-        self._diff = []
+        super(EcsTaskDefinition, self).__init__(iterable or {}, **kwargs)
+        self._changes = OrderedDict()
+        self.reindex()
+
+    def reindex(self):
+        self._indexed_containers = None
+        self._index = {}
+        self._named_indexes = {}
+        self._container_hashes = {}
+        self._owned = set()  # ids of the containers and lists this task definition copied
+
+    def copy(self):
+        """
+        Return a copy sharing the containers of this task definition until
+        either of them changes one. The copy starts without changes
+        """
+        other = EcsTaskDefinition(self)
+        other._container_hashes = dict(self._container_hashes)
+        self._owned = set()  # Shared now, so copy again before changing them
+        return other
+
+    def _container_index(self):
+        containers = self.containers
+        if containers is not self._indexed_containers or len(containers) != len(self._index):
+            self._index = dict([(container[u'name'], i) for i, container in enumerate(containers)])
+            self._indexed_containers = containers
+            self._named_indexes = {}
+        return self._index
+
+    def get_container(self, name):
+        index = self._container_index()
+        if name not in index:
+            raise UnknownContainerError(u'Unknown container: %s' % name)
+        return self.containers[index[name]]
+
+    def _writable_container(self, name):
+        """
+        Return the container to change, copying it (and the list of
+        containers) if it may be shared
+        """
+        index = self._container_index()
+        if name not in index:
+            raise UnknownContainerError(u'Unknown container: %s' % name)
+        containers = self.containers
+        if id(containers) not in self._owned:
+            containers = self[u'containerDefinitions'] = list(containers)
+            self._indexed_containers = containers
+            self._owned.add(id(containers))
+        container = containers[index[name]]
+        if id(container) not in self._owned:
+            container = containers[index[name]] = dict(container)
+            self._owned.add(id(container))
+        self._container_hashes.pop(name, None)
+        return container
+
+    def _named_index(self, name, field):
+        """
+        Return the position of each item of a container's environment or
+        secrets by name
+        """
+        key = (name, field)
+        if key not in self._named_indexes:
+            items = self.get_container(name).get(field) or []
+            self._named_indexes[key] = dict([(item[u'name'], i) for i, item in enumerate(items)])
+        return self._named_indexes[key]
+
+    def _set_named_values(self, name, field, value_key, values):
+        """
+        Set the items of a container's environment or secrets, adding the
+        ones it doesn't have. Returns the old value of the items that changed
+        (None for added items)
+        """
+        index = self._named_index(name, field)
+        container = self._writable_container(name)
+        items = container.get(field) or []
+        if id(items) not in self._owned:
+            items = container[field] = list(items)
+            self._owned.add(id(items))
+        old_values = {}
+        for key, value in values.items():
+            if key in index:
+                old_value = items[index[key]][value_key]
+                if old_value == value:
+                    continue
+                items[index[key]] = {u'name': key, value_key: value}
+            else:
+                old_value = None
+                index[key] = len(items)
+                items.append({u'name': key, value_key: value})
+            old_values[key] = old_value
+        return old_values
+
+    def _record(self, container, field, value, old_value):
+        """
+        Record a change, merging it with earlier changes of the same field
+        """
+        changes = self._changes.setdefault(container, OrderedDict())
+        diff = changes.get(field)
+        if diff is None:
+            changes[field] = EcsTaskDefinitionDiff(container, field, value, old_value)
+        elif isinstance(value, dict):
+            for key in value:
+                diff.old_value.setdefault(key, old_value[key])
+            diff.value.update(value)
+        else:
+            diff.value = value
 
     @property
     def containers(self):
@@ -254,8 +744,7 @@ class EcsTaskDefinition(dict):
 
     @property
     def container_names(self):
-        for container in self.get(u'containerDefinitions'):
-            yield container[u'name']
+        return [container[u'name'] for container in self.containers]
 
     @property
     def volumes(self):
@@ -283,19 +772,54 @@ class EcsTaskDefinition(dict):
 
     @property
     def diff(self):
-        return self._diff
+        return [diff for changes in self._changes.values() for diff in changes.values()]
+
+    @property
+    def diff_by_container(self):
+        """
+        The changes of each container (None for the task definition itself)
+        by field
+        """
+        return self._changes
+
+    @property
+    def structural_hash(self):
+        """
+        A hash of the task definition that doesn't depend on the order of its
+        containers, environment variables or secrets. Only the containers
+        changed since the last time are hashed again
+        """
+        self._container_index()
+        digest = hashlib.sha1()
+        fields = dict([(key, value) for key, value in self.items() if key != u'containerDefinitions'])
+        digest.update(dumps(fields, sort_keys=True, default=str).encode('utf-8'))
+        for name in sorted(self._index):
+            digest.update(self._container_hash(name).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _container_hash(self, name):
+        container = self.get_container(name)
+        cached = self._container_hashes.get(name)
+        if cached is None or cached[0] != id(container):
+            normalized = dict(container)
+            for field in (u'environment', u'secrets'):
+                if normalized.get(field):
+                    normalized[field] = sorted(normalized[field], key=lambda item: item[u'name'])
+            value = hashlib.sha1(dumps(normalized, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            cached = self._container_hashes[name] = (id(container), value)
+        return cached[1]
 
     def get_overrides(self):
-        override = dict()
         overrides = []
-        for diff in self.diff:
-            if override.get('name') != diff.container:
-                override = dict(name=diff.container)
-                overrides.append(override)
-            if diff.field == 'command':
-                override['command'] = self.get_overrides_command(diff.value)
-            elif diff.field == 'environment':
-                override['environment'] = self.get_overrides_environment(diff.value)
+        for container, changes in self._changes.items():
+            if container is None:
+                continue
+            override = dict(name=container)
+            if u'command' in changes:
+                override['command'] = self.get_overrides_command(changes[u'command'].value)
+            if u'environment' in changes:
+                override['environment'] = self.get_overrides_environment(changes[u'environment'].value)
+            overrides.append(override)
         return overrides
 
     def get_overrides_command(self, command):
@@ -306,60 +830,64 @@ class EcsTaskDefinition(dict):
 
     def set_images(self, tag=None, **images):
         self.validate_container_options(**images)
-        for container in self.containers:
-            if container[u'name'] in images:
-                new_image = images[container[u'name']]
-                diff = EcsTaskDefinitionDiff(container[u'name'], u'image', new_image, container[u'image'])
-                self._diff.append(diff)
-                container[u'image'] = new_image
+        for name in self.container_names:
+            old_image = self.get_container(name)[u'image']
+            if name in images:
+                new_image = images[name]
             elif tag:
-                image_definition = container[u'image'].rsplit(u':', 1)
-                new_image = u'%s:%s' % (image_definition[0], tag.strip())
-                diff = EcsTaskDefinitionDiff(container[u'name'], u'image', new_image, container[u'image'])
-                self._diff.append(diff)
-                container[u'image'] = new_image
+                new_image = u'%s:%s' % (old_image.rsplit(u':', 1)[0], tag.strip())
+            else:
+                continue
+            self._writable_container(name)[u'image'] = new_image
+            self._record(name, u'image', new_image, old_image)
 
     def set_commands(self, **commands):
         self.validate_container_options(**commands)
-        for container in self.containers:
-            if container[u'name'] in commands:
-                new_command = commands[container[u'name']]
-                diff = EcsTaskDefinitionDiff(container[u'name'], u'command', new_command, container.get(u'command'))
-                self._diff.append(diff)
-                container[u'command'] = [new_command]
+        for name, new_command in commands.items():
+            old_command = self.get_container(name).get(u'command')
+            self._writable_container(name)[u'command'] = [new_command]
+            self._record(name, u'command', new_command, old_command)
 
     def set_environment(self, environment_list):
-        environment = {}
+        """
+        Set environment variables from (container, name, value) tuples
+        """
+        self._set_named_items(u'environment', u'value', environment_list)
 
-        for env in environment_list:
-            environment.setdefault(env[0], {})
-            environment[env[0]][env[1]] = env[2]
+    def set_secrets(self, secret_list):
+        """
+        Set secrets from (container, name, valueFrom) tuples
+        """
+        self._set_named_items(u'secrets', u'valueFrom', secret_list)
 
-        self.validate_container_options(**environment)
-        for container in self.containers:
-            if container[u'name'] in environment:
-                self.apply_container_environment(container, environment[container[u'name']])
+    def _set_named_items(self, field, value_key, item_list):
+        values = OrderedDict()
+        for item in item_list:
+            values.setdefault(item[0], {})[item[1]] = item[2]
 
-    def apply_container_environment(self, container, new_environment):
-        old_environment = {env['name']: env['value'] for env in container.get('environment', {})}
-        merged_environment = old_environment.copy()
-        merged_environment.update(new_environment)
+        self.validate_container_options(**values)
+        for name, container_values in values.items():
+            self.apply_container_values(name, field, value_key, container_values)
 
-        diff = EcsTaskDefinitionDiff(container[u'name'], u'environment', merged_environment, old_environment)
-        self._diff.append(diff)
+    def apply_container_environment(self, container, new_environment):
+        self.apply_container_values(container[u'name'], u'environment', u'value', new_environment)
 
-        container[u'environment'] = [{"name": e, "value": merged_environment[e]} for e in merged_environment]
+    def apply_container_values(self, name, field, value_key, new_values):
+        old_values = self._set_named_values(name, field, value_key, new_values)
+        if old_values:
+            changed = dict([(key, new_values[key]) for key in old_values])
+            self._record(name, field, changed, old_values)
 
     def validate_container_options(self, **container_options):
+        index = self._container_index()
         for container_name in container_options:
-            if container_name not in self.container_names:
+            if container_name not in index:
                 raise UnknownContainerError(u'Unknown container: %s' % container_name)
 
     def set_role_arn(self, role_arn):
         if role_arn:
-            diff = EcsTaskDefinitionDiff(None, u'role_arn', role_arn, self[u'taskRoleArn'])
+            self._record(None, u'role_arn', role_arn, self.get(u'taskRoleArn'))
             self[u'taskRoleArn'] = role_arn
-            self._diff.append(diff)
 
 
 class EcsTaskDefinitionDiff(object):
@@ -431,12 +959,18 @@ class EcsAction(object):
         return EcsService(self._cluster_name, response[u'service'])
 
     def is_deployed(self, service):
-        if len(service[u'deployments']) != 1:
+        """
+        Whether the service runs only its task definition, with all its tasks
+        running. The service is described with everything else being watched
+        """
+        from .poller import get_poller
+
+        current = get_poller(self._client).describe_service(service.cluster, service.name)
+        if len(current[u'deployments']) != 1:
             return False
-        running_tasks = self._client.list_tasks(service.cluster, service.name)
-        if not running_tasks[u'taskArns']:
-            return service.desired_count == 0
-        return service.desired_count == self.get_running_tasks_count(service, running_tasks[u'taskArns'])
+        deployment = current[u'deployments'][0]
+        return (deployment[u'taskDefinition'] == service.task_definition and
+                deployment[u'runningCount'] == service.desired_count)
 
     def get_running_tasks_count(self, service, task_arns):
         running_count = 0
@@ -0,0 +1,135 @@
+"""
+Run a command in a task the service already runs, with ECS Exec
+
+Starting a one-off task means waiting for it to be placed and to pull its
+image before the command starts. With ECS Exec the command runs in a
+running task of the service instead, within seconds.
+
+The service is described by the poller, like deploy does when it waits for
+it, and the task is picked among its RUNNING tasks whose exec agent runs in
+the container: those of the service's task definition first, then healthy
+ones before those without a health check. ecs-boss then starts the session
+with execute_command and hands it to the Session Manager plugin, whose output
+is streamed.
+
+The plugin doesn't tell how the command ended, so the command is run by a
+shell that prints its exit code on a marker line afterwards, which is read
+and not shown.
+
+Nothing is run here when the service doesn't have execute command enabled,
+none of its tasks can run it or the plugin isn't installed: the caller then
+runs the command in a new task.
+"""
+import json
+import os
+import re
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+import click
+
+from .poller import get_poller
+from .process import echo_line, run
+
+PLUGIN = 'session-manager-plugin'
+EXIT_MARKER = '__ECS_BOSS_EXIT_CODE='
+EXIT_MARKER_RE = re.compile(r'^' + EXIT_MARKER + r'(\d+)$')
+HEALTH_ORDER = {'HEALTHY': 0, 'UNKNOWN': 1}
+
+
+def find_plugin():
+    """
+    The path of the Session Manager plugin, or None if it isn't installed
+    """
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, PLUGIN)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def exec_agent_running(task, container_name):
+    for container in task.get('containers', []):
+        if container['name'] == container_name:
+            return any([agent.get('name') == 'ExecuteCommandAgent' and agent.get('lastStatus') == 'RUNNING'
+                        for agent in container.get('managedAgents', [])])
+    return False
+
+
+def pick_task(ecs_client, cluster, service_name, container_name):
+    """
+    A running task of the service that can run commands in the container, or
+    None. Returns (task, reason) with the reason there is none
+    """
+    service = get_poller(ecs_client).describe_service(cluster, service_name)
+    if not service.get('enableExecuteCommand'):
+        return None, "execute command isn't enabled on the service {0}".format(service_name)
+
+    task_arns = ecs_client.list_task_arns(cluster, service_name)
+    tasks = ecs_client.describe_tasks(cluster, task_arns)['tasks'] if task_arns else []
+    candidates = [task for task in tasks
+                  if task['lastStatus'] == 'RUNNING' and task.get('enableExecuteCommand') and
+                  task.get('healthStatus', 'UNKNOWN') in HEALTH_ORDER and exec_agent_running(task, container_name)]
+    if not candidates:
+        return None, "none of the {0} tasks of {1} can run commands in the container {2}".format(
+            len(tasks), service_name, container_name)
+    candidates.sort(key=lambda task: (task['taskDefinitionArn'] != service['taskDefinition'],
+                                      HEALTH_ORDER[task.get('healthStatus', 'UNKNOWN')], task['taskArn']))
+    return candidates[0], None
+
+
+def shell_command(command):
+    """
+    The command run by a shell that prints its exit code on a marker line.
+    Each argument is quoted, so it reaches the command as it was given
+    """
+    script = "{0}; echo {1}$?".format(" ".join([quote(arg) for arg in command]), EXIT_MARKER)
+    return "/bin/sh -c '{0}'".format(script.replace("'", "'\\''"))
+
+
+def run_in_task(ecs_client, cluster, task, container_name, command, plugin=PLUGIN):
+    """
+    Run the command in the container of a running task, streaming its
+    output. Returns its exit code
+    """
+    container = [c for c in task['containers'] if c['name'] == container_name][0]
+    response = ecs_client.execute_command(cluster, task['taskArn'], container_name, shell_command(command))
+    target = "ecs:{0}_{1}_{2}".format(cluster.split('/')[-1], task['taskArn'].split('/')[-1], container['runtimeId'])
+    plugin_command = [plugin, json.dumps(response['session']), ecs_client.region, 'StartSession', '',
+                      json.dumps({'Target': target}), ecs_client.endpoint_url]
+    exit_codes = []
+
+    def on_line(line):
+        match = EXIT_MARKER_RE.match(line.strip())
+        if match:
+            exit_codes.append(int(match.group(1)))
+        elif not exit_codes:  # The plugin says it's exiting the session after the command ends
+            echo_line(line)
+
+    result = run(plugin_command, tail_lines=1, on_line=on_line)
+    if not exit_codes:
+        raise click.ClickException("The session ended before '{0}' finished ({1} exited with {2}).".format(
+            " ".join(command), PLUGIN, result.exit_code))
+    return exit_codes[0]
+
+
+def exec_command(ecs_client, cluster, service_name, container_name, command):
+    """
+    Run the command in a running task of the service with ECS Exec. Returns
+    its exit code, or None if it couldn't be run that way
+    """
+    plugin = find_plugin()
+    if plugin is None:
+        click.echo("{0} isn't installed, so the command runs in a new task.".format(PLUGIN))
+        return None
+    task, reason = pick_task(ecs_client, cluster, service_name, container_name)
+    if task is None:
+        click.echo("The command runs in a new task: {0}.".format(reason))
+        return None
+    click.echo("Running '{0}' in container '{1}' of the running task {2} ({3}).".format(
+        " ".join(command), container_name, task['taskArn'].split('/')[-1],
+        task['taskDefinitionArn'].split('/')[-1]))
+    return run_in_task(ecs_client, cluster, task, container_name, command, plugin)
@@ -0,0 +1,281 @@
+"""
+Run a command across many one-off ECS tasks
+
+Each unit of work is a shard. Shards are launched in as few `run_task` calls
+as possible, limited by a maximum number of running tasks and a maximum rate
+of `run_task` calls, and are tracked until every task has stopped.
+
+Only shards with identical overrides share a call (up to 10 tasks). With
+SHARD_INDEX in each shard's environment, or a different command per shard,
+every call launches a single task, so those runs default to a higher rate.
+"""
+import io
+import os
+import time
+from collections import deque
+
+import click
+from botocore.exceptions import ClientError
+
+from .api import POLL_TIME, get_log_stream_name
+from .ecs import RUN_TASK_MAX_COUNT
+
+SHARD_INDEX_VAR = 'SHARD_INDEX'
+SHARD_COUNT_VAR = 'SHARD_COUNT'
+
+# The longest the rate limiter will back off when ECS throttles us
+MAX_LAUNCH_INTERVAL = 30
+
+# Default run_task calls per second, when calls launch several tasks or one each
+GROUPED_LAUNCH_RATE = 1.0
+SINGLE_LAUNCH_RATE = 5.0
+
+
+class RateLimiter(object):
+    """
+    Space out calls so there are at most `rate` calls per second
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_call = 0
+
+    def wait(self):
+        now = time.time()
+        if now < self._next_call:
+            time.sleep(self._next_call - now)
+            now = self._next_call
+        self._next_call = now + self.interval
+
+    def backoff(self):
+        """
+        Slow down after the API pushed back
+        """
+        self.interval = min(max(self.interval * 2, 1), MAX_LAUNCH_INTERVAL)
+
+
+class Shard(object):
+    """
+    One unit of work and the task that runs it
+    """
+    def __init__(self, index, command):
+        self.index = index
+        self.command = command
+        self.task_arn = None
+        self.status = 'QUEUED'
+        self.exit_code = None
+        self.stop_code = None
+        self.reason = None
+        self.log_token = None
+
+    @property
+    def task_id(self):
+        return self.task_arn.split('/')[-1]
+
+    @property
+    def failed(self):
+        return self.status == 'FAILED' or (self.status == 'STOPPED' and self.exit_code != 0)
+
+    def fail(self, reason):
+        self.status = 'FAILED'
+        self.reason = reason
+
+
+def read_commands_file(commands_file):
+    """
+    Return a list of commands, one per line. Blank lines and comments are skipped
+    """
+    import shlex
+
+    commands = []
+    for line in commands_file:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            commands.append(shlex.split(line))
+    return commands
+
+
+class FanOut(object):
+    """
+    Launch and track one task per shard
+    """
+    def __init__(self, ecs_client, log_client, cluster, task_definition, container_name, shards,
+                 max_running=10, launch_rate=None, shard_env=True, log_config=None, log_dir=None,
+                 started_by='ecs-boss'):
+        self.ecs_client = ecs_client
+        self.log_client = log_client
+        self.cluster = cluster
+        self.task_definition = task_definition
+        self.container_name = container_name
+        self.shards = shards
+        self.max_running = max_running
+        self.shard_env = shard_env
+        if launch_rate is None:
+            launch_rate = GROUPED_LAUNCH_RATE if self.can_group() else SINGLE_LAUNCH_RATE
+        self.rate_limiter = RateLimiter(launch_rate)
+        self.log_config = log_config if log_dir else None
+        self.log_dir = log_dir
+        self.started_by = started_by
+
+    def can_group(self):
+        """
+        Whether any shards can share a `run_task` call, which needs identical overrides
+        """
+        if self.shard_env:
+            return False  # Each shard has its own SHARD_INDEX
+        return len(set([tuple(shard.command) for shard in self.shards])) < len(self.shards)
+
+    def get_overrides(self, shard):
+        override = {
+            'name': self.container_name,
+            'command': shard.command,
+        }
+        if self.shard_env:
+            override['environment'] = [
+                {'name': SHARD_INDEX_VAR, 'value': str(shard.index)},
+                {'name': SHARD_COUNT_VAR, 'value': str(len(self.shards))},
+            ]
+        return {'containerOverrides': [override]}
+
+    def run(self):
+        """
+        Launch every shard and wait for all of them to stop
+        """
+        if self.log_dir and not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        queued = deque(self.shards)
+        running = {}
+        while queued or running:
+            if queued:
+                self.launch(queued, running)
+            if running:
+                self.poll(running)
+            if queued or running:
+                time.sleep(POLL_TIME)
+        return self.shards
+
+    def next_group(self, queued, slots):
+        """
+        Take the next shards that can share a single `run_task` call
+        """
+        group = [queued.popleft()]
+        overrides = self.get_overrides(group[0])
+        limit = min(slots, RUN_TASK_MAX_COUNT)
+        while queued and len(group) < limit and self.get_overrides(queued[0]) == overrides:
+            group.append(queued.popleft())
+        return group, overrides
+
+    def launch(self, queued, running):
+        """
+        Launch queued shards until the running limit is reached
+        """
+        while queued and len(running) < self.max_running:
+            group, overrides = self.next_group(queued, self.max_running - len(running))
+            self.rate_limiter.wait()
+            try:
+                result = self.ecs_client.run_task(
+                    self.cluster, self.task_definition.family_revision, count=len(group),
+                    started_by=self.started_by, overrides=overrides)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ThrottlingException':
+                    raise
+                # Put the shards back and try again on the next pass
+                self.rate_limiter.backoff()
+                queued.extendleft(reversed(group))
+                return
+
+            for shard, task in zip(group, result['tasks']):
+                shard.task_arn = task['taskArn']
+                shard.status = task['lastStatus']
+                running[shard.task_arn] = shard
+                click.echo("Shard {0}: started task {1}".format(shard.index, shard.task_id))
+
+            unlaunched = group[len(result['tasks']):]
+            if not unlaunched:
+                continue
+            reasons = sorted(set([f['reason'] for f in result['failures']])) or ['unknown']
+            if running and all([r.startswith('RESOURCE:') for r in reasons]):
+                # The cluster is full. Wait for running tasks to make room.
+                click.echo("Cluster has no room for more tasks ({0}). Waiting.".format(", ".join(reasons)))
+                queued.extendleft(reversed(unlaunched))
+                return
+            for shard in unlaunched:
+                shard.fail("Could not start task: {0}".format(", ".join(reasons)))
+                click.echo("Shard {0}: {1}".format(shard.index, shard.reason))
+
+    def poll(self, running):
+        """
+        Update the status of the running shards and collect their logs
+        """
+        response = self.ecs_client.describe_tasks(self.cluster, list(running.keys()))
+        for task in sorted(response['tasks'], key=lambda t: running[t['taskArn']].index):
+            shard = running[task['taskArn']]
+            if task['lastStatus'] != shard.status:
+                shard.status = task['lastStatus']
+                click.echo("Shard {0}: {1}".format(shard.index, shard.status))
+            if shard.status in ('RUNNING', 'STOPPED'):
+                self.fetch_logs(shard)
+            if shard.status == 'STOPPED':
+                self.record_exit(shard, task)
+                del running[shard.task_arn]
+        # ECS forgets a task some time after it stops, and it can't tell how it ended
+        for failure in response['failures']:
+            shard = running.pop(failure.get('arn'), None)
+            if shard is not None:
+                shard.fail("Could not describe task: {0}".format(failure.get('reason')))
+                click.echo("Shard {0}: {1}".format(shard.index, shard.reason))
+
+    def record_exit(self, shard, task):
+        shard.stop_code = task.get('stopCode')
+        shard.reason = task.get('stoppedReason')
+        for container in task.get('containers', []):
+            if container['name'] == self.container_name:
+                shard.exit_code = container.get('exitCode')
+                shard.reason = container.get('reason', shard.reason)
+
+    def fetch_logs(self, shard):
+        """
+        Append any new log events for the shard to its log file
+        """
+        if not self.log_config:
+            return
+        log_group, log_stream = get_log_stream_name(self.log_config, self.container_name, shard.task_id)
+        if log_stream is None:
+            return
+
+        path = os.path.join(self.log_dir, 'shard-{0:04d}.log'.format(shard.index))
+        with io.open(path, 'a', encoding='utf-8') as log_file:
+            while True:
+                kwargs = {}
+                if shard.log_token is not None:
+                    kwargs['nextToken'] = shard.log_token
+                else:
+                    kwargs['startFromHead'] = True
+                try:
+                    log_events = self.log_client.get_log_events(log_group, log_stream, **kwargs)
+                except ClientError as e:
+                    if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                        return  # The stream isn't created until the container logs something
+                    raise
+                if log_events['nextForwardToken'] == shard.log_token:
+                    return
+                shard.log_token = log_events['nextForwardToken']
+                log_file.write(u''.join([u'{0}\n'.format(e['message']) for e in log_events['events']]))
+
+
+def summarize(shards):
+    """
+    Report how the shards finished. Returns the failed shards
+    """
+    exit_codes = {}
+    for shard in shards:
+        exit_codes[shard.exit_code] = exit_codes.get(shard.exit_code, 0) + 1
+    failed = [shard for shard in shards if shard.failed]
+
+    click.echo("{0} of {1} shards succeeded.".format(len(shards) - len(failed), len(shards)))
+    for exit_code, count in sorted(exit_codes.items(), key=lambda x: -x[1]):
+        click.echo("  exit code {0}: {1}".format('none' if exit_code is None else exit_code, count))
+    for shard in failed:
+        click.echo("  shard {0} ({1}): exit code {2}, {3}".format(
+            shard.index, shard.task_arn or 'not started', shard.exit_code, shard.reason or shard.stop_code))
+    return failed
@@ -0,0 +1,208 @@
+"""
+Show what makes an image big, and how it changed since the last deploy
+
+The size of each layer is attributed to the Dockerfile instruction that made
+it: for an image in ECR, from its manifest (compressed sizes, which is what
+tasks pull) and the history in its config; for a local image, from docker
+history (uncompressed sizes). The image is compared with the one the service
+runs now, found through the service's current task definition, from the same
+source so the sizes are comparable.
+
+Layers are matched by their instruction. One whose size grew by more than a
+threshold is flagged, and the report fails when the whole image is over a
+size budget.
+"""
+import json
+import re
+from collections import namedtuple
+
+from .compression import format_size
+
+Layer = namedtuple('Layer', ['instruction', 'size'])
+
+NOP_PREFIX_RE = re.compile(r'^/bin/sh -c #\(nop\)\s*')
+SHELL_PREFIX_RE = re.compile(r'^(RUN )?/bin/sh -c ')
+CONTENT_HASH_RE = re.compile(r'\b(file|dir|multi):[0-9a-f]{64}\b')
+DEFAULT_MAX_LAYER_GROWTH = 10  # MB
+
+
+def normalize_instruction(created_by):
+    """
+    The Dockerfile instruction of a history entry, without the shell prefix
+    the classic builder adds, BuildKit's comment and content hashes
+    """
+    instruction = NOP_PREFIX_RE.sub('', created_by or '')
+    instruction = SHELL_PREFIX_RE.sub('RUN ', instruction)
+    instruction = CONTENT_HASH_RE.sub(r'\1:...', instruction)
+    if instruction.endswith('# buildkit'):
+        instruction = instruction[:-len('# buildkit')]
+    return " ".join(instruction.split())
+
+
+def ecr_layers(ecr_client, repository, tag=None, digest=None):
+    """
+    The layers of an image in ECR with their compressed sizes, or None if it
+    doesn't exist
+    """
+    manifest = ecr_client.get_image_manifest(repository, tag, digest)
+    if manifest is None:
+        return None
+    config = ecr_client.get_image_config(repository, manifest['config']['digest'])
+    history = [h for h in config.get('history', []) if not h.get('empty_layer')]
+    layers = manifest['layers']
+    if len(history) != len(layers):  # Squashed or hand-made images
+        history = [{}] * (len(layers) - len(history)) + history[-len(layers):] if layers else []
+    return [Layer(normalize_instruction(h.get('created_by')) or layer['digest'][:19], layer['size'])
+            for h, layer in zip(history, layers)]
+
+
+def local_layers(image, docker=None):
+    """
+    The layers of a local image with their uncompressed sizes, or None if it
+    doesn't exist
+    """
+    from .api import run_command
+
+    if docker is not None:
+        history = docker.history(image)
+    else:
+        output = run_command(['docker', 'history', '--no-trunc', '--human=false', '--format',
+                              '{{.Size}}\t{{.CreatedBy}}', image]).output
+        if not output.strip() or '\t' not in output:
+            return None
+        history = []
+        for line in reversed(output.strip().splitlines()):
+            size, _, created_by = line.partition('\t')
+            history.append((created_by, int(size)))
+    if history is None:
+        return None
+    return [Layer(normalize_instruction(created_by), size) for created_by, size in history if size]
+
+
+def get_deployed_image(ecs_client, service_desc, repository):
+    """
+    The image of `repository` in the task definition the service runs now,
+    as (tag, digest), or None
+    """
+    response = ecs_client.describe_services(service_desc['cluster'], service_desc['serviceName'])
+    if not response['services']:
+        return None
+    task_def = ecs_client.describe_task_definition(response['services'][0]['taskDefinition'])
+    repository_name = repository.split('/')[-1]
+    for container in task_def['containerDefinitions']:
+        name, _, digest = container['image'].partition('@')
+        image_repository, _, tag = name.rpartition(':') if ':' in name.split('/')[-1] else (name, '', 'latest')
+        if image_repository.split('/')[-1] == repository_name:
+            return (None, digest) if digest else (tag, None)
+    return None
+
+
+class LayerChange(object):
+    def __init__(self, instruction, size, previous_size):
+        self.instruction = instruction
+        self.size = size
+        self.previous_size = previous_size
+        self.flagged = False
+
+    @property
+    def growth(self):
+        return self.size - (self.previous_size or 0)
+
+    def as_dict(self):
+        return {'instruction': self.instruction, 'size': self.size, 'previous_size': self.previous_size,
+                'growth': self.growth, 'flagged': self.flagged}
+
+
+class ImageReport(object):
+    """
+    The layers of an image compared with those of the deployed image
+    """
+    def __init__(self, image, layers, previous_image=None, previous_layers=None, compressed=True):
+        self.image = image
+        self.previous_image = previous_image
+        self.compressed = compressed
+        self.total = sum([layer.size for layer in layers])
+        self.previous_total = sum([layer.size for layer in previous_layers]) if previous_layers is not None else None
+
+        # Match layers by instruction, counting repeats so the nth "RUN ..." matches the nth
+        previous = {}
+        for key, layer in self._keyed(previous_layers or []):
+            previous[key] = layer.size
+        self.changes = [LayerChange(layer.instruction, layer.size, previous.get(key)) for key, layer
+                        in self._keyed(layers)]
+
+    @staticmethod
+    def _keyed(layers):
+        counts = {}
+        for layer in layers:
+            counts[layer.instruction] = counts.get(layer.instruction, 0) + 1
+            yield (layer.instruction, counts[layer.instruction]), layer
+
+    def flag_growth(self, max_growth):
+        """
+        Flag the layers that grew by more than `max_growth` bytes since the
+        deployed image. Returns them
+        """
+        for change in self.changes:
+            change.flagged = self.previous_total is not None and change.growth > max_growth
+        return [change for change in self.changes if change.flagged]
+
+    def as_dict(self):
+        return {
+            'image': self.image,
+            'previous_image': self.previous_image,
+            'compressed': self.compressed,
+            'total': self.total,
+            'previous_total': self.previous_total,
+            'layers': [change.as_dict() for change in self.changes],
+        }
+
+
+def build_report(ecs_client, ecr_client, service_desc, repository, tag, local_image=None, docker=None):
+    """
+    Compare the image `repository:tag` in ECR, or the local image
+    `local_image`, with the image the service described by `service_desc`
+    runs now. Returns an ImageReport, or None if the image doesn't exist
+    """
+    deployed = get_deployed_image(ecs_client, service_desc, repository) if service_desc else None
+    previous_image = previous_layers = None
+    if local_image:
+        layers = local_layers(local_image, docker)
+        if deployed and deployed[0]:  # Only images pushed from here are still tagged locally
+            previous_image = "{0}:{1}".format(repository, deployed[0])
+            previous_layers = local_layers(previous_image, docker)
+        image = local_image
+    else:
+        layers = ecr_layers(ecr_client, repository, tag)
+        if deployed:
+            previous_image = "{0}@{1}".format(repository, deployed[1]) if deployed[1] else "{0}:{1}".format(
+                repository, deployed[0])
+            previous_layers = ecr_layers(ecr_client, repository, *deployed)
+        image = "{0}:{1}".format(repository, tag)
+    if layers is None:
+        return None
+    if previous_layers is None:
+        previous_image = None
+    return ImageReport(image, layers, previous_image, previous_layers, compressed=not local_image)
+
+
+def format_text(report, top=None):
+    kind = 'compressed' if report.compressed else 'uncompressed'
+    lines = ["{0}: {1} {2} in {3} layers".format(report.image, format_size(report.total), kind, len(report.changes))]
+    if report.previous_total is not None:
+        lines[0] += ", {0:+.1f} MB since {1} ({2})".format(
+            (report.total - report.previous_total) / 1e6, report.previous_image, format_size(report.previous_total))
+    changes = sorted(report.changes, key=lambda c: -c.size)[:top] if top else report.changes
+    for change in changes:
+        if change.previous_size is None:
+            growth = 'new' if report.previous_total is not None else ''
+        else:
+            growth = "{0:+.1f} MB".format(change.growth / 1e6) if abs(change.growth) >= 50000 else ''
+        instruction = change.instruction if len(change.instruction) <= 70 else change.instruction[:67] + '...'
+        lines.append("{0} {1:>10} {2:>10}  {3}".format(
+            '!' if change.flagged else ' ', format_size(change.size), growth, instruction))
+    return lines
+
+
+def format_json(report):
+    return [json.dumps(report.as_dict(), indent=2, sort_keys=True, separators=(',', ': '))]
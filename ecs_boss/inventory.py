@@ -0,0 +1,90 @@
+"""
+Stream a compact inventory of the services in one or more clusters
+
+Services are listed 100 at a time and described in concurrent batches of
+10, those of the next pages and clusters while the rows of the first ones are
+written. Each distinct task definition is described once and reduced to the
+few fields the inventory needs, so memory use doesn't grow with the size of
+the API payloads.
+"""
+import csv
+import json
+from collections import deque, namedtuple
+from functools import partial
+
+from .ecs import DESCRIBE_SERVICES_MAX, chunked
+
+InventoryRow = namedtuple('InventoryRow', [
+    'cluster', 'service', 'family', 'revision', 'image',
+    'desired', 'running', 'pending', 'cpu', 'memory'])
+
+TaskDefinitionSummary = namedtuple('TaskDefinitionSummary', ['family', 'revision', 'image', 'cpu', 'memory'])
+
+
+def summarize_task_definition(ecs_client, task_definition_arn):
+    """
+    Describe the task definition and keep only what the inventory needs
+    """
+    task_def = ecs_client.describe_task_definition(task_definition_arn)
+    containers = task_def.containers
+    cpu = task_def.get('cpu') or sum([c.get('cpu', 0) for c in containers])
+    memory = task_def.get('memory') or sum([c.get('memory') or c.get('memoryReservation') or 0 for c in containers])
+    image = " ".join([c['image'] for c in containers])
+    return TaskDefinitionSummary(task_def.family, task_def.revision, image, int(cpu), int(memory))
+
+
+def iter_service_arn_pages(ecs_client, clusters):
+    """
+    Yield (cluster, service ARNs) for each page of services of the clusters
+    """
+    for cluster in clusters:
+        for service_arns in ecs_client.iter_service_arn_pages(cluster):
+            yield cluster, service_arns
+
+
+def iter_inventory(ecs_client, clusters, concurrency=8):
+    """
+    Yield an InventoryRow for every service in the clusters
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    summaries = {}
+    summarize = partial(summarize_task_definition, ecs_client)
+
+    def rows(cluster_name, future):
+        services = future.result()['services']
+        for arn in set([s['taskDefinition'] for s in services]) - set(summaries):
+            summaries[arn] = executor.submit(summarize, arn)
+        for service in services:
+            summary = summaries[service['taskDefinition']].result()
+            yield InventoryRow(
+                cluster_name, service['serviceName'], summary.family, summary.revision, summary.image,
+                service['desiredCount'], service['runningCount'], service['pendingCount'],
+                summary.cpu, summary.memory)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # The batches of every cluster are described as soon as they are listed, and the rows
+        # of the oldest ones are written while the pool works on the next
+        batches = deque()
+        for cluster, service_arns in iter_service_arn_pages(ecs_client, clusters):
+            for chunk in chunked(service_arns, DESCRIBE_SERVICES_MAX):
+                batches.append((cluster.split('/')[-1], executor.submit(ecs_client.describe_services, cluster, chunk)))
+            while len(batches) > concurrency:
+                for row in rows(*batches.popleft()):
+                    yield row
+        while batches:
+            for row in rows(*batches.popleft()):
+                yield row
+
+
+def write_csv(rows, output):
+    writer = csv.writer(output)
+    writer.writerow(InventoryRow._fields)
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_ndjson(rows, output):
+    for row in rows:
+        output.write(json.dumps(dict(zip(row._fields, row)), sort_keys=True))
+        output.write('\n')
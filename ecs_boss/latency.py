@@ -0,0 +1,186 @@
+"""
+Measure how long tasks take to launch
+
+describe_tasks reports when each task was created, when its image pull started
+and stopped, and when it started. A launch is split into phases:
+
+- provisioning: createdAt to pullStartedAt (placement, network interfaces)
+- pull: pullStartedAt to pullStoppedAt
+- start: pullStoppedAt to startedAt
+- total: createdAt to startedAt
+
+A task without pull timestamps (its image was already on the instance) only
+counts towards the total. The 50th, 90th and 99th percentiles of each phase are
+written as text, JSON or a Prometheus textfile.
+"""
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+import click
+
+PHASES = OrderedDict([
+    ('provisioning', ('createdAt', 'pullStartedAt')),
+    ('pull', ('pullStartedAt', 'pullStoppedAt')),
+    ('start', ('pullStoppedAt', 'startedAt')),
+    ('total', ('createdAt', 'startedAt')),
+])
+PERCENTILES = (50, 90, 99)
+METRIC = 'ecs_boss_task_launch_seconds'
+
+
+def task_phases(task):
+    """
+    Return the seconds a task spent in each phase it has timestamps for
+    """
+    phases = {}
+    for phase, (start, end) in PHASES.items():
+        if task.get(start) and task.get(end):
+            seconds = (task[end] - task[start]).total_seconds()
+            if seconds >= 0:
+                phases[phase] = seconds
+    return phases
+
+
+def percentile(values, percent):
+    """
+    The nearest-rank percentile of sorted values
+    """
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def summarize(tasks):
+    """
+    Return the number of tasks and the percentiles, maximum, sum and count of
+    each phase
+    """
+    seconds = OrderedDict([(phase, []) for phase in PHASES])
+    for task in tasks:
+        for phase, value in task_phases(task).items():
+            seconds[phase].append(value)
+
+    phases = OrderedDict()
+    for phase, values in seconds.items():
+        if not values:
+            continue
+        values.sort()
+        stats = OrderedDict([('p{0}'.format(p), percentile(values, p)) for p in PERCENTILES])
+        stats['max'] = values[-1]
+        stats['sum'] = sum(values)
+        stats['count'] = len(values)
+        phases[phase] = stats
+    task_definitions = sorted(set([task['taskDefinitionArn'].split('/')[-1] for task in tasks]))
+    return OrderedDict([('tasks', len(tasks)), ('task_definitions', task_definitions), ('phases', phases)])
+
+
+def collect_tasks(ecs_client, cluster, service_name=None, started_by=None):
+    """
+    Describe the running and stopped tasks of a service or started by
+    `started_by` (a deployment or run id) that have started
+    """
+    task_arns = []
+    for desired_status in ('RUNNING', 'STOPPED'):
+        task_arns.extend(ecs_client.list_task_arns(cluster, service_name, started_by, desired_status))
+    if not task_arns:
+        return []
+    return [task for task in ecs_client.describe_tasks(cluster, task_arns)['tasks'] if task.get('startedAt')]
+
+
+def get_primary_deployment_id(ecs_client, cluster, service_name):
+    response = ecs_client.describe_services(cluster, service_name)
+    if not response['services']:
+        raise click.ClickException("The service {0} doesn't exist in {1}.".format(service_name, cluster))
+    primary = [d for d in response['services'][0]['deployments'] if d['status'] == 'PRIMARY']
+    return primary[0]['id'] if primary else None
+
+
+def wait_for_tasks(ecs_client, cluster, started_by, count, timeout=90, poll_time=2):
+    """
+    Wait until `count` tasks started by `started_by` have started, or the
+    timeout passes. Returns the started tasks
+    """
+    start = time.time()
+    while True:
+        tasks = collect_tasks(ecs_client, cluster, started_by=started_by)
+        if len(tasks) >= count or time.time() - start >= timeout:
+            return tasks
+        time.sleep(poll_time)
+
+
+def format_text(summary):
+    if not summary['phases']:
+        return ["No started tasks to measure."]
+    lines = ["Launch latency of {0} tasks ({1}), in seconds:".format(
+        summary['tasks'], ", ".join(summary['task_definitions']))]
+    columns = ['p{0}'.format(p) for p in PERCENTILES] + ['max']
+    lines.append("{0:<14}".format('phase') + "".join(["{0:>9}".format(c) for c in columns]) + "{0:>7}".format('tasks'))
+    for phase, stats in summary['phases'].items():
+        lines.append("{0:<14}".format(phase) + "".join(["{0:>9.1f}".format(stats[c]) for c in columns]) +
+                     "{0:>7}".format(stats['count']))
+    return lines
+
+
+def format_json(summary):
+    return [json.dumps(summary, indent=2)]
+
+
+def prometheus_labels(labels):
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels.items()]
+    return ",".join(['{0}="{1}"'.format(name, value) for name, value in escaped])
+
+
+def format_prometheus(summary, labels):
+    """
+    Format the summary as a Prometheus summary metric with a `phase` label
+    """
+    lines = [
+        "# HELP {0} Seconds ECS tasks spent in each phase of their launch.".format(METRIC),
+        "# TYPE {0} summary".format(METRIC),
+    ]
+    if len(summary['task_definitions']) == 1:
+        labels = OrderedDict(labels, task_definition=summary['task_definitions'][0])
+    for phase, stats in summary['phases'].items():
+        phase_labels = OrderedDict(labels, phase=phase)
+        for p in PERCENTILES:
+            quantile_labels = prometheus_labels(OrderedDict(phase_labels, quantile=p / 100.0))
+            lines.append("{0}{{{1}}} {2}".format(METRIC, quantile_labels, stats['p{0}'.format(p)]))
+        lines.append("{0}_sum{{{1}}} {2}".format(METRIC, prometheus_labels(phase_labels), stats['sum']))
+        lines.append("{0}_count{{{1}}} {2}".format(METRIC, prometheus_labels(phase_labels), stats['count']))
+    return lines
+
+
+def format_for_path(path):
+    """
+    Choose the format of a report from its file name
+    """
+    if path.endswith('.prom'):
+        return 'prometheus'
+    if path.endswith('.json'):
+        return 'json'
+    return 'text'
+
+
+def write_report(summary, output='-', output_format='text', labels=None):
+    """
+    Write the summary to the terminal ('-') or a file. The file is replaced in
+    one step, so a Prometheus textfile collector never reads half of it
+    """
+    if output_format == 'prometheus':
+        lines = format_prometheus(summary, labels or OrderedDict())
+    elif output_format == 'json':
+        lines = format_json(summary)
+    else:
+        lines = format_text(summary)
+
+    if output == '-':
+        click.echo("\n".join(lines))
+        return
+    temp_path = "{0}.{1}.tmp".format(output, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.rename(temp_path, output)
+    click.echo("Wrote the launch latency of {0} tasks to {1}".format(summary['tasks'], output))
@@ -0,0 +1,446 @@
+"""
+Run a task definition on this machine with docker run
+
+Each container of the task definition becomes a docker container named
+<family>-<container> with the options ECS would give it:
+
+- cpu becomes --cpu-shares and memory and memoryReservation the hard and soft
+  memory limits. A task-level cpu or memory limits each container, as docker
+  can't limit containers together
+- in bridge mode the containers join a docker network, where links are
+  aliases. In awsvpc mode they share the network namespace of a pause
+  container, so they reach each other on localhost as they do in ECS, and the
+  pause container publishes their ports. In host mode they use the host's
+  network
+- port mappings without a host port get the container port in awsvpc and host
+  mode, and a random port in bridge mode, like ECS
+- volumes with a host sourcePath are bind mounts (a relative path is taken
+  from the current directory), other volumes are docker volumes named
+  <family>-<volume>
+- health checks, entry points, commands, users, working directories,
+  ulimits, labels and extra hosts are passed on
+
+Secrets are fetched from Parameter Store and Secrets Manager and passed as
+environment variables, as the ECS agent does when it starts a task. docker run
+gets the names of the variables and reads their values from its own
+environment, so they don't show on its command line.
+
+Containers start at the same time unless they depend on others: a link or a
+dependsOn START waits for the other container to start, HEALTHY for it to be
+healthy, COMPLETE for it to exit and SUCCESS for it to exit with 0. Like ECS,
+the task stops when one of its essential containers exits.
+"""
+import json
+import os
+import threading
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+import click
+
+from .process import caller_context, worker_context
+
+NETWORK_PREFIX = 'ecs-boss-'
+PAUSE_IMAGE = 'registry.k8s.io/pause:3.9'
+PAUSE_SUFFIX = '-pause'
+HEALTH_POLL_TIME = 1  # seconds
+DEPENDENCY_CONDITIONS = ('START', 'COMPLETE', 'SUCCESS', 'HEALTHY')
+
+
+def cpu_units(value):
+    """
+    The cpu units of a task-level cpu, e.g. 512, "512" or "0.5 vCPU"
+    """
+    text = str(value).strip().lower()
+    if text.endswith('vcpu'):
+        return int(float(text[:-len('vcpu')]) * 1024)
+    return int(float(text))
+
+
+def memory_mib(value):
+    """
+    The MiB of a task-level memory, e.g. 1024, "1024" or "1 GB"
+    """
+    text = str(value).strip().lower()
+    if text.endswith('gb'):
+        return int(float(text[:-len('gb')]) * 1024)
+    if text.endswith('mb'):
+        text = text[:-len('mb')]
+    return int(float(text))
+
+
+def parameter_name(value_from):
+    """
+    The name of a Parameter Store parameter given by name or ARN
+    """
+    if not value_from.startswith('arn:'):
+        return value_from
+    name = value_from.split(':parameter', 1)[1]
+    return name if name.count('/') > 1 else name[1:]  # Only names with a path keep their slash
+
+
+def secret_value(value_from, parameters, secrets_client):
+    """
+    The value of a container secret: a parameter, a secret or a key of a
+    JSON secret
+    """
+    if ':secretsmanager:' not in value_from:
+        name = parameter_name(value_from)
+        if name not in parameters:
+            raise click.ClickException("Couldn't find the parameter {0}.".format(name))
+        return parameters[name]['Value']
+    parts = value_from.split(':')
+    secret_id, json_key = ':'.join(parts[:7]), parts[7] if len(parts) > 7 else ''
+    secret = secrets_client.get_secret(secret_id, True)
+    if secret is None:
+        raise click.ClickException("Couldn't find the secret {0}.".format(secret_id))
+    if not json_key:
+        return secret.get('SecretString')
+    try:
+        return json.loads(secret['SecretString'])[json_key]
+    except (ValueError, KeyError):
+        raise click.ClickException("The secret {0} has no JSON key {1}.".format(secret_id, json_key))
+
+
+def resolve_secrets(task_def, ssm_client, secrets_client):
+    """
+    Move the secrets of each container to its environment with their values,
+    in place
+    """
+    containers = [c for c in task_def['containerDefinitions'] if c.get('secrets')]
+    names = [parameter_name(s['valueFrom']) for c in containers for s in c['secrets']
+             if ':secretsmanager:' not in s['valueFrom']]
+    parameters = ssm_client.get_parameters(names) if names else {}
+    for container in containers:
+        environment = container.setdefault('environment', [])
+        for secret in container.pop('secrets'):
+            environment.append({'name': secret['name'],
+                                'value': secret_value(secret['valueFrom'], parameters, secrets_client)})
+
+
+def has_secrets(task_def):
+    return any([c.get('secrets') for c in task_def['containerDefinitions']])
+
+
+def health_check_args(health_check):
+    command = health_check['command']
+    if command[0] == 'CMD-SHELL':
+        args = ['--health-cmd', " ".join(command[1:])]
+    else:  # docker run only takes a shell command
+        args = ['--health-cmd', " ".join([quote(arg) for arg in command[command[0] == 'CMD':]])]
+    for key, option in (('interval', '--health-interval'), ('timeout', '--health-timeout'),
+                        ('startPeriod', '--health-start-period')):
+        if key in health_check:
+            args.extend([option, '{0}s'.format(health_check[key])])
+    if 'retries' in health_check:
+        args.extend(['--health-retries', str(health_check['retries'])])
+    return args
+
+
+class LocalTask(object):
+    """
+    The containers of a task definition, run with docker
+    """
+    def __init__(self, task_def, network=None):
+        self.task_def = task_def
+        self.family = task_def['family']
+        self.network_mode = task_def.get('networkMode') or 'bridge'
+        self.network = network or NETWORK_PREFIX + self.family
+        self.containers = task_def['containerDefinitions']
+        self.names = [c['name'] for c in self.containers]
+        self.started = dict([(name, threading.Event()) for name in self.names])
+        self.errors = {}
+        self.validate()
+
+    def docker_name(self, name):
+        return "{0}-{1}".format(self.family, name)
+
+    @property
+    def pause_name(self):
+        return self.family + PAUSE_SUFFIX
+
+    def dependencies(self, container):
+        """
+        The containers `container` waits for, with the condition
+        """
+        dependencies = [(d['containerName'], d['condition']) for d in container.get('dependsOn', [])]
+        for link in container.get('links', []):
+            dependencies.append((link.split(':')[0], 'START'))
+        return dependencies
+
+    def validate(self):
+        by_name = dict([(c['name'], c) for c in self.containers])
+        for container in self.containers:
+            for name, condition in self.dependencies(container):
+                if name not in by_name:
+                    raise click.ClickException("{0} depends on {1}, which isn't in the task definition.".format(
+                        container['name'], name))
+                if condition not in DEPENDENCY_CONDITIONS:
+                    raise click.ClickException("{0} depends on {1} with the unknown condition {2}.".format(
+                        container['name'], name, condition))
+                if condition == 'HEALTHY' and not by_name[name].get('healthCheck'):
+                    raise click.ClickException("{0} waits for {1} to be healthy, but it has no health check.".format(
+                        container['name'], name))
+
+        # Every container must be reachable without going round a cycle
+        visiting, done = set(), set()
+
+        def visit(name, path):
+            if name in done:
+                return
+            if name in visiting:
+                raise click.ClickException("The containers depend on each other: {0}.".format(
+                    " -> ".join(path + [name])))
+            visiting.add(name)
+            for dependency, _ in self.dependencies(by_name[name]):
+                visit(dependency, path + [name])
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.names:
+            visit(name, [])
+
+    def host_path(self, path):
+        from .api import local_path
+
+        return os.path.abspath(local_path(path))
+
+    def volume_args(self, container):
+        volumes = dict([(v['name'], v) for v in self.task_def.get('volumes', [])])
+        args = []
+        for mount in container.get('mountPoints', []):
+            volume = volumes.get(mount['sourceVolume'])
+            if volume is None:
+                raise click.ClickException("{0} mounts the volume {1}, which isn't in the task definition.".format(
+                    container['name'], mount['sourceVolume']))
+            source_path = (volume.get('host') or {}).get('sourcePath')
+            source = self.host_path(source_path) if source_path else self.docker_name(volume['name'])
+            target = "{0}:{1}".format(source, mount['containerPath'])
+            args.extend(['-v', target + (':ro' if mount.get('readOnly') else '')])
+        for volumes_from in container.get('volumesFrom', []):
+            source = self.docker_name(volumes_from['sourceContainer'])
+            args.extend(['--volumes-from', source + (':ro' if volumes_from.get('readOnly') else '')])
+        return args
+
+    def port_args(self, container):
+        args = []
+        for mapping in container.get('portMappings', []):
+            host_port = mapping.get('hostPort') or (mapping['containerPort'] if self.network_mode == 'awsvpc' else None)
+            port = "{0}/{1}".format(mapping['containerPort'], mapping.get('protocol', 'tcp'))
+            args.extend(['-p', "{0}:{1}".format(host_port, port) if host_port else port])
+        return args
+
+    def network_args(self, container):
+        if self.network_mode == 'host':
+            return ['--network', 'host']
+        if self.network_mode == 'awsvpc':
+            return ['--network', 'container:' + self.pause_name]
+        args = ['--network', self.network, '--network-alias', container['name']] + self.port_args(container)
+        for link in container.get('links', []):
+            name, _, alias = link.partition(':')
+            args.extend(['--link', "{0}:{1}".format(self.docker_name(name), alias or name)])
+        if container.get('hostname'):
+            args.extend(['--hostname', container['hostname']])
+        return args
+
+    def resource_args(self, container):
+        args = []
+        if container.get('cpu'):
+            args.extend(['--cpu-shares', str(max(container['cpu'], 2))])
+        if self.task_def.get('cpu'):
+            args.extend(['--cpus', '{0:g}'.format(cpu_units(self.task_def['cpu']) / 1024.0)])
+        memory = container.get('memory') or (memory_mib(self.task_def['memory']) if self.task_def.get('memory')
+                                             else None)
+        if memory:
+            args.extend(['--memory', '{0}m'.format(memory)])
+        if container.get('memoryReservation'):
+            args.extend(['--memory-reservation', '{0}m'.format(container['memoryReservation'])])
+        return args
+
+    def run_args(self, container):
+        """
+        The docker run command of a container. The values of its environment
+        variables, which may be secrets, aren't on it: they are in
+        container_env
+        """
+        args = ['docker', 'run', '-d', '--name', self.docker_name(container['name'])]
+        args.extend(self.network_args(container))
+        args.extend(self.resource_args(container))
+        args.extend(self.volume_args(container))
+        for variable in container.get('environment', []):
+            args.extend(['-e', variable['name']])  # The value comes from docker run's environment
+        if container.get('healthCheck'):
+            args.extend(health_check_args(container['healthCheck']))
+        for ulimit in container.get('ulimits', []):
+            args.extend(['--ulimit', "{0}={1}:{2}".format(ulimit['name'], ulimit['softLimit'], ulimit['hardLimit'])])
+        for key, value in sorted(container.get('dockerLabels', {}).items()):
+            args.extend(['--label', "{0}={1}".format(key, value)])
+        for host in container.get('extraHosts', []):
+            args.extend(['--add-host', "{0}:{1}".format(host['hostname'], host['ipAddress'])])
+        for key, option in (('workingDirectory', '-w'), ('user', '-u'), ('stopTimeout', '--stop-timeout')):
+            if container.get(key):
+                args.extend([option, str(container[key])])
+        if container.get('privileged'):
+            args.append('--privileged')
+        if container.get('readonlyRootFilesystem'):
+            args.append('--read-only')
+        if (container.get('linuxParameters') or {}).get('initProcessEnabled'):
+            args.append('--init')
+
+        entry_point = container.get('entryPoint') or []
+        if entry_point:
+            args.extend(['--entrypoint', entry_point[0]])
+        return args + [container['image']] + entry_point[1:] + (container.get('command') or [])
+
+    def container_env(self, container):
+        """
+        The environment docker run passes on to the container
+        """
+        return dict([(variable['name'], variable['value']) for variable in container.get('environment', [])])
+
+    def inspect(self, docker_name, template):
+        from .api import run_command
+
+        return run_command(['docker', 'inspect', '--format', template, docker_name]).output.strip()
+
+    def wait_exit(self, name):
+        """
+        Wait for a container to exit and return its exit code
+        """
+        from .api import run_command
+
+        exit_code = run_command(['docker', 'wait', self.docker_name(name)]).output.strip()
+        return int(exit_code) if exit_code.isdigit() else 1
+
+    def wait_for(self, container, name, condition):
+        """
+        Wait until the container `name` meets the condition `container`
+        depends on
+        """
+        self.started[name].wait()
+        if name in self.errors:
+            raise click.ClickException("{0} didn't start because {1} didn't.".format(container['name'], name))
+        if condition in ('COMPLETE', 'SUCCESS'):
+            exit_code = self.wait_exit(name)
+            if condition == 'SUCCESS' and exit_code != 0:
+                raise click.ClickException("{0} didn't start because {1} exited with {2}.".format(
+                    container['name'], name, exit_code))
+        elif condition == 'HEALTHY':
+            while True:
+                state = self.inspect(self.docker_name(name), '{{.State.Health.Status}} {{.State.Status}}')
+                health, _, status = state.partition(' ')
+                if health == 'healthy':
+                    return
+                if health == 'unhealthy' or status in ('exited', 'dead'):
+                    raise click.ClickException("{0} didn't start because {1} is {2}.".format(
+                        container['name'], name, 'unhealthy' if health == 'unhealthy' else status))
+                time.sleep(HEALTH_POLL_TIME)
+
+    def start_container(self, container):
+        from .api import run_command
+
+        try:
+            for name, condition in self.dependencies(container):
+                self.wait_for(container, name, condition)
+            run_command(self.run_args(container), check=True, env=self.container_env(container))
+            click.echo("Started {0}.".format(self.docker_name(container['name'])))
+        except Exception as e:
+            self.errors[container['name']] = e
+            raise
+        finally:
+            self.started[container['name']].set()
+
+    def prepare(self):
+        """
+        Remove the containers of an earlier run and create the network or the
+        pause container
+        """
+        from .api import command_succeeds, run_command
+
+        self.remove()
+        if self.network_mode == 'bridge' and not command_succeeds(['docker', 'network', 'inspect', self.network]):
+            run_command(['docker', 'network', 'create', self.network], check=True)
+        elif self.network_mode == 'awsvpc':
+            ports = [arg for container in self.containers for arg in self.port_args(container)]
+            run_command(['docker', 'run', '-d', '--name', self.pause_name] + ports + [PAUSE_IMAGE], check=True)
+
+    def start(self):
+        """
+        Start the containers, each once the containers it depends on are
+        ready
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.prepare()
+        context = caller_context()
+
+        def start(container):
+            with worker_context(context):
+                return self.start_container(container)
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.containers)) as executor:
+                list(executor.map(start, self.containers))
+        except Exception:
+            self.remove()
+            raise
+        # In awsvpc mode the pause container publishes the ports of all the containers
+        published = [self.pause_name] if self.network_mode == 'awsvpc' else [
+            self.docker_name(c['name']) for c in self.containers if c.get('portMappings')]
+        for docker_name in published:
+            ports = self.inspect(docker_name, '{{range $p, $b := .NetworkSettings.Ports}}{{range $b}}'
+                                 '{{$p}}->{{.HostPort}} {{end}}{{end}}')
+            if ports:
+                click.echo("{0}: {1}".format(docker_name, ports))
+
+    def follow(self):
+        """
+        Show the output of every container until an essential container
+        exits, then remove them all. Returns the exit code of the essential
+        container
+        """
+        from .api import run_command
+
+        context = caller_context()
+        exits = []
+        exited = threading.Event()
+
+        def show_logs(name):
+            with worker_context(context, "[{0}] ".format(name)):
+                run_command(['docker', 'logs', '-f', self.docker_name(name)], echo=True)
+
+        def wait(name):
+            with worker_context(context):
+                exits.append((name, self.wait_exit(name)))
+            exited.set()
+
+        essential = [c['name'] for c in self.containers if c.get('essential', True)]
+        for target, names in ((show_logs, self.names), (wait, essential)):
+            for name in names:
+                thread = threading.Thread(target=target, args=(name,))
+                thread.daemon = True
+                thread.start()
+        try:
+            while not exited.wait(1):  # With a timeout, Ctrl-C still works on Python 2
+                pass
+        finally:
+            self.remove()
+        name, exit_code = exits[0]
+        click.echo("{0} exited with {1}, so the task stopped.".format(self.docker_name(name), exit_code))
+        return exit_code
+
+    @property
+    def docker_names(self):
+        names = [self.docker_name(name) for name in self.names]
+        if self.network_mode == 'awsvpc':
+            names.append(self.pause_name)
+        return names
+
+    def remove(self):
+        from .api import command_succeeds
+
+        command_succeeds(['docker', 'rm', '-f', '-v'] + self.docker_names)
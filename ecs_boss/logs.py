@@ -0,0 +1,269 @@
+"""
+Export CloudWatch logs to compressed, newline-delimited JSON files
+
+Every log stream (or log group query) is exported to its own file, one page
+at a time. Each page is written as a complete gzip member or zstd frame, and
+the file size and page token are saved to a state file afterwards. An
+interrupted export truncates any partial page and picks up where it left off.
+
+The stream of a task that was still running when its export finished may get
+more events. Its last page token is kept, and the next export checks it for
+new events, until the task has stopped.
+"""
+import io
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+import click
+
+from .process import caller_context, worker_context
+
+# The most events CloudWatch returns in a single page
+MAX_PAGE_SIZE = 10000
+WRITE_BUFFER_SIZE = 1024 * 1024
+COMPRESSION_EXTENSIONS = {
+    'gzip': '.ndjson.gz',
+    'zstd': '.ndjson.zst',
+    'none': '.ndjson',
+}
+EPOCH = datetime(1970, 1, 1)
+RELATIVE_TIME_RE = re.compile(r'^(\d+)([smhd])$')
+RELATIVE_TIME_UNITS = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+
+
+def parse_time(value):
+    """
+    Convert an ISO date/time (UTC) or a relative time like '90m', '2h' or '7d'
+    ago into milliseconds since the epoch
+    """
+    if value is None:
+        return None
+    match = RELATIVE_TIME_RE.match(value)
+    if match:
+        delta = timedelta(**{RELATIVE_TIME_UNITS[match.group(2)]: int(match.group(1))})
+        moment = datetime.utcnow() - delta
+    else:
+        for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+            try:
+                moment = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise click.ClickException("Can't understand the time '{0}'. Use YYYY-MM-DD[THH:MM[:SS]] or "
+                                       "a relative time like 2h.".format(value))
+    return int((moment - EPOCH).total_seconds() * 1000)
+
+
+def get_compressor(compression):
+    """
+    Return a function that compresses a page of bytes into a self-contained
+    gzip member or zstd frame
+    """
+    if compression == 'gzip':
+        import gzip
+
+        def compress(data):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+                gz.write(data)
+            return buf.getvalue()
+        return compress
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise click.ClickException("zstd compression requires the zstandard package: pip install zstandard")
+        # Compressors aren't thread-safe, and the pages of several streams are compressed at the same time
+        return lambda data: zstandard.ZstdCompressor().compress(data)
+    return lambda data: data
+
+
+class ExportState(object):
+    """
+    The progress of every export job, saved to a JSON file after each page
+    """
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.jobs = {}
+        self._lock = threading.Lock()
+        if not restart and os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f)
+
+    def get(self, key):
+        with self._lock:
+            return dict(self.jobs.get(key, {'token': None, 'offset': 0, 'events': 0, 'done': False}))
+
+    def update(self, key, **kwargs):
+        with self._lock:
+            self.jobs.setdefault(key, {}).update(kwargs)
+            tmp_path = "{0}.tmp".format(self.path)
+            with open(tmp_path, 'w') as f:
+                json.dump(self.jobs, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+
+
+class ExportJob(object):
+    """
+    Export one log stream, or all the events in a log group matching a filter
+    """
+    def __init__(self, log_group, log_stream=None, start_time=None, end_time=None, stream_prefix=None, final=True):
+        self.log_group = log_group
+        self.log_stream = log_stream
+        self.start_time = start_time
+        self.end_time = end_time
+        self.stream_prefix = stream_prefix
+        self.final = final  # False while the task logging to the stream is still running
+
+    @property
+    def key(self):
+        if self.log_stream:
+            return "{0}:{1}".format(self.log_group, self.log_stream)
+        return "{0}:{1}:{2}-{3}".format(self.log_group, self.stream_prefix or '*', self.start_time, self.end_time)
+
+    @property
+    def file_name(self):
+        return re.sub(r'[^A-Za-z0-9._-]+', '_', self.key).strip('_')
+
+    def fetch_page(self, log_client, token):
+        """
+        Return the events of the page starting at `token` and the token of the
+        next page, or None if this is the last page
+        """
+        kwargs = {'limit': MAX_PAGE_SIZE}
+        if self.start_time is not None:
+            kwargs['startTime'] = self.start_time
+        if self.end_time is not None:
+            kwargs['endTime'] = self.end_time
+
+        if self.log_stream:
+            if token is not None:
+                kwargs['nextToken'] = token
+            else:
+                kwargs['startFromHead'] = True
+            response = log_client.get_log_events(self.log_group, self.log_stream, **kwargs)
+            next_token = response['nextForwardToken']
+            # The stream is finished when the same token comes back
+            return response['events'], next_token if next_token != token else None
+
+        if token is not None:
+            kwargs['nextToken'] = token
+        if self.stream_prefix:
+            kwargs['logStreamNamePrefix'] = self.stream_prefix
+        response = log_client.filter_log_events(self.log_group, **kwargs)
+        return response['events'], response.get('nextToken')
+
+    def format_event(self, event):
+        record = {
+            'logGroup': self.log_group,
+            'logStream': event.get('logStreamName', self.log_stream),
+            'timestamp': event['timestamp'],
+            'ingestionTime': event.get('ingestionTime'),
+            'message': event['message'],
+        }
+        return json.dumps(record, sort_keys=True).encode('utf-8') + b'\n'
+
+
+class LogExporter(object):
+    """
+    Export many jobs in parallel, resuming from the state file
+    """
+    def __init__(self, log_client, output_dir, compression='gzip', state_file=None, restart=False, concurrency=4):
+        self.log_client = log_client
+        self.output_dir = output_dir
+        self.compression = compression
+        self.compress = get_compressor(compression)
+        self.state = ExportState(state_file or os.path.join(output_dir, 'export-state.json'), restart)
+        self.concurrency = concurrency
+
+    def export(self, jobs):
+        """
+        Run all the jobs. Returns a list of (job, error) for the jobs that failed
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        context = caller_context()
+
+        def export_job(job):
+            with worker_context(context):
+                return self.export_job(job)
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [(job, executor.submit(export_job, job)) for job in jobs]
+            for job, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    click.echo("Failed exporting {0}: {1}".format(job.key, e))
+                    errors.append((job, e))
+        return errors
+
+    def export_job(self, job):
+        progress = self.state.get(job.key)
+        if progress['done'] and progress.get('final', True):
+            click.echo("Already exported {0}".format(job.key))
+            return
+        if progress['done']:
+            click.echo("Checking {0} for events logged since it was exported".format(job.key))
+        elif progress['token']:
+            click.echo("Resuming {0} after {1} events".format(job.key, progress['events']))
+
+        path = os.path.join(self.output_dir, job.file_name + COMPRESSION_EXTENSIONS[self.compression])
+        if os.path.exists(path):
+            # Drop anything written after the last checkpoint
+            with io.open(path, 'r+b') as f:
+                f.truncate(progress['offset'])
+
+        token = progress['token']
+        events = progress['events']
+        with io.open(path, 'ab', buffering=WRITE_BUFFER_SIZE) as out:
+            while True:
+                page, next_token = job.fetch_page(self.log_client, token)
+                if page:
+                    out.write(self.compress(b''.join([job.format_event(e) for e in page])))
+                    out.flush()
+                    events += len(page)
+                done = next_token is None
+                if not done or not job.log_stream:
+                    token = next_token  # A stream's last token is kept to check it for new events
+                self.state.update(job.key, token=token, offset=out.tell(), events=events, done=done,
+                                  final=job.final)
+                if done:
+                    break
+        click.echo("Exported {0} events from {1} to {2}".format(events, job.key, path))
+
+
+def get_task_jobs(ecs_client, cluster, task_arns, container_name=None, start_time=None, end_time=None):
+    """
+    Return an export job for each container log stream of the tasks
+    """
+    from .api import get_log_stream_name
+
+    jobs = []
+    task_defs = {}
+    tasks = ecs_client.describe_tasks(cluster, task_arns)
+    for failure in tasks['failures']:
+        click.echo("Skipping task {0}: {1}".format(failure['arn'], failure['reason']))
+    for task in tasks['tasks']:
+        task_def_arn = task['taskDefinitionArn']
+        if task_def_arn not in task_defs:
+            task_defs[task_def_arn] = ecs_client.describe_task_definition(task_def_arn)
+        task_id = task['taskArn'].split('/')[-1]
+        for container in task_defs[task_def_arn].containers:
+            if container_name and container['name'] != container_name:
+                continue
+            log_group, log_stream = get_log_stream_name(container.get('logConfiguration'), container['name'], task_id)
+            if log_stream is None:
+                click.echo("Container {0} of task {1} doesn't log to CloudWatch with a stream prefix.".format(
+                    container['name'], task_id))
+                continue
+            jobs.append(ExportJob(log_group, log_stream, start_time, end_time, final=task['lastStatus'] == 'STOPPED'))
+    return jobs
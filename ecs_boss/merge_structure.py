@@ -29,6 +29,15 @@ def merge_containerDefinitions(d, u):  # NOQA
         name = item['name']
         d_index[name] = recursive_update(d_index.get(name, {}), item)
 
+        # A variable is either in the environment or a secret, as the local definition says
+        merged = d_index[name]
+        secret_names = set([x['name'] for x in item.get('secrets', [])])
+        environment_names = set([x['name'] for x in item.get('environment', [])])
+        if 'environment' in merged:
+            merged['environment'] = [x for x in merged['environment'] if x['name'] not in secret_names]
+        if 'secrets' in merged:
+            merged['secrets'] = [x for x in merged['secrets'] if x['name'] not in environment_names]
+
     return d_index.values()
 
 
@@ -49,3 +58,103 @@ def recursive_update(d, u):
         else:
             d[k] = u[k]
     return d
+
+
+def diff_environment(d, u, path):
+    """
+    List the environment variables in `u` whose values are different in `d`
+    """
+    d_index = dict([(x['name'], x['value']) for x in d])
+    changes = []
+    for item in u:
+        if d_index.get(item['name']) != item['value']:
+            changes.append(("{0}.{1}".format(path, item['name']), d_index.get(item['name']), item['value']))
+    return changes
+
+
+def diff_secrets(d, u, path):
+    """
+    List the secrets in `u` whose references are different in `d`
+    """
+    d_index = dict([(x['name'], x['valueFrom']) for x in d])
+    changes = []
+    for item in u:
+        if d_index.get(item['name']) != item['valueFrom']:
+            changes.append(("{0}.{1}".format(path, item['name']), d_index.get(item['name']), item['valueFrom']))
+    return changes
+
+
+def diff_subnets(d, u, path):
+    """
+    Compare lists whose order doesn't matter
+    """
+    if sorted(d) != sorted(u):
+        return [(path, d, u)]
+    return []
+
+
+diff_securityGroups = diff_subnets  # NOQA
+
+
+def diff_list(d, u, path):
+    """
+    Compare a list of structures, like portMappings, in any order. An item of
+    `u` matches one of `d` that has the same values for the keys it sets, so
+    the defaults ECS fills in aren't changes. The items left are compared in
+    order when there are as many on each side
+    """
+    if not all([isinstance(x, collections.Mapping) for x in d]):
+        return [(path, d, u)]
+    unmatched = list(d)
+    left = []
+    for i, item in enumerate(u):
+        matches = [x for x in unmatched if not recursive_diff(x, item)]
+        if matches:
+            unmatched.remove(matches[0])
+        else:
+            left.append((i, item))
+    if len(d) != len(u):
+        return [(path, d, u)]
+    changes = []
+    for (i, u_item), d_item in zip(left, unmatched):
+        changes.extend(recursive_diff(d_item, u_item, "{0}[{1}]".format(path, i)))
+    return changes
+
+
+def diff_containerDefinitions(d, u, path):  # NOQA
+    """
+    List the differences of each container definition in `u`, matched by name
+    """
+    d_index = dict([(x['name'], x) for x in d])
+    changes = []
+    for item in u:
+        item_path = "{0}[{1}]".format(path, item['name'])
+        if item['name'] not in d_index:
+            changes.append((item_path, None, item))
+        else:
+            changes.extend(recursive_diff(d_index[item['name']], item, item_path))
+    return changes
+
+
+def recursive_diff(d, u, path=''):
+    """
+    List the changes `recursive_update(d, u)` would make as (path, old, new)
+
+    Looks for a `diff_<keyname>` function in globals() to compare the values,
+    matching the `merge_<keyname>` functions. Only the keys `u` sets are
+    compared, in lists of structures too.
+    """
+    changes = []
+    for k, v in u.items():
+        key_path = "{0}.{1}".format(path, k) if path else k
+        func_name = "diff_%s" % k
+        if func_name in globals():
+            changes.extend(globals()[func_name](d.get(k) or [], v, key_path))
+        elif isinstance(v, collections.Mapping) and isinstance(d.get(k), collections.Mapping):
+            changes.extend(recursive_diff(d[k], v, key_path))
+        elif (isinstance(v, list) and isinstance(d.get(k), list) and v and
+              all([isinstance(x, collections.Mapping) for x in v])):
+            changes.extend(diff_list(d[k], v, key_path))
+        elif d.get(k) != v:
+            changes.append((key_path, d.get(k), v))
+    return changes
@@ -0,0 +1,210 @@
+"""
+Deploy the same service to several regions at once
+
+The image is pushed to the repository of every region concurrently, or pushed
+once and copied to the other regions by ECR replication. Then the task
+definition and service are updated in every region in parallel, and each
+region is watched until its deployment is stable. With --watch, a region
+whose deployment fails is rolled back; without it, the region is left as it is
+and reported as unstable.
+"""
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+import click
+
+from .api import (create_or_update_service, create_or_update_task, docker_tag, get_repository_region,
+                  regional_repository)
+from .capacity import check_capacity
+from .compression import copy_compressed
+from .ecs import EcsTaskDefinition
+from .prepull import prepull_images
+from .process import caller_context, worker_context
+from .watchdog import RolloutWatchdog
+
+REPLICATION_TIMEOUT = 600
+REPLICATION_POLL_TIME = 10
+
+STABLE = 'stable'
+UNSTABLE = 'unstable'  # Failed without --watch, so not rolled back
+FAILED = 'failed'
+ROLLED_BACK = 'rolled back'
+SKIPPED = 'skipped'
+SUCCEEDED = (STABLE, )
+
+
+def regional_task_def(local_task_file, region):
+    """
+    Return a copy of the task definition that logs to CloudWatch in `region`
+    """
+    task_def = EcsTaskDefinition(deepcopy(local_task_file))
+    for container in task_def['containerDefinitions']:
+        options = (container.get('logConfiguration') or {}).get('options', {})
+        if 'awslogs-region' in options:
+            options['awslogs-region'] = region
+    return task_def
+
+
+def wait_for_replication(repositories, tag, get_ecr_client):
+    """
+    Wait until ECR has replicated the tagged image to every repository.
+    Returns the image digest of each region
+    """
+    start = time.time()
+    digests = {}
+    while True:
+        for region, repository in repositories.items():
+            if region not in digests:
+                digest = get_ecr_client(region).get_image_digest(repository, tag)
+                if digest:
+                    digests[region] = digest
+        pending = [region for region in repositories if region not in digests]
+        if not pending:
+            return digests
+        if time.time() - start >= REPLICATION_TIMEOUT:
+            raise click.ClickException("ECR didn't replicate {0} to {1} within {2} seconds.".format(
+                tag, ", ".join(pending), REPLICATION_TIMEOUT))
+        click.echo("Waiting for ECR to replicate {0} to {1}.".format(tag, ", ".join(pending)))
+        time.sleep(REPLICATION_POLL_TIME)
+
+
+def push_images(project_name, repository, tag, regions, get_ecr_client, replication=False, docker=None,
+                compression=None):
+    """
+    Push the image to the repository of every region at the same time. With
+    `replication`, push it to `repository` only and wait for ECR to copy it.
+    With `docker`, a DockerEngine, the Docker Engine API is used instead of
+    the CLI, and with `compression` BuildKit pushes recompressed layers to
+    the first region, which are copied to the others. Returns the image
+    digest of each region
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    repositories = OrderedDict([(region, regional_repository(repository, region)) for region in regions])
+    if replication:
+        source_region = get_repository_region(repository)
+        docker_tag(None, get_ecr_client(source_region), project_name, repository, tag, docker, compression)
+        return wait_for_replication(repositories, tag, get_ecr_client)
+
+    context = caller_context()
+
+    def push(region):
+        with worker_context(context, "[{0}] ".format(region)):
+            digest = docker_tag(None, get_ecr_client(region), project_name, repositories[region], tag, docker,
+                                compression)
+        return digest or get_ecr_client(region).get_image_digest(repositories[region], tag)
+
+    if compression is None:
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            return dict(zip(regions, executor.map(push, regions)))
+
+    # The layers are recompressed once, and the pushed image is copied to the other regions
+    digests = {regions[0]: push(regions[0])}
+    source_repository = repositories[regions[0]]
+
+    def copy(region):
+        with worker_context(context, "[{0}] ".format(region)):
+            ecr_client = get_ecr_client(region)
+            repository_name = repositories[region].split('/', 1)[1]
+            if ecr_client.has_tagged_image(repository_name, tag):
+                click.echo("Found tagged image in remote repository.")
+                return ecr_client.get_image_digest(repositories[region], tag)
+            return copy_compressed(ecr_client, source_repository, repositories[region], tag)
+
+    other_regions = regions[1:]
+    if other_regions:
+        with ThreadPoolExecutor(max_workers=len(other_regions)) as executor:
+            digests.update(zip(other_regions, executor.map(copy, other_regions)))
+    return digests
+
+
+def deploy_region(region, ecs_client, local_task_file, local_service_file, repository, tag,
+                  watch=False, max_failed_tasks=3, timeout=300, poll_time=2, preflight=False, prepull=False):
+    """
+    Register the task definition, update the service in one region and wait
+    for the deployment to be stable. With `watch`, a deployment that fails is
+    rolled back. With `preflight`, the service isn't updated if the region's
+    cluster doesn't have room for the tasks. With `prepull`, the region's
+    container instances pull the image first. Returns the result of the
+    region
+    """
+    task_definition = create_or_update_task(
+        ecs_client, regional_task_def(local_task_file, region), regional_repository(repository, region), tag)
+    result = {'status': FAILED, 'task_definition': task_definition.family_revision, 'message': ''}
+    if preflight:
+        report = check_capacity(ecs_client, local_service_file, task_definition)
+        if not report.ok:
+            result['message'] = " ".join(report.messages)
+            return result
+        for message in report.messages:
+            click.echo(message)
+    if prepull:
+        prepull_images(ecs_client, local_service_file['cluster'], task_definition)
+    service = create_or_update_service(ecs_client, deepcopy(local_service_file), task_definition)
+    if not service:
+        result['message'] = "The service doesn't exist."
+        return result
+    watchdog = RolloutWatchdog(ecs_client, service, max_failed_tasks, timeout, poll_time)
+    failure = watchdog.watch()
+    if failure is None:
+        result['status'] = STABLE
+        return result
+    result['message'] = failure
+    if not watch:
+        result['status'] = UNSTABLE
+    elif watchdog.rollback():
+        result['status'] = ROLLED_BACK
+    return result
+
+
+def deploy_regions(regions, deploy, fail_fast=False):
+    """
+    Call deploy(region) for every region in parallel and return the results
+    by region. With `fail_fast`, the first region is deployed on its own and
+    the other regions are skipped unless it succeeded
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    context = caller_context()
+
+    def run(region):
+        try:
+            with worker_context(context, "[{0}] ".format(region)):
+                return deploy(region)
+        except Exception as e:
+            click.echo("Deploying to {0} failed: {1}".format(region, e))
+            return {'status': FAILED, 'message': str(e)}
+
+    results = OrderedDict()
+    pending = list(regions)
+    if fail_fast and len(pending) > 1:
+        first = pending.pop(0)
+        click.echo("Deploying to {0} before the other regions.".format(first))
+        results[first] = run(first)
+        if results[first]['status'] not in SUCCEEDED:
+            for region in pending:
+                results[region] = {'status': SKIPPED, 'message': "{0} failed".format(first)}
+            return results
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            for region, result in zip(pending, executor.map(run, pending)):
+                results[region] = result
+    return OrderedDict([(region, results[region]) for region in regions])
+
+
+def format_results(results):
+    lines = []
+    for region, result in results.items():
+        line = "{0}: {1}".format(region, result['status'])
+        if result.get('task_definition'):
+            line += " ({0})".format(result['task_definition'])
+        if result.get('message'):
+            line += ": {0}".format(result['message'])
+        if result['status'] == UNSTABLE:
+            line += " (left as it is; --watch rolls back failed regions)"
+        lines.append(line)
+    stable = len([r for r in results.values() if r['status'] in SUCCEEDED])
+    lines.append("{0} of {1} regions are stable.".format(stable, len(results)))
+    return lines
@@ -0,0 +1,193 @@
+"""
+Fill in Parameter Store and Secrets Manager placeholders in task and service files
+
+Besides %REPOSITORY% and %RELEASE_TAG%, any string of a task or service file
+may use:
+
+- %SSM:/path/name% for the value of a parameter
+- %SECRET:name% for the value of a secret
+
+An environment variable whose value is %SSM:/path/*% becomes one variable
+per parameter directly under /path, named after the parameter with the
+variable's name as a prefix.
+
+The placeholders of all the files are collected first, so each parameter and
+secret is fetched once: the paths with get_parameters_by_path, then the other
+parameters with get_parameters, 10 per call, and the secrets concurrently.
+The clients keep what they fetched for a few minutes, which the server reuses
+between commands.
+
+SecureString parameters and secrets are secret. In "reference" mode, an
+environment variable whose whole value is one of them becomes a `secrets`
+entry with its ARN, so ECS injects the value when the task starts and it
+isn't stored in the task definition. Anywhere else, they are only allowed in
+"render" mode, which writes every value into the files.
+"""
+import re
+from collections import OrderedDict
+
+import click
+
+PLACEHOLDER_RE = re.compile(r'%(SSM|SECRET):([^%]+)%')
+PATH_WILDCARD = '/*'
+MODES = ('reference', 'render')
+
+
+def iter_strings(value):
+    """
+    Every string in a JSON structure, not counting the keys
+    """
+    if isinstance(value, dict):
+        for item in value.values():
+            for string in iter_strings(item):
+                yield string
+    elif isinstance(value, list):
+        for item in value:
+            for string in iter_strings(item):
+                yield string
+    elif isinstance(value, basestring):
+        yield value
+
+
+def has_placeholders(*documents):
+    return any([PLACEHOLDER_RE.search(s) for document in documents for s in iter_strings(document)])
+
+
+def find_placeholders(documents):
+    """
+    The parameter names, parameter paths and secret names used by the
+    documents, each once
+    """
+    names, paths, secret_names = OrderedDict(), OrderedDict(), OrderedDict()
+    for document in documents:
+        for string in iter_strings(document):
+            for kind, name in PLACEHOLDER_RE.findall(string):
+                if kind == 'SECRET':
+                    secret_names[name] = True
+                elif name.endswith(PATH_WILDCARD):
+                    paths[name[:-len(PATH_WILDCARD)] or '/'] = True
+                else:
+                    names[name] = True
+    return list(names), list(paths), list(secret_names)
+
+
+def env_name(prefix, parameter_name):
+    """
+    The environment variable for a parameter found under a path: the prefix,
+    then the last part of its name in capitals, e.g. DB_HOST for /app/db-host
+    """
+    return prefix + re.sub(r'[^A-Za-z0-9_]', '_', parameter_name.rsplit('/', 1)[-1]).upper()
+
+
+class PlaceholderResolver(object):
+    """
+    Fetches the parameters and secrets of a set of files, then fills them in
+    """
+    def __init__(self, ssm_client, secrets_client, mode='reference', concurrency=8):
+        self.ssm_client = ssm_client
+        self.secrets_client = secrets_client
+        self.mode = mode
+        self.concurrency = concurrency
+        self.parameters = {}
+        self.paths = {}
+        self.secrets = {}
+
+    def fetch(self, documents):
+        from concurrent.futures import ThreadPoolExecutor
+
+        names, paths, secret_names = find_placeholders(documents)
+        for path in paths:
+            self.paths[path] = list(self.ssm_client.get_parameters_by_path(path).values())
+        # Parameters under a path that was fetched come from the client's cache
+        self.parameters.update(self.ssm_client.get_parameters(names))
+        if secret_names:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                secrets = executor.map(lambda name: self.secrets_client.get_secret(name, self.mode == 'render'),
+                                       secret_names)
+                self.secrets.update([(name, secret) for name, secret in zip(secret_names, secrets) if secret])
+
+        missing = ["parameter {0}".format(name) for name in names if name not in self.parameters]
+        missing.extend(["secret {0}".format(name) for name in secret_names if name not in self.secrets])
+        if missing:
+            raise click.ClickException("Couldn't find the {0}.".format(", ".join(missing)))
+
+    def lookup(self, kind, name):
+        """
+        Return the ARN and value of a placeholder, and whether it is secret
+        """
+        if kind == 'SECRET':
+            secret = self.secrets[name]
+            return secret['ARN'], secret.get('SecretString'), True
+        parameter = self.parameters[name]
+        return parameter['ARN'], parameter['Value'], parameter['Type'] == 'SecureString'
+
+    def render_string(self, string):
+        def replace(match):
+            kind, name = match.groups()
+            if kind == 'SSM' and name.endswith(PATH_WILDCARD):
+                raise click.ClickException("{0} can only be the whole value of an environment variable.".format(
+                    match.group(0)))
+            _, value, secret = self.lookup(kind, name)
+            if secret and self.mode != 'render':
+                raise click.ClickException("{0} is secret, so outside of an environment variable it needs "
+                                           "--secret-placeholders render.".format(match.group(0)))
+            return value
+        return PLACEHOLDER_RE.sub(replace, string)
+
+    def render(self, value):
+        """
+        Fill in the placeholders of a JSON structure, in place
+        """
+        if isinstance(value, dict):
+            for key, item in value.items():
+                value[key] = self.render(item)
+        elif isinstance(value, list):
+            value[:] = [self.render(item) for item in value]
+        elif isinstance(value, basestring):
+            return self.render_string(value)
+        return value
+
+    def render_environment(self, container):
+        """
+        Fill in the environment of a container, moving the secret variables
+        to its `secrets` in reference mode
+        """
+        environment = []
+        secrets = list(container.get('secrets', []))
+
+        def add(name, arn, value, secret):
+            if secret and self.mode != 'render':
+                secrets.append({'name': name, 'valueFrom': arn})
+            else:
+                environment.append({'name': name, 'value': value})
+
+        for variable in container.get('environment', []):
+            match = PLACEHOLDER_RE.match(variable.get('value', ''))
+            if not match or match.end() != len(variable['value']):
+                environment.append(dict(variable, value=self.render_string(variable.get('value', ''))))
+                continue
+            kind, name = match.groups()
+            if kind == 'SSM' and name.endswith(PATH_WILDCARD):
+                for parameter in self.paths[name[:-len(PATH_WILDCARD)] or '/']:
+                    add(env_name(variable['name'], parameter['Name']), parameter['ARN'], parameter['Value'],
+                        parameter['Type'] == 'SecureString')
+            else:
+                add(variable['name'], *self.lookup(kind, name))
+
+        if 'environment' in container:
+            container['environment'] = environment
+        if secrets:
+            container['secrets'] = secrets
+
+    def resolve(self, task_defs=(), service_descs=()):
+        """
+        Fetch and fill in the placeholders of the task definitions and
+        service descriptions, in place
+        """
+        self.fetch(list(task_defs) + list(service_descs))
+        for task_def in task_defs:
+            for container in task_def.get('containerDefinitions', []):
+                self.render_environment(container)
+            self.render(task_def)
+        for service_desc in service_descs:
+            self.render(service_desc)
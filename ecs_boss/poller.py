@@ -0,0 +1,293 @@
+"""
+Watch tasks, services and log streams for everyone waiting on them
+
+Rather than each watcher polling its own task or service with its own
+sleeps, watchers subscribe to the Poller of their ECS client. On each tick it
+reads the new events of the log streams, then describes all the subscribed
+tasks with describe_tasks (100 per call) and services with describe_services
+(10 per call), per cluster, and calls each subscriber whose task, service or
+stream changed. The calls are shared by all the watchers of the client, e.g.
+the commands the server runs at the same time.
+
+The tick adapts to how fast things change: it halves after a tick that saw a
+change, down to MIN_INTERVAL, and grows by half after a quiet tick, up to
+MAX_INTERVAL. A new subscription is picked up within MIN_INTERVAL.
+
+Callbacks run on the poller's thread, with the output and request of the
+thread that subscribed. A callback returning True ends its subscription. A
+call that fails ends the subscriptions it was for with its error: those of
+one log stream, or of the tasks or services of one cluster.
+"""
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from .ecs import DESCRIBE_SERVICES_MAX, DESCRIBE_TASKS_MAX, EcsError, chunked
+from .process import caller_context, current_output, worker_context
+
+INTERVAL = 2  # seconds
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 10
+
+_pollers = weakref.WeakKeyDictionary()
+_pollers_lock = threading.Lock()
+
+
+def get_poller(ecs_client):
+    """
+    The Poller shared by everything using `ecs_client`
+    """
+    with _pollers_lock:
+        if ecs_client not in _pollers:
+            _pollers[ecs_client] = Poller(ecs_client)
+        return _pollers[ecs_client]
+
+
+class Subscription(object):
+    """
+    A watcher's interest in a task, service or log stream. `state` is the
+    latest description, `timed_out` tells whether it ended at its timeout
+    """
+    def __init__(self, poller, kind, cluster, key, callback, timeout=None):
+        self.poller = poller
+        self.kind = kind
+        self.cluster = cluster
+        self.key = key
+        self.callback = callback
+        self.deadline = time.time() + timeout if timeout is not None else None
+        self.context = caller_context()
+        self.state = None
+        self.timed_out = False
+        self.error = None
+        self._done = threading.Event()
+
+    def matches(self, arn):
+        return arn == self.key or arn.endswith('/' + self.key)
+
+    def update(self, state):
+        """
+        Give the subscriber a new state. Returns whether it changed
+        """
+        if state == self.state:
+            return False
+        self.state = state
+        self.notify(state)
+        return True
+
+    def notify(self, state):
+        try:
+            if self.context[0] is current_output():
+                finished = self.callback(state)
+            else:
+                with worker_context(self.context):
+                    finished = self.callback(state)
+        except Exception as e:
+            self.fail(e)
+            return
+        if finished:
+            self.cancel()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        self.poller.unsubscribe(self)
+        self._done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.cancel()
+
+    def wait(self):
+        """
+        Wait until the subscription ends, raising the error of its callback or
+        of the describe calls. Returns the latest state
+        """
+        while not self._done.wait(1):  # With a timeout, Ctrl-C still works on Python 2
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.state
+
+
+class LogStreamSubscription(Subscription):
+    """
+    Follows a log stream, passing its new events to the callback
+    """
+    def __init__(self, poller, log_client, log_group, log_stream, callback):
+        Subscription.__init__(self, poller, 'logs', log_group, log_stream, callback)
+        self.log_client = log_client
+        self.next_token = None
+
+    def read(self):
+        """
+        Read the events after the last ones read. Returns whether there were any
+        """
+        kwargs = {'logGroupName': self.cluster, 'logStreamName': self.key}
+        if self.next_token is not None:
+            kwargs['nextToken'] = self.next_token
+        else:
+            kwargs['startFromHead'] = True
+        try:
+            response = self.log_client.get_log_events(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                return False  # The task hasn't written anything yet
+            raise
+        # The token stays the same once there is nothing more to read
+        if response['nextForwardToken'] == self.next_token:
+            return False
+        self.next_token = response['nextForwardToken']
+        if not response['events']:
+            return False
+        self.notify(response['events'])
+        return True
+
+    def drain(self):
+        """
+        Stop following the stream and read the rest of it in this thread
+        """
+        self.cancel()
+        while self.read():
+            pass
+
+
+class Poller(object):
+    """
+    Polls the subscriptions of one ECS client from a thread that runs while
+    there are any
+    """
+    def __init__(self, ecs_client, interval=INTERVAL):
+        self.ecs_client = ecs_client
+        self.interval = interval
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._added = False
+
+    def subscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.append(subscription)
+            self._added = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ecs-boss-poller')
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def watch_task(self, cluster, task_arn, callback, timeout=None):
+        """
+        Call `callback(task)` with the task's description when it changes
+        """
+        return self.subscribe(Subscription(self, 'task', cluster, task_arn, callback, timeout))
+
+    def watch_service(self, cluster, service_name, callback, timeout=None):
+        """
+        Call `callback(service)` with the service's description when it changes
+        """
+        return self.subscribe(Subscription(self, 'service', cluster, service_name, callback, timeout))
+
+    def follow_log_stream(self, log_client, log_group, log_stream, callback):
+        """
+        Call `callback(events)` with the new events of a log stream
+        """
+        return self.subscribe(LogStreamSubscription(self, log_client, log_group, log_stream, callback))
+
+    def describe_service(self, cluster, service_name):
+        """
+        Describe a service in the next tick, together with everything else
+        being watched
+        """
+        return self.watch_service(cluster, service_name, lambda service: True).wait()
+
+    def _run(self):
+        interval = self.interval
+        while True:
+            with self._lock:
+                self._added = False
+                if not self._subscriptions:
+                    self._thread = None
+                    return
+            changed = self.tick()
+            interval = max(interval / 2.0, MIN_INTERVAL) if changed else min(interval * 1.5, MAX_INTERVAL)
+            waited = 0
+            while waited < interval and not self._added:
+                step = min(MIN_INTERVAL, interval - waited)
+                time.sleep(step)
+                waited += step
+
+    def tick(self):
+        """
+        Poll every subscription once. Returns whether anything changed
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        now = time.time()
+        for subscription in subscriptions:
+            if subscription.deadline is not None and now >= subscription.deadline:
+                subscription.timed_out = True
+                subscription.cancel()
+        subscriptions = [s for s in subscriptions if not s.done]
+
+        changed = False
+        for subscription in [s for s in subscriptions if s.kind == 'logs']:
+            try:
+                changed = subscription.read() or changed
+            except Exception as e:  # The watcher gets the error rather than waiting forever
+                subscription.fail(e)
+        changed = self._describe('task', subscriptions) or changed
+        changed = self._describe('service', subscriptions) or changed
+        return changed
+
+    def _describe(self, kind, subscriptions):
+        by_cluster = OrderedDict()
+        for subscription in subscriptions:
+            if subscription.kind == kind and not subscription.done:
+                by_cluster.setdefault(subscription.cluster, []).append(subscription)
+
+        changed = False
+        for cluster, cluster_subscriptions in by_cluster.items():
+            try:
+                found, failures = self._describe_cluster(kind, cluster, cluster_subscriptions)
+            except Exception as e:  # Only the watchers of this cluster's tasks or services get the error
+                for subscription in cluster_subscriptions:
+                    subscription.fail(e)
+                continue
+            for arn, state in found:
+                for subscription in cluster_subscriptions:
+                    if not subscription.done and subscription.matches(arn):
+                        changed = subscription.update(state) or changed
+            for failure in failures:
+                for subscription in cluster_subscriptions:
+                    if not subscription.done and subscription.matches(failure.get('arn', '')):
+                        subscription.fail(EcsError("Couldn't describe the {0} {1}: {2}".format(
+                            kind, subscription.key, failure.get('reason'))))
+        return changed
+
+    def _describe_cluster(self, kind, cluster, subscriptions):
+        """
+        Describe the tasks or services of one cluster. Returns the (ARN,
+        description) pairs and the failures
+        """
+        keys = list(OrderedDict.fromkeys([s.key for s in subscriptions]))
+        found, failures = [], []
+        if kind == 'task':
+            for chunk in chunked(keys, DESCRIBE_TASKS_MAX):
+                response = self.ecs_client.describe_tasks(cluster, chunk)
+                found.extend([(task['taskArn'], task) for task in response['tasks']])
+                failures.extend(response['failures'])
+        else:
+            for chunk in chunked(keys, DESCRIBE_SERVICES_MAX):
+                response = self.ecs_client.describe_services(cluster, chunk)
+                found.extend([(service['serviceArn'], service) for service in response['services']])
+                failures.extend(response.get('failures', []))
+        return found, failures
@@ -0,0 +1,137 @@
+"""
+Pull a new image on every container instance before the service is updated
+
+A small task definition is registered with one container per image of the
+new task definition, and start_task places one of its tasks on every active
+container instance of the cluster (10 instances per call, calls made
+concurrently). ECS pulls the images before it starts the containers, so a
+task has done its job once its pull has stopped, whether its container then
+runs or not. The first container, the essential one, depends on the others
+starting, so the task doesn't stop before every image is pulled. A task that
+stops with CannotPullContainerError, or before its pull ended, counts as a
+failed instance. The service's new tasks then start from the image already on
+the instance.
+"""
+import time
+import uuid
+from functools import partial
+
+import click
+
+from .ecs import START_TASK_MAX_INSTANCES, chunked
+
+PREPULL_FAMILY_SUFFIX = '-prepull'
+# The container exits straight away; images without a shell fail to start, after the pull
+PREPULL_ENTRY_POINT = ['sh', '-c', 'exit 0']
+PREPULL_MEMORY_RESERVATION = 8  # MiB
+
+
+def prepull_containers(task_def):
+    """
+    One container for each image of the task definition, doing nothing
+    """
+    containers = []
+    images = set()
+    for container in task_def['containerDefinitions']:
+        if container['image'] in images:
+            continue
+        images.add(container['image'])
+        prepull = {
+            'name': container['name'],
+            'image': container['image'],
+            'essential': False,
+            'entryPoint': PREPULL_ENTRY_POINT,
+            'memoryReservation': PREPULL_MEMORY_RESERVATION,
+        }
+        if container.get('repositoryCredentials'):
+            prepull['repositoryCredentials'] = container['repositoryCredentials']
+        containers.append(prepull)
+    # A task needs an essential container, and it stops when that one exits: after the others have started
+    containers[0]['essential'] = True
+    if len(containers) > 1:
+        containers[0]['dependsOn'] = [{'containerName': c['name'], 'condition': 'START'} for c in containers[1:]]
+    return containers
+
+
+def get_pull_failure(task):
+    """
+    Why the task couldn't pull its images, or None if it could or is still
+    pulling
+    """
+    reasons = [task.get('stoppedReason') or ''] + [c.get('reason') or '' for c in task.get('containers', [])]
+    for reason in reasons:
+        if 'CannotPullContainer' in reason:
+            return reason
+    if task['lastStatus'] == 'STOPPED' and not task.get('pullStoppedAt'):
+        return task.get('stoppedReason') or "stopped before its pull ended"
+    return None
+
+
+def is_pulled(task):
+    return bool(task.get('pullStoppedAt')) and get_pull_failure(task) is None
+
+
+def prepull_images(ecs_client, cluster, task_def, timeout=600, poll_time=5, concurrency=8):
+    """
+    Pull the images of `task_def` on every container instance of the cluster
+    and wait until the pulls are done or the timeout passes. Returns the
+    number of instances that pulled them and the number of instances. The
+    instances that failed to are reported
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    instance_arns = []
+    for page in ecs_client.iter_container_instance_arn_pages(cluster):
+        instance_arns.extend(page)
+    if not instance_arns:
+        click.echo("Skipping the pre-pull: {0} has no active container instances.".format(cluster))
+        return 0, 0
+
+    # The execution role lets ECS pull from private registries with repositoryCredentials
+    response = ecs_client.register_task_definition(
+        task_def['family'] + PREPULL_FAMILY_SUFFIX, prepull_containers(task_def), [], None,
+        task_def.get('executionRoleArn'))
+    prepull_task_def = response['taskDefinition']['taskDefinitionArn']
+    started_by = 'ecs-boss-prepull-{0}'.format(uuid.uuid4().hex[:12])
+    click.echo("Pulling {0} on {1} container instances.".format(
+        ", ".join(sorted(set([c['image'] for c in task_def['containerDefinitions']]))), len(instance_arns)))
+
+    start = time.time()
+    try:
+        start_task = partial(ecs_client.start_task, cluster, prepull_task_def, started_by=started_by)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            responses = list(executor.map(start_task, chunked(instance_arns, START_TASK_MAX_INSTANCES)))
+        task_arns = [task['taskArn'] for r in responses for task in r['tasks']]
+        for failure in [failure for r in responses for failure in r['failures']]:
+            click.echo("Couldn't start a pre-pull task on {0}: {1}".format(
+                failure.get('arn', '').split('/')[-1], failure.get('reason')))
+
+        pulled, failures = 0, {}
+        while task_arns:
+            response = ecs_client.describe_tasks(cluster, task_arns)
+            for failure in response['failures']:
+                click.echo("Couldn't describe the pre-pull task {0}: {1}".format(
+                    failure.get('arn', '').split('/')[-1], failure.get('reason')))
+            missing = set([failure.get('arn') for failure in response['failures']])
+            task_arns = [arn for arn in task_arns if arn not in missing]  # Not waited for again
+            pulled = len([task for task in response['tasks'] if is_pulled(task)])
+            for task in response['tasks']:
+                failure = get_pull_failure(task)
+                if failure and task['taskArn'] not in failures:
+                    failures[task['taskArn']] = failure
+                    click.echo("Couldn't pull the image on {0}: {1}".format(
+                        task.get('containerInstanceArn', '').split('/')[-1], failure))
+            if pulled + len(failures) >= len(task_arns):
+                break
+            if time.time() - start >= timeout:
+                click.echo("{0} of {1} instances still pulling after {2}s. Continuing.".format(
+                    len(task_arns) - pulled - len(failures), len(task_arns), timeout))
+                break
+            time.sleep(poll_time)
+    finally:
+        ecs_client.deregister_task_definition(prepull_task_def)
+
+    click.echo("Pulled the image on {0} of {1} container instances in {2:.0f}s{3}.".format(
+        pulled, len(instance_arns), time.time() - start,
+        "; {0} failed to".format(len(failures)) if failures else ""))
+    return pulled, len(instance_arns)
@@ -0,0 +1,165 @@
+"""
+Run commands and stream their output
+
+Output is read a line at a time as the command writes it. Shown output isn't
+kept, apart from the last lines in a ring buffer, so a long docker build
+doesn't fill memory but its end can still be shown if it fails.
+
+Commands running at the same time in different threads (builds or pushes to
+several regions) can each prefix their lines, and whole lines are written one
+at a time so they don't get mixed up.
+
+In the server, each thread also has the working directory and environment of
+the client it runs a command for. Commands are run there, with that
+environment, and worker threads take them over with worker_context.
+"""
+import os
+import subprocess
+import sys
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import click
+
+TAIL_LINES = 100
+
+_output = threading.local()
+_request = threading.local()
+_echo_lock = threading.Lock()
+
+
+class CommandResult(object):
+    def __init__(self, command, exit_code, output, tail):
+        self.command = command
+        self.exit_code = exit_code
+        self.output = output
+        self.tail = tail
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+
+class CommandError(click.ClickException):
+    def __init__(self, result):
+        command = result.command if isinstance(result.command, basestring) else " ".join(result.command)
+        message = "'{0}' failed with exit code {1}".format(command, result.exit_code)
+        if result.tail:
+            message += ". The end of its output:\n" + "\n".join(result.tail)
+        super(CommandError, self).__init__(message)
+        self.result = result
+
+
+def set_request(cwd=None, env=None):
+    """
+    Run the commands of this thread in `cwd` with the environment `env`, or
+    in the process's own with None
+    """
+    _request.cwd = cwd
+    _request.env = env
+
+
+def request_cwd():
+    return getattr(_request, 'cwd', None)
+
+
+def native(value):
+    """
+    A str on Python 2 as well, as subprocess environments need
+    """
+    return value if isinstance(value, str) else value.encode('utf-8')
+
+
+def request_env():
+    """
+    The environment of the client this thread runs a command for, or None
+    """
+    return getattr(_request, 'env', None)
+
+
+def current_output():
+    """
+    The stream this thread writes to. In the server, that is the client's
+    """
+    return getattr(sys.stdout, 'current', sys.stdout)
+
+
+@contextmanager
+def output_to(stream, prefix=''):
+    """
+    Write the output of this thread to `stream`, and prefix the lines of the
+    commands it runs. Use it in worker threads, passing current_output() of
+    the thread that started them
+    """
+    local_stream = hasattr(sys.stdout, 'set')
+    if local_stream:
+        sys.stdout.set(stream)
+    _output.stream = stream
+    _output.prefix = prefix
+    try:
+        yield
+    finally:
+        _output.stream = None
+        _output.prefix = ''
+        if local_stream:
+            sys.stdout.set(None)
+
+
+def caller_context():
+    """
+    What a worker thread needs to act for this thread: its output, line
+    prefix, working directory and environment
+    """
+    return current_output(), getattr(_output, 'prefix', ''), request_cwd(), request_env()
+
+
+@contextmanager
+def worker_context(context, prefix=''):
+    """
+    Act for the thread whose caller_context() is `context`, adding `prefix`
+    to its line prefix
+    """
+    stream, caller_prefix, cwd, env = context
+    set_request(cwd, env)
+    try:
+        with output_to(stream, caller_prefix + prefix):
+            yield
+    finally:
+        set_request()
+
+
+def echo_line(line):
+    with _echo_lock:
+        click.echo(getattr(_output, 'prefix', '') + line, file=getattr(_output, 'stream', None))
+
+
+def run(command, echo=False, cwd=None, tail_lines=TAIL_LINES, on_line=None, env=None):
+    """
+    Run a command and wait for it to finish. A string is run by the shell; a
+    list of arguments is run without one. With `echo` the output is shown as
+    it is written and only its last `tail_lines` lines are kept, otherwise it
+    is returned in full. `on_line` is called with each line as it is read.
+    `env` has variables to add to the environment, e.g. values that
+    shouldn't be on the command line
+    """
+    environment = request_env()
+    if env:
+        environment = dict(environment if environment is not None else os.environ)
+        environment.update([(native(key), native(value)) for key, value in env.items()])
+    p = subprocess.Popen(command, shell=not isinstance(command, (list, tuple)), cwd=cwd or request_cwd(),
+                         env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    tail = deque(maxlen=tail_lines)
+    output = []
+    for line in iter(p.stdout.readline, b''):
+        line = line.decode('utf-8', 'replace')
+        tail.append(line.rstrip('\r\n'))
+        if on_line is not None:
+            on_line(tail[-1])
+        if echo:
+            echo_line(tail[-1])
+        else:
+            output.append(line)
+    p.stdout.close()
+    exit_code = p.wait()
+    return CommandResult(command, exit_code, "".join(output), list(tail))
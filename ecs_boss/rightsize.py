@@ -0,0 +1,158 @@
+"""
+Propose cpu and memory reservations from what a service's tasks really use
+
+ECS reports the CPUUtilization and MemoryUtilization of a service to
+CloudWatch as a percentage of what its task definition reserves. The average
+and maximum of both, for every service running the family, are fetched with
+get_metric_data (up to 500 queries per call) over a window, and turned back
+into cpu units and MiB with the reservations of the live task definition.
+
+The metrics are per task, so a task's usage is split between its containers
+in proportion to their current reservations. For each container:
+
+- cpu: the percentile of the average cpu used, plus headroom
+- memoryReservation: the percentile of the average memory used, plus headroom
+- memory (only for containers that already have a hard limit): the highest
+  memory used by any task, plus headroom, so containers aren't OOM-killed
+"""
+import json
+import math
+from collections import OrderedDict
+
+from .capacity import parse_units
+from .latency import percentile
+
+NAMESPACE = 'AWS/ECS'
+STATISTICS = (
+    ('cpu_average', 'CPUUtilization', 'Average'),
+    ('cpu_maximum', 'CPUUtilization', 'Maximum'),
+    ('memory_average', 'MemoryUtilization', 'Average'),
+    ('memory_maximum', 'MemoryUtilization', 'Maximum'),
+)
+CPU_STEP = 16  # cpu units
+MEMORY_STEP = 16  # MiB
+MIN_DATAPOINTS = 12
+
+
+def metric_queries(index, cluster, service_name, period):
+    """
+    The get_metric_data queries for the utilization of one service
+    """
+    dimensions = [{'Name': 'ClusterName', 'Value': cluster}, {'Name': 'ServiceName', 'Value': service_name}]
+    return [{
+        'Id': 's{0}_{1}'.format(index, key),
+        'MetricStat': {
+            'Metric': {'Namespace': NAMESPACE, 'MetricName': metric_name, 'Dimensions': dimensions},
+            'Period': period,
+            'Stat': stat,
+        },
+        'ReturnData': True,
+    } for key, metric_name, stat in STATISTICS]
+
+
+def fetch_utilization(cloudwatch_client, services, start_time, end_time, period=300):
+    """
+    Return the utilization percentages of all the (cluster, service name)
+    `services` together, by statistic
+    """
+    queries = []
+    for index, (cluster, service_name) in enumerate(services):
+        queries.extend(metric_queries(index, cluster, service_name, period))
+    results = cloudwatch_client.get_metric_data(queries, start_time, end_time)
+
+    utilization = OrderedDict([(key, []) for key, _, _ in STATISTICS])
+    for query_id, result in results.items():
+        utilization[query_id.split('_', 1)[1]].extend(result['Values'])
+    return utilization
+
+
+def get_reservations(task_def):
+    """
+    The cpu units and MiB a task reserves, which the utilization percentages
+    are relative to, and each container's share of them. A container
+    reserves its memoryReservation, or its memory without one
+    """
+    containers = task_def.get('containerDefinitions', [])
+    container_cpu = OrderedDict([(c['name'], c.get('cpu', 0)) for c in containers])
+    container_memory = OrderedDict([(c['name'], c.get('memoryReservation') or c.get('memory') or 0)
+                                    for c in containers])
+    task_cpu = parse_units(task_def['cpu'], 1024) if task_def.get('cpu') else sum(container_cpu.values())
+    task_memory = parse_units(task_def['memory'], 1024) if task_def.get('memory') else sum(container_memory.values())
+
+    def shares(values):
+        total = float(sum(values.values()))
+        return OrderedDict([(name, value / total if total else 1.0 / len(values)) for name, value in values.items()])
+    return task_cpu, task_memory, shares(container_cpu), shares(container_memory)
+
+
+def round_up(value, step):
+    return max(int(math.ceil(value / float(step))) * step, step)
+
+
+def propose(local_task_def, live_task_def, utilization, percent=99, headroom=1.2):
+    """
+    Return the proposed changes to the containers of the local task
+    definition as (container, field, current, proposed) rows
+    """
+    task_cpu, task_memory, cpu_shares, memory_shares = get_reservations(live_task_def)
+    cpu_average = sorted(utilization['cpu_average'])
+    memory_average = sorted(utilization['memory_average'])
+    peak_memory = max(utilization['memory_maximum'] or [0])
+
+    changes = []
+    for container in local_task_def.get('containerDefinitions', []):
+        name = container['name']
+        if name not in cpu_shares:
+            continue  # Not running yet, so there are no metrics for it
+        proposed = OrderedDict()
+        if container.get('cpu') and task_cpu and cpu_average:
+            used = percentile(cpu_average, percent) / 100.0 * task_cpu * cpu_shares[name]
+            proposed['cpu'] = round_up(used * headroom, CPU_STEP)
+        if task_memory and memory_average:
+            used = percentile(memory_average, percent) / 100.0 * task_memory * memory_shares[name]
+            proposed['memoryReservation'] = round_up(used * headroom, MEMORY_STEP)
+            if container.get('memory'):
+                peak = peak_memory / 100.0 * task_memory * memory_shares[name]
+                proposed['memory'] = max(round_up(peak * headroom, MEMORY_STEP), proposed['memoryReservation'])
+        for field, value in proposed.items():
+            if container.get(field) != value:
+                changes.append((name, field, container.get(field), value))
+    return changes
+
+
+def as_patch(changes):
+    """
+    The changes as a partial task definition, merged by container name
+    """
+    containers = OrderedDict()
+    for name, field, _, proposed in changes:
+        containers.setdefault(name, OrderedDict([('name', name)]))[field] = proposed
+    return OrderedDict([('containerDefinitions', list(containers.values()))])
+
+
+def apply_patch(task_def, changes):
+    """
+    Set the proposed values in a task definition (the parsed local file)
+    """
+    containers = dict([(c['name'], c) for c in task_def.get('containerDefinitions', [])])
+    for name, field, _, proposed in changes:
+        containers[name][field] = proposed
+    return task_def
+
+
+def format_text(changes, utilization, percent):
+    def used(key):
+        return percentile(sorted(utilization[key]), percent) if utilization[key] else 0
+
+    lines = ["{0} datapoints; cpu p{1:g} {2:.1f}%, memory p{1:g} {3:.1f}%, memory peak {4:.1f}% of the "
+             "reservation.".format(len(utilization['cpu_average']), percent, used('cpu_average'),
+                                   used('memory_average'), max(utilization['memory_maximum'] or [0]))]
+    if not changes:
+        lines.append("The reservations already match the usage.")
+    for name, field, current, proposed in changes:
+        lines.append("{0:<20} {1:<18} {2:>8} -> {3}".format(name, field, '-' if current is None else current, proposed))
+    return lines
+
+
+def format_json(changes):
+    return [json.dumps(as_patch(changes), indent=2, separators=(',', ': '))]
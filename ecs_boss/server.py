@@ -0,0 +1,353 @@
+"""
+Run commands for ecs-boss-client over a Unix socket
+
+The server keeps its AWS clients between commands, so their connections,
+credentials and cached task definitions stay warm. Each request runs in its
+own thread with its output sent back to the client as it is written.
+
+A request is a line of JSON with the command line, working directory and
+environment of the client. The command gets the client's environment, with
+the .env file of its directory (or of the closest parent directory that has
+one) under it, and never the server's: options read from environment
+variables are removed from the server's environment when it starts. The server answers with lines of JSON: the output
+({"output": ..., "stream": "stdout" or "stderr"}) and finally the exit code
+({"exit_code": ...}).
+"""
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import click
+
+from . import commands
+from .process import native, set_request
+
+# Commands that change a service, so only one of them runs at a time for each service
+SERVICE_COMMANDS = ('deploy', 'update-service', 'update-task-and-service', 'scale-service')
+# Only read from the client's environment, as the AWS clients are made with them
+CLIENT_ENVVARS = ('AWS_PROFILE', 'AWS_REGION', 'AWS_DEFAULT_REGION')
+
+
+class ThreadLocalStream(object):
+    """
+    Writes to the stream set for the current thread, or to the original stream
+    """
+    def __init__(self, stream):
+        self.original = stream
+        self.local = threading.local()
+
+    @property
+    def current(self):
+        return getattr(self.local, 'stream', None) or self.original
+
+    def set(self, stream):
+        self.local.stream = stream
+
+    def write(self, data):
+        self.current.write(data)
+
+    def flush(self):
+        self.current.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.current, name)
+
+
+class ResponseStream(object):
+    """
+    Sends what is written to it to the client. If the client goes away, the
+    command keeps running and its output is dropped
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.name = name
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        if data:
+            self.channel.send({'output': data, 'stream': self.name})
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class ResponseChannel(object):
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.closed = False
+        self._lock = threading.Lock()
+        self.stdout = ResponseStream(self, 'stdout')
+        self.stderr = ResponseStream(self, 'stderr')
+
+    def send(self, message):
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except (IOError, OSError, socket.error):
+                self.closed = True
+
+
+def resolve_command(group, args):
+    """
+    Return the names of the (sub)commands that `args` run, the command and the
+    rest of the arguments
+    """
+    names = []
+    command = group
+    args = list(args)
+    while isinstance(command, click.MultiCommand) and args and not args[0].startswith('-'):
+        subcommand = command.get_command(click.Context(command), args[0])
+        if subcommand is None:
+            break
+        names.append(args.pop(0))
+        command = subcommand
+    return names, command, args
+
+
+def is_path(param):
+    return isinstance(param.type, (click.File, click.Path))
+
+
+def normalize_args(command, args, cwd, env):
+    """
+    Return the arguments with the file and path options (including their
+    defaults) made absolute using the client's directory, and options read
+    from environment variables filled in from the client's environment. Also
+    returns the parsed values
+    """
+    ctx = click.Context(command, resilient_parsing=True)
+    try:
+        values, _, _ = command.make_parser(ctx).parse_args(args=list(args))
+    except click.UsageError:
+        return args, {}  # The command will report the error
+
+    def absolute(value):
+        if value == '-':
+            return value
+        return os.path.join(cwd, os.path.expanduser(value))
+
+    options = []
+    arguments = []
+    for param in command.get_params(ctx):
+        value = values.get(param.name)
+        if value is None and getattr(param, 'envvar', None) in env:
+            value = env[param.envvar]
+        if value is None and is_path(param) and param.default is not None:
+            value = param.default
+        if value is None:
+            continue
+        multiple = param.multiple or param.nargs != 1
+        if is_path(param):
+            value = [absolute(v) for v in value] if multiple else absolute(value)
+            values[param.name] = value
+
+        if isinstance(param, click.Argument):
+            arguments.extend(value if multiple else [value])
+        elif param.is_flag:
+            if value == param.flag_value or (param.is_bool_flag and value):
+                options.append(param.opts[0])
+            elif param.is_bool_flag and param.secondary_opts:
+                options.append(param.secondary_opts[0])
+        else:
+            for item in (value if multiple else [value]):
+                options.extend([param.opts[0], item])
+    return options + ['--'] + arguments, values
+
+
+def find_env_file(cwd):
+    """
+    The .env file of `cwd` or its closest parent directory that has one, or
+    None
+    """
+    path = os.path.abspath(cwd)
+    while True:
+        if os.path.isfile(os.path.join(path, '.env')):
+            return os.path.join(path, '.env')
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def request_environment(request):
+    """
+    The client's environment over the variables of its .env file
+    """
+    from dotenv import dotenv_values
+
+    env = {}
+    env_file = find_env_file(request['cwd'])
+    if env_file is not None:
+        env.update([(key, value) for key, value in dotenv_values(env_file).items() if value is not None])
+    env.update(request.get('env', {}))
+    return dict([(native(key), native(value)) for key, value in env.items()])
+
+
+def iter_envvars(group):
+    """
+    The environment variables the options of every command read
+    """
+    for command in group.commands.values():
+        if isinstance(command, click.MultiCommand):
+            for envvar in iter_envvars(command):
+                yield envvar
+            continue
+        for param in command.params:
+            envvars = getattr(param, 'envvar', None) or []
+            for envvar in ([envvars] if isinstance(envvars, basestring) else envvars):
+                yield envvar
+
+
+def get_service_key(service_path):
+    """
+    Return the cluster and name of the service in a service file, or None
+    """
+    try:
+        with open(service_path) as f:
+            service = json.load(f)
+        return service['cluster'], service['serviceName']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+class ServiceLocks(object):
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+def invoke(args):
+    """
+    Run the command line and return its exit code
+    """
+    try:
+        result = commands.cli.main(args=args, prog_name='ecs-boss', standalone_mode=False)
+        return result if isinstance(result, int) else 0
+    except click.ClickException as e:
+        e.show(file=sys.stderr)
+        return e.exit_code
+    except click.Abort:
+        click.echo("Aborted!", err=True)
+        return 1
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        return 1
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+        channel = ResponseChannel(self.wfile)
+        sys.stdout.set(channel.stdout)
+        sys.stderr.set(channel.stderr)
+        request['env'] = request_environment(request)
+        set_request(request['cwd'], request['env'])
+        try:
+            exit_code = self.server.run(request)
+        finally:
+            sys.stdout.set(None)
+            sys.stderr.set(None)
+            set_request()
+        channel.send({'exit_code': exit_code})
+
+
+class CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        self.locks = ServiceLocks()
+        socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+
+    def run(self, request):
+        """
+        Run a request, waiting for other commands changing the same service
+        """
+        names, command, args = resolve_command(commands.cli, request['args'])
+        if names[:1] == ['serve']:
+            click.echo("The server can't run 'serve'.", err=True)
+            return 2
+        values = {}
+        if not isinstance(command, click.MultiCommand):
+            args, values = normalize_args(command, args, request['cwd'], request.get('env', {}))
+
+        service_key = None
+        if ' '.join(names) in SERVICE_COMMANDS and values.get('service_file'):
+            service_key = get_service_key(values['service_file'])
+        if service_key is None:
+            return invoke(names + args)
+
+        lock = self.locks.get(service_key)
+        if not lock.acquire(False):
+            click.echo("Waiting for another command on {1} in {0} to finish.".format(*service_key))
+            lock.acquire()
+        try:
+            return invoke(names + args)
+        finally:
+            lock.release()
+
+
+def serve(socket_path):
+    """
+    Listen on `socket_path` until interrupted
+    """
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir and not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, 0o700)
+    if os.path.exists(socket_path):
+        from .client import connect
+
+        sock = connect(socket_path)
+        if sock is not None:
+            sock.close()
+            raise click.ClickException("A server is already listening on {0}.".format(socket_path))
+        os.remove(socket_path)  # Left behind by a server that didn't stop cleanly
+
+    old_umask = os.umask(0o177)  # Only this user may connect
+    try:
+        server = CommandServer(socket_path)
+    finally:
+        os.umask(old_umask)
+    commands.reuse_clients()
+    for envvar in set(iter_envvars(commands.cli)) | set(CLIENT_ENVVARS):
+        os.environ.pop(envvar, None)  # Including what the server's own .env set
+    click.echo("Listening on {0}".format(socket_path))
+    sys.stdout = ThreadLocalStream(sys.stdout)
+    sys.stderr = ThreadLocalStream(sys.stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        sys.stdout = sys.stdout.original
+        sys.stderr = sys.stderr.original
+        server.server_close()
+        os.remove(socket_path)
+    click.echo("Stopped.")
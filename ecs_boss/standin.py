@@ -0,0 +1,797 @@
+"""
+An in-process stand-in for the ECS, ECR, CloudWatch and CloudWatch Logs APIs
+
+It keeps just enough state to run the ecs-boss commands end to end: task
+definitions, services whose deployments converge over a few polls, one-off
+tasks that run and stop, log streams, metrics, and images. Every call can be slowed
+down, throttled and paginated, and is counted, so the benchmark can measure
+how a command uses the API without touching AWS.
+
+Install it with `ecs_boss.ecs.set_client_factory(stand_in.client)`.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+from botocore.exceptions import ClientError
+
+ACCOUNT = '123456789012'
+REGION = 'us-east-1'
+EPOCH = datetime(2020, 1, 1)
+DEFAULT_CREATED_BY = [
+    '/bin/sh -c #(nop) ADD file:4b03b5f551e3fbdf47ec609712007327828f7530cc3455c43bbcdcaf449a75a9 in / ',
+    'RUN /bin/sh -c pip install -r requirements.txt # buildkit',
+    'COPY . /app # buildkit',
+]
+
+ClientMeta = namedtuple('ClientMeta', ['region_name', 'endpoint_url'])
+
+# Latency is real even when the benchmark replaces time.sleep
+real_sleep = time.sleep
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, operation)
+
+
+def ok(response):
+    response['ResponseMetadata'] = {'HTTPStatusCode': 200}
+    return response
+
+
+class StandInPaginator(object):
+    """
+    Calls a paged operation until there are no more pages
+    """
+    def __init__(self, method, token_key='nextToken'):
+        self.method = method
+        self.token_key = token_key
+
+    def paginate(self, PaginationConfig=None, **kwargs):  # NOQA
+        if (PaginationConfig or {}).get('PageSize'):
+            kwargs['maxResults'] = PaginationConfig['PageSize']
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get(self.token_key):
+                return
+            kwargs[self.token_key] = page[self.token_key]
+
+
+class StandInClient(object):
+    """
+    The base for the fake clients: counts calls, adds latency and throttles
+    """
+    service_name = None
+
+    def __init__(self, aws, region=None):
+        self.aws = aws
+        region = region or REGION
+        self.meta = ClientMeta(region, 'https://{0}.{1}.amazonaws.com'.format(self.service_name, region))
+
+    def _call(self, operation):
+        self.aws.record(self.service_name, operation)
+
+    def get_paginator(self, operation):
+        return StandInPaginator(getattr(self, operation))
+
+    def can_paginate(self, operation):
+        return True
+
+    def page(self, items, next_token=None, max_results=None):
+        """
+        Return a page of items and the token of the next page
+        """
+        start = int(next_token or 0)
+        size = max_results or self.aws.page_size
+        end = start + size
+        return items[start:end], str(end) if end < len(items) else None
+
+
+class StandInEcs(StandInClient):
+    service_name = 'ecs'
+
+    def cluster_arn(self, cluster):
+        if cluster.startswith('arn:'):
+            return cluster
+        return 'arn:aws:ecs:{0}:{1}:cluster/{2}'.format(REGION, ACCOUNT, cluster)
+
+    def list_clusters(self, nextToken=None, maxResults=None):  # NOQA
+        self._call('ListClusters')
+        clusters = sorted(set([self.cluster_arn(c) for c, _ in self.aws.services]))
+        page, token = self.page(clusters, nextToken, maxResults)
+        return ok({'clusterArns': page, 'nextToken': token})
+
+    def list_task_definition_families(self, familyPrefix=None, status='ACTIVE', nextToken=None):  # NOQA
+        self._call('ListTaskDefinitionFamilies')
+        families = sorted([f for f in self.aws.task_definitions if f.startswith(familyPrefix or '')])
+        page, token = self.page(families, nextToken)
+        return ok({'families': page, 'nextToken': token})
+
+    def describe_task_definition(self, taskDefinition):  # NOQA
+        self._call('DescribeTaskDefinition')
+        task_def = self.aws.find_task_definition(taskDefinition)
+        if task_def is None:
+            raise client_error('ClientException', 'DescribeTaskDefinition', 'Unable to describe task definition.')
+        return ok({'taskDefinition': deepcopy(task_def)})
+
+    def register_task_definition(self, family, containerDefinitions, **kwargs):  # NOQA
+        self._call('RegisterTaskDefinition')
+        return ok({'taskDefinition': deepcopy(self.aws.add_task_definition(family, containerDefinitions, **kwargs))})
+
+    def deregister_task_definition(self, taskDefinition):  # NOQA
+        self._call('DeregisterTaskDefinition')
+        task_def = self.aws.find_task_definition(taskDefinition)
+        task_def['status'] = 'INACTIVE'
+        return ok({'taskDefinition': deepcopy(task_def)})
+
+    def list_services(self, cluster='default', nextToken=None, maxResults=None):  # NOQA
+        self._call('ListServices')
+        arns = [s['serviceArn'] for (c, _), s in sorted(self.aws.services.items()) if c == cluster.split('/')[-1]]
+        page, token = self.page(arns, nextToken, maxResults)
+        return ok({'serviceArns': page, 'nextToken': token})
+
+    def describe_services(self, cluster='default', services=()):
+        self._call('DescribeServices')
+        if len(services) > 10:
+            raise client_error('InvalidParameterException', 'DescribeServices', 'services can have at most 10 items.')
+        result = {'services': [], 'failures': []}
+        for name in services:
+            service = self.aws.services.get((cluster.split('/')[-1], name.split('/')[-1]))
+            if service is None:
+                result['failures'].append({'arn': name, 'reason': 'MISSING'})
+            else:
+                self.aws.advance_service(service)
+                result['services'].append(deepcopy(service))
+        return ok(result)
+
+    def update_service(self, cluster='default', service=None, desiredCount=None, taskDefinition=None, **kwargs):  # NOQA
+        self._call('UpdateService')
+        current = self.aws.services.get((cluster.split('/')[-1], service.split('/')[-1]))
+        if current is None:
+            raise client_error('ServiceNotFoundException', 'UpdateService')
+        if desiredCount is not None:
+            current['desiredCount'] = desiredCount
+        if taskDefinition is not None:
+            task_def = self.aws.find_task_definition(taskDefinition)
+            if task_def['taskDefinitionArn'] != current['taskDefinition']:
+                self.aws.start_deployment(current, task_def['taskDefinitionArn'])
+        for deployment in current['deployments']:
+            if deployment['status'] == 'PRIMARY':
+                deployment['desiredCount'] = current['desiredCount']
+        return ok({'service': deepcopy(current)})
+
+    def list_tasks(self, cluster='default', serviceName=None, startedBy=None, desiredStatus='RUNNING',  # NOQA
+                   nextToken=None, maxResults=None, **kwargs):  # NOQA
+        self._call('ListTasks')
+        arns = []
+        for task in self.aws.tasks.values():
+            if task['clusterArn'] != self.cluster_arn(cluster) or task['desiredStatus'] != desiredStatus:
+                continue
+            if serviceName and task.get('group') != 'service:{0}'.format(serviceName.split('/')[-1]):
+                continue
+            if startedBy and task.get('startedBy') != startedBy:
+                continue
+            arns.append(task['taskArn'])
+        page, token = self.page(sorted(arns), nextToken, maxResults)
+        return ok({'taskArns': page, 'nextToken': token})
+
+    def describe_tasks(self, cluster='default', tasks=()):
+        self._call('DescribeTasks')
+        if len(tasks) > 100:
+            raise client_error('InvalidParameterException', 'DescribeTasks', 'tasks can have at most 100 items.')
+        result = {'tasks': [], 'failures': []}
+        for arn in tasks:
+            task = self.aws.find_task(arn)
+            if task is None:
+                result['failures'].append({'arn': arn, 'reason': 'MISSING'})
+            else:
+                self.aws.advance_task(task)
+                result['tasks'].append(deepcopy(task))
+        return ok(result)
+
+    def run_task(self, cluster='default', taskDefinition=None, count=1, startedBy=None, overrides=None, **kwargs):  # NOQA
+        self._call('RunTask')
+        if count > 10:
+            raise client_error('InvalidParameterException', 'RunTask', 'count can be at most 10.')
+        task_def = self.aws.find_task_definition(taskDefinition)
+        tasks = [self.aws.add_task(cluster.split('/')[-1], task_def, startedBy=startedBy, overrides=overrides)
+                 for _ in range(count)]
+        return ok({'tasks': deepcopy(tasks), 'failures': []})
+
+    def start_task(self, cluster='default', taskDefinition=None, containerInstances=(), startedBy=None,  # NOQA
+                   overrides=None, **kwargs):
+        self._call('StartTask')
+        if len(containerInstances) > 10:
+            raise client_error('InvalidParameterException', 'StartTask',
+                               'containerInstances can have at most 10 items.')
+        task_def = self.aws.find_task_definition(taskDefinition)
+        result = {'tasks': [], 'failures': []}
+        for arn in containerInstances:
+            if arn not in self.aws.container_instances:
+                result['failures'].append({'arn': arn, 'reason': 'MISSING'})
+                continue
+            task = self.aws.add_task(cluster.split('/')[-1], task_def, startedBy=startedBy, overrides=overrides)
+            task['containerInstanceArn'] = arn
+            result['tasks'].append(deepcopy(task))
+        return ok(result)
+
+    def execute_command(self, cluster='default', task=None, container=None, command=None, interactive=False):
+        self._call('ExecuteCommand')
+        found = self.aws.find_task(task)
+        if found is None or found['lastStatus'] != 'RUNNING':
+            raise client_error('InvalidParameterException', 'ExecuteCommand', 'The task is not running.')
+        if not found.get('enableExecuteCommand') or not interactive:
+            raise client_error('InvalidParameterException', 'ExecuteCommand',
+                               'The execute command failed because execute command was not enabled.')
+        session_id = 'ecs-execute-command-{0:017x}'.format(self.aws.next_id())
+        return ok({
+            'clusterArn': found['clusterArn'],
+            'taskArn': found['taskArn'],
+            'containerName': container,
+            'interactive': interactive,
+            'session': {
+                'sessionId': session_id,
+                'streamUrl': 'wss://ssmmessages.{0}.amazonaws.com/v1/data-channel/{1}'.format(REGION, session_id),
+                'tokenValue': session_id,
+            },
+        })
+
+    def list_container_instances(self, cluster='default', status=None, nextToken=None, maxResults=None, **kwargs):  # NOQA
+        self._call('ListContainerInstances')
+        arns = sorted([arn for arn, instance in self.aws.container_instances.items()
+                       if instance['clusterArn'] == self.cluster_arn(cluster)
+                       and (status is None or instance['status'] == status)])
+        page, token = self.page(arns, nextToken, maxResults)
+        return ok({'containerInstanceArns': page, 'nextToken': token})
+
+    def describe_container_instances(self, cluster='default', containerInstances=()):  # NOQA
+        self._call('DescribeContainerInstances')
+        if len(containerInstances) > 100:
+            raise client_error('InvalidParameterException', 'DescribeContainerInstances',
+                               'containerInstances can have at most 100 items.')
+        result = {'containerInstances': [], 'failures': []}
+        for arn in containerInstances:
+            if arn in self.aws.container_instances:
+                result['containerInstances'].append(deepcopy(self.aws.container_instances[arn]))
+            else:
+                result['failures'].append({'arn': arn, 'reason': 'MISSING'})
+        return ok(result)
+
+
+class StandInEcr(StandInClient):
+    service_name = 'ecr'
+
+    def describe_repositories(self, repositoryNames=None, **kwargs):  # NOQA
+        self._call('DescribeRepositories')
+        repositories = []
+        for name in repositoryNames or sorted(self.aws.images):
+            if name not in self.aws.images:
+                raise client_error('RepositoryNotFoundException', 'DescribeRepositories')
+            repositories.append({
+                'repositoryName': name,
+                'repositoryUri': '{0}.dkr.ecr.{1}.amazonaws.com/{2}'.format(ACCOUNT, REGION, name),
+            })
+        return ok({'repositories': repositories})
+
+    def create_repository(self, repositoryName, **kwargs):  # NOQA
+        self._call('CreateRepository')
+        self.aws.images.setdefault(repositoryName, {})
+        return ok({'repository': self.describe_repositories([repositoryName])['repositories'][0]})
+
+    def list_images(self, repositoryName, filter=None, nextToken=None, maxResults=None):  # NOQA
+        self._call('ListImages')
+        image_ids = [{'imageTag': tag, 'imageDigest': digest}
+                     for tag, digest in sorted(self.aws.images.get(repositoryName, {}).items())]
+        page, token = self.page(image_ids, nextToken, maxResults)
+        return ok({'imageIds': page, 'nextToken': token})
+
+    def describe_images(self, repositoryName, imageIds=(), **kwargs):  # NOQA
+        self._call('DescribeImages')
+        details = []
+        for image_id in imageIds:
+            digest = self.aws.images.get(repositoryName, {}).get(image_id.get('imageTag'), image_id.get('imageDigest'))
+            if digest is None or digest not in self.aws.images.get(repositoryName, {}).values():
+                raise client_error('ImageNotFoundException', 'DescribeImages')
+            tags = [t for t, d in self.aws.images[repositoryName].items() if d == digest]
+            details.append({'repositoryName': repositoryName, 'imageDigest': digest, 'imageTags': sorted(tags)})
+        return ok({'imageDetails': details})
+
+    def get_download_url_for_layer(self, repositoryName, layerDigest, **kwargs):  # NOQA
+        self._call('GetDownloadUrlForLayer')
+        if layerDigest not in self.aws.image_configs:
+            raise client_error('LayersNotFoundException', 'GetDownloadUrlForLayer')
+        return ok({'downloadUrl': self.aws.blob_url(layerDigest), 'layerDigest': layerDigest})
+
+    def batch_get_image(self, repositoryName, imageIds=(), acceptedMediaTypes=None, **kwargs):  # NOQA
+        self._call('BatchGetImage')
+        images, failures = [], []
+        for image_id in imageIds:
+            digest = self.aws.images.get(repositoryName, {}).get(image_id.get('imageTag'), image_id.get('imageDigest'))
+            if digest not in self.aws.manifests:
+                failures.append({'imageId': image_id, 'failureCode': 'ImageNotFound'})
+                continue
+            images.append({'repositoryName': repositoryName, 'imageId': dict(image_id, imageDigest=digest),
+                           'imageManifest': json.dumps(self.aws.manifests[digest])})
+        return ok({'images': images, 'failures': failures})
+
+
+class StandInLogs(StandInClient):
+    service_name = 'logs'
+
+    def describe_log_groups(self, logGroupNamePrefix=None, **kwargs):  # NOQA
+        self._call('DescribeLogGroups')
+        groups = sorted(set([g for g, _ in self.aws.log_streams if g.startswith(logGroupNamePrefix or '')]))
+        return ok({'logGroups': [{'logGroupName': g} for g in groups]})
+
+    def create_log_group(self, logGroupName):  # NOQA
+        self._call('CreateLogGroup')
+        return ok({})
+
+    def put_retention_policy(self, logGroupName, retentionInDays):  # NOQA
+        self._call('PutRetentionPolicy')
+        return ok({})
+
+    def get_log_events(self, logGroupName, logStreamName, nextToken=None, startFromHead=False, limit=None,  # NOQA
+                       **kwargs):
+        self._call('GetLogEvents')
+        events = self.aws.log_streams.get((logGroupName, logStreamName))
+        if events is None:
+            raise client_error('ResourceNotFoundException', 'GetLogEvents', 'The specified log stream does not exist.')
+        start = int(nextToken.split('/')[1]) if nextToken else 0
+        page = events[start:start + min(limit or 10000, self.aws.page_size)]
+        return ok({'events': deepcopy(page), 'nextForwardToken': 'f/{0}'.format(start + len(page))})
+
+    def filter_log_events(self, logGroupName, logStreamNamePrefix=None, startTime=None, endTime=None,  # NOQA
+                          nextToken=None, limit=None, **kwargs):
+        self._call('FilterLogEvents')
+        events = []
+        for (group, stream), stream_events in sorted(self.aws.log_streams.items()):
+            if group != logGroupName or not stream.startswith(logStreamNamePrefix or ''):
+                continue
+            for event in stream_events:
+                if startTime is not None and event['timestamp'] < startTime:
+                    continue
+                if endTime is not None and event['timestamp'] > endTime:
+                    continue
+                events.append(dict(event, logStreamName=stream))
+        page, token = self.page(events, nextToken, min(limit or 10000, self.aws.page_size))
+        result = {'events': page}
+        if token:
+            result['nextToken'] = token
+        return ok(result)
+
+
+class StandInCloudWatch(StandInClient):
+    service_name = 'cloudwatch'
+
+    statistics = {
+        'Average': lambda values: sum(values) / float(len(values)),
+        'Maximum': max,
+        'Minimum': min,
+        'Sum': sum,
+        'SampleCount': len,
+    }
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None, ScanBy=None, **kwargs):  # NOQA
+        self._call('GetMetricData')
+        if len(MetricDataQueries) > 500:
+            raise client_error('InvalidParameterValue', 'GetMetricData', 'At most 500 queries are allowed.')
+        start = int(NextToken or 0)
+        results = []
+        more = False
+        for query in MetricDataQueries:
+            stat = query['MetricStat']
+            metric = stat['Metric']
+            dimensions = tuple(sorted([(d['Name'], d['Value']) for d in metric.get('Dimensions', [])]))
+            samples = self.aws.metrics.get((metric['Namespace'], metric['MetricName'], dimensions), [])
+            periods = {}
+            for timestamp, value in samples:
+                if StartTime <= timestamp < EndTime:
+                    seconds = int((timestamp - EPOCH).total_seconds())
+                    periods.setdefault(EPOCH + timedelta(seconds=seconds - seconds % stat['Period']), []).append(value)
+            timestamps = sorted(periods, reverse=ScanBy != 'TimestampAscending')
+            page = timestamps[start:start + self.aws.page_size]
+            more = more or start + self.aws.page_size < len(timestamps)
+            results.append({
+                'Id': query['Id'],
+                'Label': metric['MetricName'],
+                'Timestamps': page,
+                'Values': [self.statistics[stat['Stat']](periods[t]) for t in page],
+                'StatusCode': 'Complete',
+            })
+        response = {'MetricDataResults': results}
+        if more:
+            response['NextToken'] = str(start + self.aws.page_size)
+        return ok(response)
+
+
+class StandInSsm(StandInClient):
+    service_name = 'ssm'
+
+    def get_paginator(self, operation):
+        return StandInPaginator(getattr(self, operation), 'NextToken')
+
+    def get_parameters(self, Names, WithDecryption=False, **kwargs):  # NOQA
+        self._call('GetParameters')
+        if len(Names) > 10:
+            raise client_error('ValidationException', 'GetParameters', 'At most 10 names are allowed.')
+        found = [self.aws.parameters[name] for name in Names if name in self.aws.parameters]
+        return ok({'Parameters': deepcopy(found),
+                   'InvalidParameters': [name for name in Names if name not in self.aws.parameters]})
+
+    def get_parameters_by_path(self, Path, Recursive=False, WithDecryption=False, NextToken=None,  # NOQA
+                               MaxResults=None, **kwargs):
+        self._call('GetParametersByPath')
+        prefix = Path.rstrip('/') + '/'
+        names = [name for name in sorted(self.aws.parameters)
+                 if name.startswith(prefix) and (Recursive or '/' not in name[len(prefix):])]
+        names, next_token = self.page(names, NextToken, min(MaxResults or 10, 10))
+        response = {'Parameters': deepcopy([self.aws.parameters[name] for name in names])}
+        if next_token:
+            response['NextToken'] = next_token
+        return ok(response)
+
+
+class StandInSecretsManager(StandInClient):
+    service_name = 'secretsmanager'
+
+    def _find(self, secret_id, operation):
+        for secret in self.aws.secrets.values():
+            if secret_id in (secret['Name'], secret['ARN']):
+                return secret
+        raise client_error('ResourceNotFoundException', operation, "Secrets Manager can't find the specified secret.")
+
+    def describe_secret(self, SecretId):  # NOQA
+        self._call('DescribeSecret')
+        secret = self._find(SecretId, 'DescribeSecret')
+        return ok({'ARN': secret['ARN'], 'Name': secret['Name']})
+
+    def get_secret_value(self, SecretId, **kwargs):  # NOQA
+        self._call('GetSecretValue')
+        secret = self._find(SecretId, 'GetSecretValue')
+        return ok({'ARN': secret['ARN'], 'Name': secret['Name'], 'SecretString': secret['SecretString']})
+
+
+class StandInAws(object):
+    """
+    The state of the fake AWS account, and the settings for the fake clients
+
+    `latency` is added to every call in seconds, every `throttle_every`th call
+    is throttled (and retried, like botocore does), and list calls return at
+    most `page_size` items. One-off tasks stop after `task_polls` describes
+    and service deployments add a running task on each describe.
+    """
+    client_classes = {
+        'ecs': StandInEcs,
+        'ecr': StandInEcr,
+        'logs': StandInLogs,
+        'cloudwatch': StandInCloudWatch,
+        'ssm': StandInSsm,
+        'secretsmanager': StandInSecretsManager,
+    }
+
+    def __init__(self, latency=0.0, throttle_every=0, page_size=100, task_polls=3, log_events_per_task=20):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.page_size = page_size
+        self.task_polls = task_polls
+        self.log_events_per_task = log_events_per_task
+
+        self.calls = {}
+        self.throttled = 0
+        self._call_count = 0
+        self._lock = threading.RLock()
+        self._ids = 0
+
+        self.task_definitions = {}
+        self.services = {}
+        self.tasks = {}
+        self.container_instances = {}
+        self.images = {}
+        self.manifests = {}
+        self.image_configs = {}
+        self._blob_dir = None
+        self.log_streams = {}
+        self.metrics = {}
+        self.parameters = {}
+        self.secrets = {}
+
+    def client(self, service_name, region=None):
+        return self.client_classes[service_name](self, region)
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def record(self, service_name, operation):
+        with self._lock:
+            self._call_count += 1
+            throttled = self.throttle_every and self._call_count % self.throttle_every == 0
+            key = '{0}.{1}'.format(service_name, operation)
+            self.calls[key] = self.calls.get(key, 0) + (2 if throttled else 1)
+            if throttled:
+                self.throttled += 1
+        if self.latency:
+            real_sleep(self.latency * (2 if throttled else 1))
+        if throttled:
+            time.sleep(0.1)  # botocore's first retry backs off before calling again
+
+    def next_id(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def now(self):
+        return EPOCH + timedelta(seconds=self.next_id())
+
+    # Task definitions
+
+    def add_task_definition(self, family, container_definitions, **kwargs):
+        revisions = self.task_definitions.setdefault(family, [])
+        task_def = dict(kwargs)
+        task_def.update({
+            'family': family,
+            'revision': len(revisions) + 1,
+            'taskDefinitionArn': 'arn:aws:ecs:{0}:{1}:task-definition/{2}:{3}'.format(
+                REGION, ACCOUNT, family, len(revisions) + 1),
+            'containerDefinitions': deepcopy(list(container_definitions)),
+            'status': 'ACTIVE',
+        })
+        task_def.setdefault('volumes', [])
+        revisions.append(task_def)
+        return task_def
+
+    def find_task_definition(self, name):
+        name = name.split('/')[-1]
+        family, _, revision = name.partition(':')
+        revisions = [t for t in self.task_definitions.get(family, []) if t['status'] == 'ACTIVE' or revision]
+        if not revisions:
+            return None
+        if revision:
+            matches = [t for t in revisions if str(t['revision']) == revision]
+            return matches[0] if matches else None
+        return revisions[-1]
+
+    # Services
+
+    def add_service(self, cluster, name, family, desired_count=1, enable_execute_command=False):
+        task_def = self.find_task_definition(family)
+        service = {
+            'serviceName': name,
+            'serviceArn': 'arn:aws:ecs:{0}:{1}:service/{2}/{3}'.format(REGION, ACCOUNT, cluster, name),
+            'clusterArn': 'arn:aws:ecs:{0}:{1}:cluster/{2}'.format(REGION, ACCOUNT, cluster),
+            'status': 'ACTIVE',
+            'desiredCount': desired_count,
+            'runningCount': 0,
+            'pendingCount': 0,
+            'taskDefinition': task_def['taskDefinitionArn'],
+            'deploymentConfiguration': {'maximumPercent': 200, 'minimumHealthyPercent': 100},
+            'deployments': [],
+            'events': [],
+            'enableExecuteCommand': enable_execute_command,
+        }
+        self.services[(cluster, name)] = service
+        self.start_deployment(service, task_def['taskDefinitionArn'])
+        for _ in range(desired_count):
+            self.advance_service(service)
+        return service
+
+    def start_deployment(self, service, task_definition_arn):
+        for deployment in service['deployments']:
+            deployment['status'] = 'ACTIVE'
+        service['taskDefinition'] = task_definition_arn
+        service['deployments'].insert(0, {
+            'id': 'ecs-svc/{0:019d}'.format(self.next_id()),
+            'status': 'PRIMARY',
+            'taskDefinition': task_definition_arn,
+            'desiredCount': service['desiredCount'],
+            'runningCount': 0,
+            'pendingCount': 0,
+            'createdAt': self.now(),
+            'updatedAt': self.now(),
+            'rolloutState': 'IN_PROGRESS',
+        })
+
+    def service_tasks(self, service, deployment=None):
+        group = 'service:{0}'.format(service['serviceName'])
+        return [t for t in self.tasks.values()
+                if t.get('group') == group and t['desiredStatus'] == 'RUNNING'
+                and (deployment is None or t['startedBy'] == deployment['id'])]
+
+    def advance_service(self, service):
+        """
+        Move the primary deployment one task closer to its desired count
+        """
+        cluster = service['clusterArn'].split('/')[-1]
+        primary = service['deployments'][0]
+        running = self.service_tasks(service, primary)
+        if len(running) < service['desiredCount']:
+            task_def = self.find_task_definition(primary['taskDefinition'])
+            task = self.add_task(cluster, task_def, startedBy=primary['id'], group='service:{0}'.format(
+                service['serviceName']))
+            task['enableExecuteCommand'] = service.get('enableExecuteCommand', False)
+            self.start_task(task)
+        elif len(running) > service['desiredCount']:
+            self.stop_task(running[-1], 'Scaling activity initiated by (deployment {0})'.format(primary['id']))
+        running = self.service_tasks(service, primary)
+        primary['runningCount'] = len(running)
+        if len(running) == service['desiredCount'] and len(service['deployments']) > 1:
+            for deployment in service['deployments'][1:]:
+                for task in self.service_tasks(service, deployment):
+                    self.stop_task(task, 'Scaling activity initiated by (deployment {0})'.format(primary['id']))
+            del service['deployments'][1:]
+        if len(service['deployments']) == 1 and len(running) == service['desiredCount']:
+            primary['rolloutState'] = 'COMPLETED'
+        service['runningCount'] = len(self.service_tasks(service))
+
+    # Tasks
+
+    def add_task(self, cluster, task_def, startedBy=None, overrides=None, group=None):  # NOQA
+        task_id = '{0:032x}'.format(self.next_id())
+        overrides = overrides or {}
+        container_overrides = dict([(o['name'], o) for o in overrides.get('containerOverrides', [])])
+        task = {
+            'taskArn': 'arn:aws:ecs:{0}:{1}:task/{2}/{3}'.format(REGION, ACCOUNT, cluster, task_id),
+            'clusterArn': 'arn:aws:ecs:{0}:{1}:cluster/{2}'.format(REGION, ACCOUNT, cluster),
+            'taskDefinitionArn': task_def['taskDefinitionArn'],
+            'lastStatus': 'PENDING',
+            'desiredStatus': 'RUNNING',
+            'startedBy': startedBy or '',
+            'group': group or 'family:{0}'.format(task_def['family']),
+            'overrides': overrides,
+            'createdAt': self.now(),
+            'containers': [{'name': c['name'], 'lastStatus': 'PENDING', 'runtimeId': '{0}-{1}'.format(task_id[-10:], i)}
+                           for i, c in enumerate(task_def['containerDefinitions'])],
+            '_polls': 0,
+        }
+        self.tasks[task['taskArn']] = task
+        for container in task_def['containerDefinitions']:
+            log_config = container.get('logConfiguration') or {}
+            options = log_config.get('options', {})
+            if log_config.get('logDriver') == 'awslogs' and 'awslogs-stream-prefix' in options:
+                stream = '{0}/{1}/{2}'.format(options['awslogs-stream-prefix'], container['name'], task_id)
+                command = container_overrides.get(container['name'], {}).get('command') or container.get('command')
+                self.log_streams[(options['awslogs-group'], stream)] = [
+                    {'timestamp': i, 'ingestionTime': i, 'message': '{0} line {1}'.format(' '.join(command or []), i)}
+                    for i in range(self.log_events_per_task)]
+        return task
+
+    def find_task(self, arn):
+        if arn in self.tasks:
+            return self.tasks[arn]
+        matches = [t for a, t in self.tasks.items() if a.endswith('/' + arn)]
+        return matches[0] if matches else None
+
+    def advance_task(self, task):
+        """
+        Move a one-off task from PENDING to RUNNING to STOPPED as it is polled
+        """
+        if task['group'].startswith('service:') or task['lastStatus'] == 'STOPPED':
+            return
+        task['_polls'] += 1
+        if task['_polls'] >= self.task_polls:
+            self.stop_task(task, 'Essential container in task exited', exit_code=0)
+        elif task['_polls'] >= 1:
+            self.start_task(task)
+
+    def start_task(self, task):
+        if task['lastStatus'] == 'RUNNING':
+            return
+        task['lastStatus'] = 'RUNNING'
+        task['pullStartedAt'] = self.now()
+        task['pullStoppedAt'] = self.now()
+        task['startedAt'] = self.now()
+        task['healthStatus'] = 'UNKNOWN'
+        for container in task['containers']:
+            container['lastStatus'] = 'RUNNING'
+            if task.get('enableExecuteCommand'):
+                container['managedAgents'] = [{'name': 'ExecuteCommandAgent', 'lastStatus': 'RUNNING'}]
+
+    def stop_task(self, task, reason, exit_code=None):
+        task['lastStatus'] = task['desiredStatus'] = 'STOPPED'
+        task['stoppedReason'] = reason
+        task['stopCode'] = 'EssentialContainerExited' if exit_code is not None else 'ServiceSchedulerInitiated'
+        task['stoppedAt'] = self.now()
+        for container in task['containers']:
+            container['lastStatus'] = 'STOPPED'
+            container['exitCode'] = exit_code if exit_code is not None else 0
+
+    # Container instances
+
+    def add_container_instance(self, cluster, cpu=2048, memory=3928, ports=(), status='ACTIVE'):
+        """
+        Add an EC2 instance to a cluster with `cpu` units, `memory` MiB and
+        the host `ports` in use left
+        """
+        instance_id = '{0:032x}'.format(self.next_id())
+        instance = {
+            'containerInstanceArn': 'arn:aws:ecs:{0}:{1}:container-instance/{2}/{3}'.format(
+                REGION, ACCOUNT, cluster, instance_id),
+            'clusterArn': 'arn:aws:ecs:{0}:{1}:cluster/{2}'.format(REGION, ACCOUNT, cluster),
+            'ec2InstanceId': 'i-{0:017x}'.format(self.next_id()),
+            'status': status,
+            'agentConnected': True,
+            'remainingResources': [
+                {'name': 'CPU', 'type': 'INTEGER', 'integerValue': cpu},
+                {'name': 'MEMORY', 'type': 'INTEGER', 'integerValue': memory},
+                {'name': 'PORTS', 'type': 'STRINGSET', 'stringSetValue': [str(p) for p in ports]},
+                {'name': 'PORTS_UDP', 'type': 'STRINGSET', 'stringSetValue': []},
+            ],
+        }
+        self.container_instances[instance['containerInstanceArn']] = instance
+        return instance
+
+    # Metrics
+
+    def add_metric_samples(self, namespace, metric_name, dimensions, samples):
+        """
+        Record (timestamp, value) samples of a metric with the `dimensions` dict
+        """
+        key = (namespace, metric_name, tuple(sorted(dimensions.items())))
+        self.metrics.setdefault(key, []).extend(samples)
+
+    # Parameters and secrets
+
+    def add_parameter(self, name, value, parameter_type='String'):
+        self.parameters[name] = {
+            'Name': name,
+            'Type': parameter_type,
+            'Value': value,
+            'Version': 1,
+            'ARN': 'arn:aws:ssm:{0}:{1}:parameter{2}'.format(REGION, ACCOUNT, name),
+        }
+        return self.parameters[name]['ARN']
+
+    def add_secret(self, name, value):
+        self.secrets[name] = {
+            'Name': name,
+            'SecretString': value,
+            'ARN': 'arn:aws:secretsmanager:{0}:{1}:secret:{2}-{3:06x}'.format(REGION, ACCOUNT, name, self.next_id()),
+        }
+        return self.secrets[name]['ARN']
+
+    # Images
+
+    def add_image(self, repository_name, tag, layer_sizes=(30000000, 5000000, 2000),
+                  layer_media_type='application/vnd.docker.image.rootfs.diff.tar.gzip', created_by=None):
+        """
+        Push an image with layers of `layer_sizes` bytes, made by the
+        `created_by` instructions, to a repository
+        """
+        created_by = created_by or DEFAULT_CREATED_BY[-len(layer_sizes):]
+        with self._lock:
+            images = self.images.setdefault(repository_name, {})
+            images[tag] = 'sha256:{0:064x}'.format(self.next_id())
+            config_digest = 'sha256:{0:064x}'.format(self.next_id())
+            self.image_configs[config_digest] = {
+                'architecture': 'amd64',
+                'os': 'linux',
+                'history': [{'created_by': c} for c in created_by] + [
+                    {'created_by': 'CMD ["gunicorn"]', 'empty_layer': True}],
+            }
+            self.manifests[images[tag]] = {
+                'schemaVersion': 2,
+                'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+                'config': {'mediaType': 'application/vnd.docker.container.image.v1+json', 'size': 1500,
+                           'digest': config_digest},
+                'layers': [{'mediaType': layer_media_type, 'size': size,
+                            'digest': 'sha256:{0:064x}'.format(self.next_id())} for size in layer_sizes],
+            }
+            return images[tag]
+
+    def blob_url(self, digest):
+        """
+        A file:// URL to download an image config from, like ECR's S3 URLs
+        """
+        if self._blob_dir is None:
+            self._blob_dir = tempfile.mkdtemp(prefix='standin-ecr-')
+        path = os.path.join(self._blob_dir, digest.replace(':', '-'))
+        with open(path, 'w') as f:
+            json.dump(self.image_configs[digest], f)
+        return 'file://' + path
@@ -0,0 +1,134 @@
+"""
+Summarize why the tasks of a service or cluster stopped
+
+Stopped tasks are listed a page at a time, and each page is described in
+concurrent batches of 100 while the next page is listed. The tasks are grouped
+by stop code, stopped reason, the exit codes of their containers and task
+definition revision, and the groups are ranked by their number of tasks.
+"""
+import json
+import re
+from collections import namedtuple
+from functools import partial
+
+from .ecs import DESCRIBE_TASKS_MAX, chunked
+
+ARN_RE = re.compile(r'arn:aws[\w-]*:[^\s)\]]+')
+ID_RE = re.compile(r'\b[0-9a-f]{12,}\b')
+
+StopSignature = namedtuple('StopSignature', ['task_definition', 'stop_code', 'reason', 'exit_codes'])
+
+
+def normalize_reason(reason):
+    """
+    Replace the ARNs and ids in a reason, so the same failure in different
+    tasks has the same reason
+    """
+    reason = ARN_RE.sub('<arn>', reason or '')
+    return ID_RE.sub('<id>', reason).strip()
+
+
+def get_exit_codes(task):
+    """
+    The containers of a task that didn't exit with 0, e.g. "web=137, worker=-"
+    """
+    codes = []
+    for container in task.get('containers', []):
+        exit_code = container.get('exitCode')
+        if exit_code != 0:
+            codes.append("{0}={1}".format(container['name'], '-' if exit_code is None else exit_code))
+    return ", ".join(sorted(codes))
+
+
+def get_signature(task):
+    return StopSignature(
+        task['taskDefinitionArn'].split('/')[-1],
+        task.get('stopCode', ''),
+        normalize_reason(task.get('stoppedReason')),
+        get_exit_codes(task))
+
+
+class StopGroup(object):
+    """
+    The stopped tasks with the same signature
+    """
+    def __init__(self, signature):
+        self.signature = signature
+        self.count = 0
+        self.first_stopped = None
+        self.last_stopped = None
+        self.example_task = None
+        self.container_reasons = set()
+
+    def add(self, task):
+        self.count += 1
+        stopped_at = task.get('stoppedAt')
+        if stopped_at and (self.last_stopped is None or stopped_at > self.last_stopped):
+            self.last_stopped = stopped_at
+            self.example_task = task['taskArn'].split('/')[-1]
+        if stopped_at and (self.first_stopped is None or stopped_at < self.first_stopped):
+            self.first_stopped = stopped_at
+        if self.example_task is None:
+            self.example_task = task['taskArn'].split('/')[-1]
+        for container in task.get('containers', []):
+            if container.get('exitCode') != 0 and container.get('reason'):
+                self.container_reasons.add(normalize_reason(container['reason']))
+
+    def as_dict(self):
+        result = dict(self.signature._asdict())
+        result.update({
+            'count': self.count,
+            'first_stopped': self.first_stopped.isoformat() if self.first_stopped else None,
+            'last_stopped': self.last_stopped.isoformat() if self.last_stopped else None,
+            'example_task': self.example_task,
+            'container_reasons': sorted(self.container_reasons),
+        })
+        return result
+
+
+def scan_stopped_tasks(ecs_client, cluster, service_name=None, concurrency=8):
+    """
+    Return the groups of the stopped tasks of a service, or of the whole
+    cluster, ranked by their number of tasks
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    describe = partial(ecs_client.describe_tasks, cluster)
+    futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for page in ecs_client.iter_task_arn_pages(cluster, service_name, desired_status='STOPPED'):
+            futures.extend([executor.submit(describe, chunk) for chunk in chunked(page, DESCRIBE_TASKS_MAX)])
+
+        groups = {}
+        for future in futures:
+            for task in future.result()['tasks']:
+                signature = get_signature(task)
+                if signature not in groups:
+                    groups[signature] = StopGroup(signature)
+                groups[signature].add(task)
+    return sorted(groups.values(), key=lambda g: (-g.count, g.signature))
+
+
+def format_text(groups, top=20):
+    total = sum([group.count for group in groups])
+    if not total:
+        return ["No stopped tasks."]
+    lines = ["{0} stopped tasks in {1} groups:".format(total, len(groups))]
+    for group in groups[:top]:
+        signature = group.signature
+        lines.append("{0:>7}  {1}  {2}  exit codes: {3}".format(
+            group.count, signature.task_definition, signature.stop_code or 'no stop code',
+            signature.exit_codes or 'all 0'))
+        lines.append("         {0}".format(signature.reason or 'no reason'))
+        for reason in sorted(group.container_reasons):
+            lines.append("         container: {0}".format(reason))
+        lines.append("         stopped {0} to {1}, latest task {2}".format(
+            group.first_stopped, group.last_stopped, group.example_task))
+    if len(groups) > top:
+        lines.append("{0} more groups with {1} tasks.".format(
+            len(groups) - top, sum([group.count for group in groups[top:]])))
+    return lines
+
+
+def format_json(groups, top=20):
+    return [json.dumps([group.as_dict() for group in groups[:top]], indent=2, sort_keys=True)]
@@ -0,0 +1,161 @@
+"""
+Watch a service deployment and roll it back as soon as it fails
+
+A deployment fails when too many of its tasks stop unsuccessfully (failing to
+start, an essential container exiting with an error, or failing health
+checks), when ECS reports it can't place tasks, or when it stops making
+progress: no new task has started running for the timeout. The service is
+then pointed back at the previous task definition.
+
+Only the stopped tasks of the deployment are listed, by the startedBy value
+ECS gives them, which is the deployment's id.
+"""
+import time
+
+import click
+
+from .ecs import EcsService
+
+FAILED_STOP_CODES = ('TaskFailedToStart', 'EssentialContainerExited')
+
+
+def get_task_failure(task):
+    """
+    Return why a stopped task failed, or None if it stopped normally
+    """
+    reason = task.get('stoppedReason', '')
+    if task.get('stopCode') in FAILED_STOP_CODES:
+        return "{0}: {1}".format(task['stopCode'], reason)
+    if 'health' in reason.lower():
+        return reason
+    for container in task.get('containers', []):
+        if container.get('exitCode'):
+            return "container {0} exited with {1}: {2}".format(
+                container['name'], container['exitCode'], container.get('reason', reason))
+        if container.get('healthStatus') == 'UNHEALTHY':
+            return "container {0} was unhealthy: {1}".format(container['name'], reason)
+    return None
+
+
+class RolloutWatchdog(object):
+    """
+    Watch the newest deployment of a service and roll back if it fails
+    """
+    def __init__(self, ecs_client, service, max_failed_tasks=3, timeout=300, poll_time=2):
+        self.ecs_client = ecs_client
+        self.cluster = service['clusterArn']
+        self.service_name = service['serviceName']
+        self.desired_count = service['desiredCount']
+        self.max_failed_tasks = max_failed_tasks
+        self.timeout = timeout
+        self.poll_time = poll_time
+
+        primary = [d for d in service['deployments'] if d['status'] == 'PRIMARY'][0]
+        self.deployment_id = primary['id']
+        self.deployment_created_at = primary['createdAt']
+        self.task_definition = primary['taskDefinition']
+        previous = sorted([d for d in service['deployments'] if d['status'] == 'ACTIVE'],
+                          key=lambda d: d['createdAt'], reverse=True)
+        previous = [d['taskDefinition'] for d in previous if d['taskDefinition'] != self.task_definition]
+        self.previous_task_definition = previous[0] if previous else None
+
+        self.failures = []
+        self._seen_tasks = set()
+        self._seen_events = set()
+
+    def check_events(self, service):
+        for event in service.get('events', []):
+            if event['id'] in self._seen_events or event['createdAt'] < self.deployment_created_at:
+                continue
+            self._seen_events.add(event['id'])
+            if u'unable' in event['message']:
+                self.failures.append(event['message'])
+                click.echo("Placement failure: {0}".format(event['message']))
+
+    def check_stopped_tasks(self):
+        task_arns = self.ecs_client.list_task_arns(self.cluster, started_by=self.deployment_id,
+                                                   desired_status='STOPPED')
+        new_arns = [arn for arn in task_arns if arn not in self._seen_tasks]
+        if not new_arns:
+            return
+        self._seen_tasks.update(new_arns)
+        for task in self.ecs_client.describe_tasks(self.cluster, new_arns)['tasks']:
+            failure = get_task_failure(task)
+            if failure:
+                self.failures.append(failure)
+                click.echo("Task {0} failed: {1}".format(task['taskArn'].split('/')[-1], failure))
+
+    def get_service(self):
+        response = self.ecs_client.describe_services(self.cluster, self.service_name)
+        return EcsService(self.cluster, response['services'][0])
+
+    def is_stable(self, service, task_definition):
+        deployments = service['deployments']
+        if len(deployments) != 1 or deployments[0]['taskDefinition'] != task_definition:
+            return False
+        return deployments[0]['runningCount'] == service['desiredCount']
+
+    def watch(self):
+        """
+        Wait for the deployment to become stable. Returns None on success or
+        the reason the deployment failed
+        """
+        start = progress_time = time.time()
+        running_count = 0
+        click.echo("Watching deployment of {0} (up to {1} failed tasks or {2} seconds without a new task "
+                   "running).".format(self.task_definition.split('/')[-1], self.max_failed_tasks, self.timeout))
+        while True:
+            service = self.get_service()
+            if self.is_stable(service, self.task_definition):
+                click.echo("Deployment is stable after {0:.0f} seconds.".format(time.time() - start))
+                return None
+
+            primary = [d for d in service['deployments'] if d['id'] == self.deployment_id]
+            if primary and primary[0].get('rolloutState') == 'FAILED':
+                return "ECS marked the deployment as failed: {0}".format(primary[0].get('rolloutStateReason'))
+            if primary and primary[0]['runningCount'] > running_count:
+                running_count = primary[0]['runningCount']
+                progress_time = time.time()
+
+            self.check_events(service)
+            self.check_stopped_tasks()
+            if len(self.failures) >= self.max_failed_tasks:
+                return "{0} failures in {1:.0f} seconds".format(len(self.failures), time.time() - start)
+            if time.time() - progress_time >= self.timeout:
+                return "No new task started running in {0} seconds".format(self.timeout)
+            time.sleep(self.poll_time)
+
+    def rollback(self):
+        """
+        Point the service back at the previous task definition and wait for it
+        to become stable again. Returns True if it recovered in time
+        """
+        if self.previous_task_definition is None:
+            click.echo("There is no previous task definition to roll back to.")
+            return False
+
+        start = time.time()
+        click.echo("Rolling back to {0}.".format(self.previous_task_definition.split('/')[-1]))
+        self.ecs_client.update_service(
+            self.cluster, self.service_name, self.desired_count, self.previous_task_definition)
+        while time.time() - start < self.timeout:
+            if self.is_stable(self.get_service(), self.previous_task_definition):
+                click.echo("Recovered after {0:.0f} seconds.".format(time.time() - start))
+                return True
+            time.sleep(self.poll_time)
+        click.echo("The rollback wasn't stable after {0} seconds.".format(self.timeout))
+        return False
+
+
+def watch_rollout(ecs_client, service, max_failed_tasks=3, timeout=300, poll_time=2):
+    """
+    Watch the deployment and roll back if it fails, raising a ClickException
+    """
+    watchdog = RolloutWatchdog(ecs_client, service, max_failed_tasks, timeout, poll_time)
+    failure = watchdog.watch()
+    if failure is None:
+        return
+    click.echo("Deployment failed: {0}".format(failure))
+    recovered = watchdog.rollback()
+    raise click.ClickException("Deployment of {0} failed and was {1}rolled back.".format(
+        watchdog.task_definition.split('/')[-1], '' if recovered else 'not successfully '))
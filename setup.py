@@ -39,6 +39,7 @@ setup(
     entry_points='''
         [console_scripts]
         ecs-boss=ecs_boss.commands:cli
+        ecs-boss-client=ecs_boss.client:main
     ''',
     classifiers=[],
 )